@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+""" Timed benchmarks of the main pipeline stages on synthetic data.
+
+Run from the top of the repo:
+
+    python -m benchmarks.bench --sizes 1000 10000 100000 --output results.json
+    python -m benchmarks.bench --compare results.json --output new.json
+"""
+
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+
+import dsd.loaddata as ld
+import dsd.solaobjs as so
+from dsd import api
+
+from benchmarks import synthetic
+
+def timeit(func, repeat):
+    """ Run func repeat times, return (best, mean) wall time and the last result """
+    times = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return min(times), sum(times)/len(times), result
+
+class Benchmarks(object):
+    """ Holds the synthetic inputs for one size and runs each benchmark against them """
+
+    def __init__(self, workdir, size, n_hosts, seed):
+        self.size = size
+
+        self.config_filename = os.path.join(workdir, 'config.json')
+        synthetic.write_config(self.config_filename, n_hosts=n_hosts)
+        with open(self.config_filename) as f:
+            self.config = json.load(f)
+
+        self.events_filename = os.path.join(workdir, 'events-%d.csv'%size)
+        synthetic.write_events_csv(self.events_filename, size, self.config, seed=seed)
+
+        self.capture_filename = os.path.join(workdir, 'capture-%d.pcapng'%size)
+        self.seed = seed
+
+    def _config(self):
+        return ld.read_config(self.config_filename)
+
+    def read_events(self):
+        hosts, event_types, settings = self._config()
+        return lambda: ld.read_events(self.events_filename, hosts=hosts, event_types=event_types, settings=settings)
+
+    def read_events_parallel(self):
+        hosts, event_types, settings = self._config()
+        return lambda: ld.read_events(self.events_filename, hosts=hosts, event_types=event_types, settings=settings, jobs=0)
+
+    def sort_and_process(self):
+        hosts, event_types, settings = self._config()
+        events = ld.read_events(self.events_filename, hosts=hosts, event_types=event_types, settings=settings)
+        events.reverse()
+        def run():
+            # Sort from a fresh (reversed) copy so every repeat does the same work
+            data = list(events)
+            so.Event.sort_and_process(events=data, settings=settings)
+            return data
+        return run
+
+    def generate_display_filter(self):
+        hosts, event_types, settings = self._config()
+        names = [e.name for e in event_types]
+        return lambda: ld.generate_display_filter(hosts=hosts, event_type_names=names, line_breaks=False)
+
+    def diagram_generate(self):
+        hosts, event_types, settings = self._config()
+        events = ld.read_events(self.events_filename, hosts=hosts, event_types=event_types, settings=settings)
+        ld.filter_hosts(hosts=hosts, events=events)
+        return lambda: so.Diagram(hosts=hosts, events=events, settings=settings).generate()
+
+    def event_to_svg(self):
+        """ Serialization of laid out events, without the fragment cache """
+        hosts, event_types, settings = self._config()
+        events = ld.read_events(self.events_filename, hosts=hosts, event_types=event_types, settings=settings)
+        ld.filter_hosts(hosts=hosts, events=events)
+        diag = so.Diagram(hosts=hosts, events=events, settings=settings)
+        diag.layout_hosts()
+        for e in events:
+            diag.layout_event(e)
+        return lambda: [e.to_svg() for e in events]
+
+    def api_make_events(self):
+        """ Events built from in-memory tuples by dsd.api, to compare with
+        the CSV round trip of read_events """
+        hosts, event_types, settings = self._config()
+        events = ld.read_events(self.events_filename, hosts=hosts, event_types=event_types, settings=settings)
+        records = [(e.time, e.src.id, e.dst.id, e.event_type.name, e.ack_time, e.frame_id, e.ack_frame_id) for e in events]
+        config = api.Config.from_file(self.config_filename)
+        return lambda: api.make_events(records, config)
+
+    def query_logs(self):
+        if not shutil.which('tshark'):
+            return None
+        if not os.path.exists(self.capture_filename):
+            synthetic.write_pcapng(self.capture_filename, self.size, self.config, seed=self.seed)
+        hosts, event_types, settings = self._config()
+        names = [e.name for e in event_types]
+        return lambda: ld.query_logs(
+            capture_filename=self.capture_filename,
+            hosts=hosts,
+            event_type_names=names,
+            event_types=event_types,
+            settings=settings,
+        )
+
+    def startup(self):
+        """ Start up of the CSV to SVG command (tests/test_startup.py checks
+        it doesn't import the capture backends) """
+        return lambda: subprocess.check_call([sys.executable, '-c', 'import dsd.generateSequenceDiag'])
+
+BENCHMARKS = ['startup', 'read_events', 'read_events_parallel', 'api_make_events', 'sort_and_process', 'generate_display_filter', 'event_to_svg', 'diagram_generate', 'query_logs']
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """ Print a table of the new results against a previous results file """
+    old = {(r['name'], r['size']): r for r in baseline['results']}
+    print('%-25s %9s %10s %10s %8s'%('Benchmark', 'Size', 'Old (s)', 'New (s)', 'Ratio'))
+    for r in results:
+        o = old.get((r['name'], r['size']))
+        if o is None:
+            continue
+        print('%-25s %9d %10.4f %10.4f %7.2fx'%(r['name'], r['size'], o['best'], r['best'], r['best']/o['best'] if o['best'] else 0))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sequence diagram pipeline on synthetic data')
+    parser.add_argument('--sizes',   dest='sizes',   nargs='+', type=int, default=[1000, 10000, 100000], help='Number of events per run (up to 10^6)')
+    parser.add_argument('--only',    dest='only',    nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run')
+    parser.add_argument('--hosts',   dest='n_hosts', type=int, default=4, help='Number of synthetic hosts')
+    parser.add_argument('--repeat',  dest='repeat',  type=int, default=3, help='Repetitions per benchmark (best is reported)')
+    parser.add_argument('--seed',    dest='seed',    type=int, default=0, help='Random seed for the generators')
+    parser.add_argument('--workdir', dest='workdir', default=None, help='Where to write the synthetic inputs (a temporary directory by default)')
+    parser.add_argument('-o', '--output',  dest='output',  default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', dest='compare', default=None, type=ld.argparse_file_exists, help='Previous results JSON to compare against')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dsd-bench-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    results = []
+    for size in args.sizes:
+        print('Generating %d events in %s'%(size, workdir), file=sys.stderr)
+        b = Benchmarks(workdir=workdir, size=size, n_hosts=args.n_hosts, seed=args.seed)
+
+        for name in args.only:
+            func = getattr(b, name)()
+            if func is None:
+                print('%-25s %9d   skipped (tshark not found)'%(name, size), file=sys.stderr)
+                continue
+
+            best, mean, _ = timeit(func, args.repeat)
+            print('%-25s %9d %10.4f s (mean %0.4f s)'%(name, size, best, mean), file=sys.stderr)
+            results.append({'name': name, 'size': size, 'best': best, 'mean': mean, 'repeat': args.repeat})
+
+    report = {
+        'date':     datetime.datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python':   platform.python_version(),
+        'platform': platform.platform(),
+        'results':  results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
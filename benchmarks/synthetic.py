@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+""" Generators for synthetic config files, events CSV files and pcapng
+captures, so the pipeline can be benchmarked at sizes the samples don't
+cover. """
+
+from __future__ import print_function
+
+import json
+import heapq
+import random
+import struct
+import socket
+import datetime
+
+DEFAULT_EVENT_TYPES = ['StartCall', 'EndMedia', 'EndCall', 'CDRtype1']
+
+""" Host types cycled through when generating a config """
+HOST_TYPES = ['APP', 'ADMIN', 'MIS', 'ELM', 'REC', 'GA']
+
+def make_config(n_hosts=3, event_types=DEFAULT_EVENT_TYPES, settings=None):
+    """ Build a config (as a dict ready to be dumped to JSON) with n_hosts hosts on 10.0.0.0/16 """
+
+    hosts = []
+    for i in range(n_hosts):
+        hosts.append({
+            'id':        'Host%d'%i,
+            'name':      'Host%d'%i,
+            'ip':        '10.0.%d.%d'%(i // 250, (i % 250) + 1),
+            'hostType':  HOST_TYPES[i % len(HOST_TYPES)],
+            'sortNudge': i,
+        })
+
+    cfg = {
+        'hosts':      hosts,
+        'eventTypes': [{'eventType': e} for e in event_types],
+        'settings': {
+            'hostSpacing':          60,
+            'timeMarginLeft':       20,
+            'timeSpacing':          1000,
+            'maxTimeGap':           0.02,
+            'minLabelTimeGap':      0.005,
+            'timeUnit':             'secondsSinceStart',
+            'ackThresholdFast':     0.002,
+            'ackThresholdSlow':     0.010,
+            'ackThresholdVerySlow': 0.050,
+        },
+    }
+    if settings:
+        cfg['settings'].update(settings)
+
+    return cfg
+
+def write_config(filename, **kwargs):
+    cfg = make_config(**kwargs)
+    with open(filename, 'w') as f:
+        json.dump(cfg, f, indent=4)
+    return cfg
+
+def generate_events(n_events, config, rate=200.0, slow_fraction=0.05, seed=0, start=None):
+    """ Generator of (time, src host dict, dst host dict, event type, ack time)
+    tuples, ordered by time.  Inter-arrival times are exponential with the
+    given mean rate (events/s), ack times are mostly fast with slow_fraction
+    of them being slow. """
+
+    rnd = random.Random(seed)
+    hosts = config['hosts']
+    event_types = [e['eventType'] for e in config['eventTypes']]
+    t = start or datetime.datetime(2019, 8, 8, 12, 0, 0)
+
+    for i in range(n_events):
+        t += datetime.timedelta(seconds=rnd.expovariate(rate))
+        src, dst = rnd.sample(hosts, 2)
+        if rnd.random() < slow_fraction:
+            ack = rnd.uniform(0.010, 0.200)
+        else:
+            ack = rnd.uniform(0.0002, 0.004)
+        yield t, src, dst, rnd.choice(event_types), ack
+
+def write_events_csv(filename, n_events, config, **kwargs):
+    """ Write a synthetic events CSV in the format read by loaddata.read_events """
+
+    with open(filename, 'w') as f:
+        f.write('time,src,dst,eventType,ackTime,frameId,ackFrameId\n')
+        frame_id = 1
+        for t, src, dst, et, ack in generate_events(n_events, config, **kwargs):
+            f.write('%s,%s,%s,%s,%f,%d,%d\n'%(
+                t.strftime('%Y-%m-%d %H:%M:%S.%f'), src['id'], dst['id'], et, ack, frame_id, frame_id+1
+            ))
+            frame_id += 2
+
+class PcapngWriter(object):
+    """ Minimal pcapng writer: one section, one Ethernet interface, enhanced packet blocks """
+
+    def __init__(self, f):
+        self.f = f
+
+        # Section header block
+        self.f.write(struct.pack('<IIIHHq', 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1))
+        self.f.write(struct.pack('<I', 28))
+
+        # Interface description block, linktype 1 (Ethernet), microsecond timestamps
+        self.f.write(struct.pack('<IIHHII', 1, 20, 1, 0, 0, 20))
+
+    def write_packet(self, time, data):
+        ts = int((time - datetime.datetime(1970, 1, 1)).total_seconds() * 1e6)
+        pad = (4 - len(data) % 4) % 4
+        total = 32 + len(data) + pad
+        self.f.write(struct.pack('<IIIIIII', 6, total, 0, ts >> 32, ts & 0xFFFFFFFF, len(data), len(data)))
+        self.f.write(data)
+        self.f.write(b'\0' * pad)
+        self.f.write(struct.pack('<I', total))
+
+def _ip_checksum(header):
+    s = sum(struct.unpack('!10H', header))
+    s = (s & 0xFFFF) + (s >> 16)
+    s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
+
+def make_tcp_frame(src_ip, dst_ip, sport, dport, seq, ack, payload, ip_id=0):
+    """ Build an Ethernet/IPv4/TCP frame (PSH,ACK) carrying payload """
+
+    tcp = struct.pack('!HHIIBBHHH', sport, dport, seq & 0xFFFFFFFF, ack & 0xFFFFFFFF, 0x50, 0x18, 65535, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), ip_id & 0xFFFF, 0x4000, 64, 6, 0,
+                     socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+    ip = ip[:10] + struct.pack('!H', _ip_checksum(ip)) + ip[12:]
+    eth = b'\x02\x00\x00\x00\x00\x01' + b'\x02\x00\x00\x00\x00\x02' + b'\x08\x00'
+    return eth + ip + tcp + payload
+
+def http_post(dst_ip, event_type):
+    body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<LogEvent><timestamp>0</timestamp><eventType>%s</eventType></LogEvent>'%event_type).encode('ascii')
+    head = ('POST /LogEvent HTTP/1.1\r\nHost: %s\r\nContent-Type: text/xml\r\nContent-Length: %d\r\n\r\n'%(dst_ip, len(body))).encode('ascii')
+    return head + body
+
+HTTP_OK = b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+def write_pcapng(filename, n_events, config, http_port=80, **kwargs):
+    """ Write a synthetic capture of n_events HTTP POSTs with XML <eventType>
+    bodies between the configured hosts, each followed (after its ack time)
+    by a 200 response on the same TCP connection.  Packets are streamed, so
+    memory stays bounded however many events are written.
+
+    Every request gets its own connection (no pipelining).  Client ports are
+    recycled, so sequence numbers keep moving forward within a host pair to
+    avoid reused ports looking like retransmissions. """
+
+    # Number of connections opened so far per (src, dst) pair
+    conns = {}
+    pending = []  # heap of (time, order, frame)
+    order = 0
+    ip_id = 0
+
+    with open(filename, 'wb') as f:
+        w = PcapngWriter(f)
+
+        for t, src, dst, et, ack in generate_events(n_events, config, **kwargs):
+            # Flush responses that happen before this request
+            while pending and pending[0][0] <= t:
+                pt, _, frame = heapq.heappop(pending)
+                w.write_packet(pt, frame)
+
+            key = (src['ip'], dst['ip'])
+            k = conns.get(key, 0)
+            conns[key] = k + 1
+            port = 1024 + k % 64000
+            seq = 1 + k * 4096
+
+            req = http_post(dst['ip'], et)
+            ip_id += 1
+            w.write_packet(t, make_tcp_frame(src['ip'], dst['ip'], port, http_port, seq, seq, req, ip_id))
+
+            ip_id += 1
+            resp = make_tcp_frame(dst['ip'], src['ip'], http_port, port, seq, seq + len(req), HTTP_OK, ip_id)
+
+            order += 1
+            heapq.heappush(pending, (t + datetime.timedelta(seconds=ack), order, resp))
+
+        while pending:
+            pt, _, frame = heapq.heappop(pending)
+            w.write_packet(pt, frame)
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+""" Streaming ACK latency statistics: quantiles of the ACK times per
+(source, destination, event type), overall and per time window.
+
+Each group keeps a QuantileSketch rather than the ACK times themselves, so
+memory only depends on the number of groups, never on the number of events.
+Sketches are mergeable, which is how the per window groups are rolled up into
+the overall ones. """
+
+from __future__ import print_function
+
+import os
+import csv
+import math
+import json
+import datetime
+
+import dsd.svgobjs as svg
+from dsd import compression
+
+""" Quantiles reported for every group """
+QUANTILES = [0.5, 0.95, 0.99]
+
+class QuantileSketch(object):
+    """ Mergeable quantile sketch with bounded relative error (in the manner
+    of DDSketch).  Values are counted in logarithmically sized buckets, so any
+    quantile is returned within relative_accuracy of the true value.  ACK
+    times spanning a microsecond to a minute need under a thousand buckets at
+    1%, and the lowest buckets are folded together past max_buckets. """
+
+    """ Values below this (s) are counted as zero """
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy)/(1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        """ Dict of bucket index -> count, bucket k holds (gamma^(k-1), gamma^k] """
+        self.buckets = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.sum   = 0.0
+        self.min   = None
+        self.max   = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value < self.MIN_VALUE:
+            self.zero_count += 1
+            return
+
+        k = int(math.ceil(math.log(value)/self._log_gamma))
+        self.buckets[k] = self.buckets.get(k, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        """ Fold the lowest buckets into the next one, trading accuracy on the
+        smallest values for bounded memory """
+        keys = sorted(self.buckets)
+        while len(keys) > self.max_buckets:
+            k = keys.pop(0)
+            self.buckets[keys[0]] += self.buckets.pop(k)
+
+    def merge(self, other):
+        """ Add the values counted by another sketch (of the same accuracy) to this one """
+        if other.gamma != self.gamma:
+            raise ValueError('Cannot merge sketches of different accuracies')
+        if not other.count:
+            return
+
+        for k, c in other.buckets.items():
+            self.buckets[k] = self.buckets.get(k, 0) + c
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum   += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def quantile(self, q):
+        """ Estimate of the q (0 to 1) quantile, or None if the sketch is empty """
+        if not self.count:
+            return None
+
+        rank = q*(self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        running = self.zero_count
+        for k in sorted(self.buckets):
+            running += self.buckets[k]
+            if running > rank:
+                value = 2*self.gamma**k/(self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum/self.count if self.count else None
+
+class AckStatsGroup(object):
+    """ ACK times of the events of one (src, dst, event type[, window]) """
+
+    def __init__(self, relative_accuracy):
+        self.sketch  = QuantileSketch(relative_accuracy=relative_accuracy)
+
+        """ Events seen, including those that were never ACKed """
+        self.events  = 0
+        self.unacked = 0
+
+    def add(self, ack_time):
+        self.events += 1
+        if ack_time is None:
+            self.unacked += 1
+        else:
+            self.sketch.add(ack_time)
+
+    def merge(self, other):
+        self.events  += other.events
+        self.unacked += other.unacked
+        self.sketch.merge(other.sketch)
+
+class AckStats(object):
+    """ Accumulates the ACK times of a stream of events, see the module docstring.
+
+    With window (s), the events are also grouped by the time window they fall
+    in (aligned on the epoch, so reports of different captures line up). """
+
+    def __init__(self, window=None, relative_accuracy=0.01):
+        self.window = window
+        self.relative_accuracy = relative_accuracy
+
+        """ Dict of (src id, dst id, event type name, window start or None) -> AckStatsGroup """
+        self.groups = {}
+
+    def _group(self, key):
+        g = self.groups.get(key)
+        if g is None:
+            g = self.groups[key] = AckStatsGroup(self.relative_accuracy)
+        return g
+
+    def add(self, e):
+        """ Count one event, events can come in any order """
+        window_start = None
+        if self.window:
+            window_start = math.floor(e.time.timestamp()/self.window)*self.window
+        self._group((e.src.id, e.dst.id, e.event_type.name, window_start)).add(e.ack_time)
+
+    def add_events(self, events):
+        for e in events:
+            self.add(e)
+        return self
+
+    def merge(self, other):
+        """ Fold the groups of another AckStats (e.g. of another capture) into this one """
+        for key, g in other.groups.items():
+            self._group(key).merge(g)
+
+    def totals(self):
+        """ Groups rolled up over the time windows, as a dict of (src id, dst id, event type name) -> AckStatsGroup """
+        if not self.window:
+            return {k[:3]: g for k, g in self.groups.items()}
+
+        totals = {}
+        for key, g in self.groups.items():
+            t = totals.get(key[:3])
+            if t is None:
+                t = totals[key[:3]] = AckStatsGroup(self.relative_accuracy)
+            t.merge(g)
+        return totals
+
+    def rows(self):
+        """ One dict per group (the overall groups first, then the windows),
+        as written to the reports.  Times are in seconds. """
+
+        groups = [(k + (None,), g) for k, g in sorted(self.totals().items())]
+        if self.window:
+            groups += sorted(self.groups.items(), key=lambda kg: (kg[0][3],) + kg[0][:3])
+
+        rows = []
+        for (src, dst, event_type, window_start), g in groups:
+            s = g.sketch
+            row = {
+                'src':         src,
+                'dst':         dst,
+                'eventType':   event_type,
+                'windowStart': datetime.datetime.fromtimestamp(window_start).isoformat() if window_start is not None else None,
+                'events':      g.events,
+                'unacked':     g.unacked,
+                'min':         s.min,
+                'mean':        s.mean,
+                'max':         s.max,
+            }
+            for q in QUANTILES:
+                row[quantile_name(q)] = s.quantile(q)
+            rows.append(row)
+        return rows
+
+    def to_element(self, x=0, y=0):
+        """ Summary table (one row per overall group) as an svg.G, returns
+        (element, height in display units) """
+
+        line_h = 5
+        columns = [('Source', 0), ('Destination', 25), ('Event', 50), ('Events', 85), ('No ACK', 100)]
+        for i, q in enumerate(QUANTILES):
+            columns.append((quantile_name(q) + ' (ms)', 117 + 18*i))
+        columns.append(('max (ms)', 117 + 18*len(QUANTILES)))
+
+        def ms(v):
+            return '%0.3f'%(v*1000) if v is not None else '-'
+
+        table = svg.G(attrs={'id': 'ack-stats', 'transform': 'translate(%s,%s)'%(x, y)})
+        def text(col, row, value, weight='normal'):
+            table.append(svg.Text(
+                attrs={'x': columns[col][1], 'y': (row + 1)*line_h},
+                style='font-size:3.5px;font-family:Sans;font-weight:%s'%weight,
+                text=str(value),
+            ))
+
+        for c, (title, _) in enumerate(columns):
+            text(c, 0, title, weight='bold')
+
+        totals = sorted(self.totals().items())
+        for r, ((src, dst, event_type), g) in enumerate(totals, start=1):
+            values = [src, dst, event_type, g.events, g.unacked]
+            values += [ms(g.sketch.quantile(q)) for q in QUANTILES]
+            values.append(ms(g.sketch.max))
+            for c, v in enumerate(values):
+                text(c, r, v)
+
+        height = (len(totals) + 2)*line_h
+        return table, height
+
+def quantile_name(q):
+    """ Report column of a quantile, e.g. p95 """
+    return 'p%g'%(q*100)
+
+def write_ack_stats(filename, stats):
+    """ Write the report of an AckStats, as CSV if filename ends in .csv and
+    JSON otherwise (either compressed for .gz or .zst, see dsd.compression) """
+
+    rows = stats.rows()
+    if os.path.splitext(compression.strip_suffix(filename))[1].lower() == '.csv':
+        fields = ['src', 'dst', 'eventType', 'windowStart', 'events', 'unacked', 'min', 'mean'] + [quantile_name(q) for q in QUANTILES] + ['max']
+        with compression.open_output(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({k: ('' if v is None else v) for k, v in row.items()})
+    else:
+        with compression.open_output(filename, 'w') as f:
+            json.dump({
+                'windowSeconds':    stats.window,
+                'relativeAccuracy': stats.relative_accuracy,
+                'groups':           rows,
+            }, f, indent=4)
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+""" Python API to draw diagrams of events held in memory, e.g. by a log
+parser or a message bus consumer, without writing them to a CSV and running
+generateSequenceDiag.
+
+Events are plain tuples or dicts:
+
+    (time, src, dst, event_type[, ack_time[, frame_id[, ack_frame_id]]])
+    {'time': ..., 'src': ..., 'dst': ..., 'eventType': ..., 'ackTime': ...,
+     'frameId': ..., 'ackFrameId': ...}
+
+src and dst are host ids and event_type an event type name of the config
+(or the Host and EventType objects themselves).  The time is a datetime, a
+POSIX timestamp, or a string in the format of the events CSVs.  The ACK time
+(s) and frame ids are optional; events without frame ids are numbered in
+the order they are given.
+
+    config = api.Config.from_file('config.json')
+    svg = api.render_svg(events, config)
+
+    # Or stream it to a file (compressed for .svgz), a socket, etc
+    api.write_svg(events, config, 'diagram.svgz')
+
+Rendering lays out the Host objects of the config, so a Config shouldn't be
+used by renders running in several threads at once. """
+
+from __future__ import print_function
+
+import copy
+import json
+import datetime
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+from dsd import csvchunks
+
+class Config(object):
+    """ The hosts, event types and settings of a config file, indexed by
+    host id and event type name """
+
+    def __init__(self, hosts, event_types, settings):
+        self.hosts       = hosts
+        self.event_types = event_types
+        self.settings    = settings
+
+        self._hosts       = {h.id: h for h in hosts}
+        self._event_types = {et.name: et for et in event_types}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Config from the parsed JSON of a config file (which is left untouched) """
+        hosts, event_types, settings = ld.ConfigFile.from_json(copy.deepcopy(data))
+        hosts.sort(key=lambda x: x.sort_nudge)
+        return cls(hosts, event_types, settings)
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename) as json_file:
+            return cls.from_dict(json.load(json_file))
+
+    def host(self, value):
+        """ The Host of a host id (or the Host itself) """
+        if isinstance(value, so.Host):
+            return value
+        try:
+            return self._hosts[value]
+        except KeyError:
+            raise ValueError('Unknown host "%s"'%value)
+
+    def event_type(self, value):
+        """ The EventType of an event type name (or the EventType itself) """
+        if isinstance(value, so.EventType):
+            return value
+        try:
+            return self._event_types[value]
+        except KeyError:
+            raise ValueError('Unknown event type "%s"'%value)
+
+def as_config(config):
+    """ A Config from a Config, the parsed JSON of a config file, or its file name """
+    if isinstance(config, Config):
+        return config
+    if isinstance(config, dict):
+        return Config.from_dict(config)
+    return Config.from_file(config)
+
+""" Fields of the tuples, and the keys accepted for them in dicts """
+FIELDS = [
+    ('time',         ('time',)),
+    ('src',          ('src',)),
+    ('dst',          ('dst',)),
+    ('event_type',   ('eventType', 'event_type')),
+    ('ack_time',     ('ackTime', 'ack_time')),
+    ('frame_id',     ('frameId', 'frame_id')),
+    ('ack_frame_id', ('ackFrameId', 'ack_frame_id')),
+]
+
+def _fields(record):
+    """ The fields of a record (see FIELDS) as a dict, missing ones None """
+    if isinstance(record, dict):
+        values = {}
+        for name, keys in FIELDS:
+            values[name] = next((record[k] for k in keys if k in record), None)
+        return values
+
+    if len(record) < 4:
+        raise ValueError('Events need at least a time, a source, a destination and an event type: %r'%(record,))
+    values = dict(zip([name for name, _ in FIELDS], record))
+    for name, _ in FIELDS:
+        values.setdefault(name, None)
+    return values
+
+def _time(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value)
+    return csvchunks.parse_time(value)
+
+def make_events(records, config, skip_unknown=False):
+    """ Events of an iterable of tuples or dicts (see the module docstring),
+    sorted and processed (Event.sort_and_process) ready to be drawn.
+
+    Unknown hosts or event types raise ValueError, or are skipped with
+    skip_unknown. """
+
+    config = as_config(config)
+
+    events = []
+    for i, record in enumerate(records):
+        f = _fields(record)
+        try:
+            src = config.host(f['src'])
+            dst = config.host(f['dst'])
+            et  = config.event_type(f['event_type'])
+        except ValueError:
+            if skip_unknown:
+                continue
+            raise
+
+        events.append(so.Event(
+            settings     = config.settings,
+            time         = _time(f['time']),
+            src          = src,
+            dst          = dst,
+            event_type   = et,
+            ack_time     = f['ack_time'],
+            frame_id     = f['frame_id'] if f['frame_id'] is not None else i + 1,
+            ack_frame_id = f['ack_frame_id'],
+        ))
+
+    so.Event.sort_and_process(events=events, settings=config.settings)
+    return events
+
+def make_diagram(records, config, skip_unknown=False, inkscape=False, coalesce_bursts=False, burst_window=None, anomalies_only=False, context_events=0, context_time=0):
+    """ The so.Diagram of the events (tuples, dicts or the so.Events of
+    make_events), drawn like generateSequenceDiag would with the same
+    options.  Only the hosts involved in the events are drawn. """
+
+    config = as_config(config)
+
+    events = list(records)
+    if not all(isinstance(e, so.Event) for e in events):
+        events = make_events(events, config, skip_unknown=skip_unknown)
+
+    if coalesce_bursts:
+        events = ld.coalesce_bursts(events=events, settings=config.settings, window=burst_window)
+    if anomalies_only:
+        events = ld.filter_anomalies(events=events, settings=config.settings, context_events=context_events, context_time=context_time)
+
+    hosts = list(config.hosts)
+    ld.filter_hosts(hosts=hosts, events=events)
+    if not events:
+        raise ValueError('No events to draw')
+
+    return so.Diagram(hosts=hosts, events=events, settings=config.settings, inkscape=inkscape)
+
+def render_svg(records, config, **options):
+    """ The SVG of the events, as a string (see make_diagram for the options) """
+    return make_diagram(records, config, **options).generate()
+
+def write_svg(records, config, outfile, **options):
+    """ Write the SVG of the events as it is rendered (see make_diagram for
+    the options).  outfile is an open text file or anything with a write
+    method (e.g. a socket wrapper), or a file name, compressed according to
+    its name (see dsd.compression). """
+
+    diag = make_diagram(records, config, **options)
+    if hasattr(outfile, 'write'):
+        diag.write(outfile)
+    else:
+        ld.write_diagram(outfile, diag)
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+""" asyncio versions of the capture queries in loaddata, so several captures
+can be processed concurrently from one event loop (each capture still gets
+its own tshark process). """
+
+from __future__ import print_function
+
+import asyncio
+import datetime
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+from dsd.profiling import stage
+
+""" Most packets tshark can get ahead of the events being consumed by """
+QUEUE_SIZE = 1000
+
+async def _tshark_packets(cap):
+    """ Async generator of the packets of a pyshark capture, read from a new
+    tshark process.  This is Capture.packets_from_tshark, whose callback
+    can't wait for the consumer, turned inside out. """
+
+    tshark = await cap._get_tshark_process()
+    parser = cap._setup_tshark_output_parser()
+    data = b''
+    got_first_packet = False
+    while True:
+        try:
+            p, data = await parser.get_packets_from_stream(tshark.stdout, data, got_first_packet=got_first_packet)
+        except EOFError:
+            break
+        if p is not None:
+            got_first_packet = True
+            yield p
+
+async def aiter_capture_events(capture_filename, hosts, event_type_names, event_types, from_frame: int=None, to_frame: int=None, settings: ld.Settings=None, verbose=False, profiler=None, clock_offset: float=0, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Async generator of the events of a capture file in time order, the
+    async equivalent of loaddata.iter_capture_events.
+
+    tshark runs in a task feeding a queue of at most QUEUE_SIZE packets, so
+    a fast tshark waits for the events to be consumed rather than reading
+    the whole capture into memory.  Cancelling the consumer (or closing the
+    generator early) cancels that task, which kills tshark.
+    progress is shared by all the queries of query_many_async, see
+    loaddata.iter_capture_events. """
+
+    loop = asyncio.get_running_loop()
+    ack_timeout = datetime.timedelta(seconds=settings.ack_timeout if settings else 5)
+    cap = ld.open_capture(
+        capture_filename,
+        hosts=hosts,
+        event_type_names=event_type_names,
+        verbose=verbose,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        from_time=from_time,
+        to_time=to_time + ack_timeout if to_time else None,
+        eventloop=loop,
+    )
+
+    streamer = ld.EventStreamer(
+        hosts=hosts,
+        all_hosts=all_hosts,
+        event_types=event_types,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+        clock_offset=clock_offset,
+        frame_offset=getattr(cap, 'frame_offset', 0),
+        from_time=from_time,
+        to_time=to_time,
+    )
+
+    """ Packets from tshark, None marks the end of the capture """
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async def produce():
+        try:
+            async for p in _tshark_packets(cap):
+                await queue.put(p)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Wake the consumer up, it raises the error
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    if progress is not None:
+        capture = progress.start_capture(streamer.matcher)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            p = await queue.get()
+            if p is None:
+                break
+
+            if progress is not None:
+                progress.packet(p, capture)
+            for e in streamer.feed(p):
+                yield e
+            if streamer.done:
+                break
+            if progress is not None and progress.stop_requested:
+                break
+
+        # Surface tshark errors, once the capture is over
+        if p is None:
+            await producer
+
+        for e in streamer.finish():
+            yield e
+
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+        await cap.close_async()
+
+        if profiler:
+            streamer.matcher.report(profiler)
+
+async def query_logs_async(capture_filename, hosts, event_type_names, event_types, from_frame: int=None, to_frame: int=None, settings: ld.Settings=None, verbose=False, profiler=None, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Query a capture file for events, the async equivalent of loaddata.query_logs """
+
+    events = []
+    async for e in aiter_capture_events(
+        capture_filename=capture_filename,
+        hosts=hosts,
+        all_hosts=all_hosts,
+        event_type_names=event_type_names,
+        event_types=event_types,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+        from_time=from_time,
+        to_time=to_time,
+        progress=progress,
+    ):
+        events.append(e)
+
+    with stage(profiler, 'sort_and_process'):
+        so.Event.sort_and_process(events=events, settings=settings)
+
+    return events
+
+async def query_many_async(capture_filenames, concurrency=4, return_exceptions=False, **kwargs):
+    """ Run query_logs_async on several capture files, at most 'concurrency'
+    at a time.  kwargs are passed to every query.
+
+    Returns the list of results in the order of capture_filenames.  If a
+    query fails, the others are cancelled and the error is raised, unless
+    return_exceptions is set in which case the exception is returned in place
+    of that capture's events. """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(f):
+        async with semaphore:
+            return await query_logs_async(capture_filename=f, **kwargs)
+
+    tasks = [asyncio.ensure_future(run(f)) for f in capture_filenames]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def query_many(capture_filenames, concurrency=4, **kwargs):
+    """ Blocking wrapper around query_many_async, for callers without an event loop """
+    return asyncio.run(query_many_async(capture_filenames, concurrency=concurrency, **kwargs))
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
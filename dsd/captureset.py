@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+""" Sets of capture files holding consecutive stretches of the same traffic,
+e.g. the ring buffer written by 'dumpcap -b duration:60 -b files:500', read
+one after the other as a single capture (see loaddata.iter_capture_set_events)
+rather than concatenated with mergecap first.
+
+A set is given as a glob ('/captures/ring_*.pcapng') or as the prefix of the
+file names ('/captures/ring', which dumpcap expands to ring_00001_<date>.pcapng
+and so on).  The files are put in time order, and numbered as one capture:
+frame numbers run on from one file to the next.
+
+The frame count and the times of the first and last packets of every file
+come from its frame index (see dsd.frameindex), built with a single pass over
+the framing the first time the file is seen and cached next to it, so files
+entirely outside a time or frame window are skipped without being opened
+again. """
+
+from __future__ import print_function
+
+import os
+import glob
+import datetime
+
+from dsd import pcapio
+from dsd import compression
+
+class CaptureFile(object):
+    """ One file of a capture set """
+
+    def __init__(self, filename, frames, first_time, last_time):
+        self.filename   = filename
+
+        """ Number of frames, None if unknown (a format we can't index) """
+        self.frames     = frames
+
+        """ Times (epoch seconds) of the earliest and latest packets, None if unknown """
+        self.first_time = first_time
+        self.last_time  = last_time
+
+        """ Number of frames in the files before this one """
+        self.frame_offset = 0
+
+    def __repr__(self):
+        return '%s (%s frames from %d)'%(self.filename, self.frames, self.frame_offset + 1)
+
+def is_pattern(spec):
+    return any(c in spec for c in '*?[')
+
+def _is_capture(filename):
+    """ Whether a file looks like a (possibly compressed) pcap or pcapng
+    capture, to leave out the indexes, events CSVs, etc next to them """
+    try:
+        with compression.open_input(filename, 'rb') as f:
+            pcapio.capture_format(f)
+    except (OSError, EOFError, pcapio.CaptureFormatError):
+        return False
+    return True
+
+def expand_capture_set(spec):
+    """ The capture files of a --capture-file argument: the file itself if it
+    exists, else the captures matching it as a glob, or starting with it.
+    Sorted by name, see capture_set for the time order. """
+
+    if os.path.isfile(spec):
+        return [spec]
+
+    pattern = spec if is_pattern(spec) else glob.escape(spec) + '*'
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f) and _is_capture(f))
+
+def _scan(filename):
+    """ (frames, first time, last time) of a capture read in full, for the
+    files that have no frame index (compressed ones) """
+    frames, first, last = 0, None, None
+    with compression.open_input(filename, 'rb') as f:
+        for r in pcapio.iter_records(f):
+            if not r.is_packet:
+                continue
+            frames = r.number
+            if r.time is not None:
+                first = r.time if first is None else min(first, r.time)
+                last  = r.time if last is None else max(last, r.time)
+    return frames, first, last
+
+def capture_set(filenames, verbose=False):
+    """ CaptureFiles of a set, in time order, with their frame offsets """
+
+    # Imported here, it pulls in pyshark
+    from dsd.frameindex import load_frame_index
+
+    files = []
+    for f in filenames:
+        index = load_frame_index(f, verbose=verbose)
+        if index is not None:
+            files.append(CaptureFile(f, index.frames, index.first_time, index.last_time))
+            continue
+        try:
+            files.append(CaptureFile(f, *_scan(f)))
+        except pcapio.CaptureFormatError:
+            files.append(CaptureFile(f, None, None, None))
+
+    # Files with no packets (e.g. the one dumpcap has just opened) go last
+    files.sort(key=lambda c: (c.first_time is None, c.first_time or 0, c.filename))
+
+    offset = 0
+    for c in files:
+        c.frame_offset = offset
+        offset += c.frames or 0
+    return files
+
+def select_files(files, from_frame=None, to_frame=None, from_time=None, to_time=None):
+    """ The files of a capture set (see capture_set) that may hold packets
+    within the frame range and between the times (datetimes).  Files whose
+    span is unknown are always kept. """
+
+    from_ts = from_time.timestamp() if isinstance(from_time, datetime.datetime) else None
+    to_ts   = to_time.timestamp() if isinstance(to_time, datetime.datetime) else None
+
+    if (from_frame or to_frame) and any(c.frames is None for c in files):
+        raise ValueError('Frame ranges over a capture set need pcap or pcapng files')
+
+    selected = []
+    for c in files:
+        if c.frames is not None:
+            if from_frame and c.frame_offset + c.frames < from_frame:
+                continue
+            if to_frame and c.frame_offset >= to_frame:
+                continue
+            if not c.frames:
+                continue
+        if c.first_time is not None:
+            if from_ts is not None and c.last_time < from_ts:
+                continue
+            if to_ts is not None and c.first_time > to_ts:
+                continue
+        selected.append(c)
+    return selected
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+""" Single 'dsd' entry point dispatching to the individual commands.  The
+command modules are only imported once the subcommand is known, so e.g.
+'dsd generate' never loads the capture backends. """
+
+from __future__ import print_function
+
+import sys
+import importlib
+
+""" Subcommand -> (module, description).  The original script names are
+accepted as aliases. """
+COMMANDS = {
+    'generate': ('dsd.generateSequenceDiag',           'Generate an SVG from a CSV of events'),
+    'query':    ('dsd.queryLogs',                      'Query events out of capture files, and optionally generate an SVG'),
+    'filters':  ('dsd.generateWireSharkDisplayFilters', 'Print the Wireshark display filter for some hosts'),
+    'shard':    ('dsd.shardCapture',                   'Split a capture by host pair for faster queries'),
+    'diff':     ('dsd.diffCaptures',                   'Compare the events of a before and an after capture'),
+}
+
+ALIASES = {
+    'generateSequenceDiag':            'generate',
+    'queryCaptureLogs':                'query',
+    'generateWireSharkDisplayFilters': 'filters',
+    'shardCapture':                    'shard',
+    'diffCaptures':                    'diff',
+}
+
+def usage(file=sys.stdout):
+    print('usage: dsd COMMAND [options]\n\nCommands:', file=file)
+    for name, (_, description) in COMMANDS.items():
+        print('  %-10s %s'%(name, description), file=file)
+    print('\nRun "dsd COMMAND --help" for the options of a command.', file=file)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        usage()
+        return
+
+    name = ALIASES.get(sys.argv[1], sys.argv[1])
+    if name not in COMMANDS:
+        print('Unknown command %s\n'%sys.argv[1], file=sys.stderr)
+        usage(file=sys.stderr)
+        sys.exit(2)
+
+    module = importlib.import_module(COMMANDS[name][0])
+
+    # Let the command's own parser see its options, and name itself properly
+    sys.argv = ['dsd %s'%name] + sys.argv[2:]
+    module.main()
+
+if __name__ == "__main__":
+    main()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
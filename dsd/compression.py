@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+""" Transparent compression of the files we read and write.
+
+Inputs (captures, event CSVs) compressed with gzip or zstd are recognised by
+their magic number and decompressed as they are read, so they never have to
+be unpacked to disk first.  Outputs are compressed according to their name:
+.gz and .svgz with gzip, .zst with zstd.
+
+gzip support comes with Python, zstd needs the optional zstandard module
+(pip install zstandard, or the package's zstd extra). """
+
+from __future__ import print_function
+
+import io
+import os
+import gzip
+import threading
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+_MAGIC = [
+    (b'\x1f\x8b',         GZIP),
+    (b'\x28\xb5\x2f\xfd', ZSTD),
+]
+
+_SUFFIXES = {
+    '.gz':   GZIP,
+    '.svgz': GZIP,
+    '.zst':  ZSTD,
+}
+
+""" gzip level of the outputs: 9 (gzip's default) is several times slower
+than 6, for files barely smaller """
+GZIP_LEVEL = 6
+
+""" zstd level of the outputs """
+ZSTD_LEVEL = 3
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compressed files need the zstandard module (pip install zstandard)')
+    return zstandard
+
+def input_compression(filename):
+    """ GZIP, ZSTD or None, from the first bytes of the file """
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    for m, kind in _MAGIC:
+        if magic.startswith(m):
+            return kind
+    return None
+
+def output_compression(filename):
+    """ GZIP, ZSTD or None, from the file name """
+    return _SUFFIXES.get(os.path.splitext(filename)[1].lower())
+
+def is_compressed(filename):
+    return input_compression(filename) is not None
+
+def strip_suffix(filename):
+    """ The name without its compression suffix, e.g. events.csv for
+    events.csv.gz, to tell what kind of file it holds.  .svgz stays as is. """
+    root, ext = os.path.splitext(filename)
+    if ext.lower() in ('.gz', '.zst'):
+        return root
+    return filename
+
+def open_input(filename, mode='r', encoding=None):
+    """ Open a file for reading ('r' or 'rb'), decompressing it on the fly if
+    it is compressed.  Text is decoded like open() would. """
+
+    kind = input_compression(filename)
+    if kind is None:
+        return open(filename, mode, encoding=encoding)
+
+    if kind == GZIP:
+        f = gzip.open(filename, 'rb')
+    else:
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+        f = io.BufferedReader(reader)
+
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding)
+
+def open_output(filename, mode='w', encoding=None, newline=None):
+    """ Open a file for writing ('w' or 'wb'), compressed according to its
+    name (see output_compression) """
+
+    kind = output_compression(filename)
+    if kind is None:
+        return open(filename, mode, encoding=encoding, newline=newline)
+
+    if kind == GZIP:
+        f = gzip.open(filename, 'wb', compresslevel=GZIP_LEVEL)
+    else:
+        writer = _zstandard().ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(filename, 'wb'), closefd=True)
+        f = io.BufferedWriter(writer)
+
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, newline=newline)
+
+class DecompressWriter(threading.Thread):
+    """ Decompress a file into a pipe, e.g. tshark's stdin """
+
+    def __init__(self, filename, fd, chunk_size=1<<20):
+        super(DecompressWriter, self).__init__(daemon=True)
+        self.filename    = filename
+        self.fd          = fd
+        self.chunk_size  = chunk_size
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            with open_input(self.filename, 'rb') as f:
+                while not self._stop_event.is_set():
+                    data = f.read(self.chunk_size)
+                    if not data:
+                        break
+                    view = memoryview(data)
+                    while len(view):
+                        view = view[os.write(self.fd, view):]
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(self.fd)
+
+    def stop(self):
+        self._stop_event.set()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
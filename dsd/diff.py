@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+""" Align the events of two captures of the same scenario ("before" and
+"after" a change), and render the differences side by side.
+
+Events are aligned on (source, destination, event type) with Myers' O(ND)
+diff, so the cost grows with the number of differences rather than with the
+product of the lengths: two runs of 10^5 events that mostly agree align in
+well under a second. """
+
+from __future__ import print_function
+
+import datetime
+from aenum import Enum
+
+import dsd.svgobjs as svg
+import dsd.solaobjs as so
+
+class DiffStatus(Enum):
+    """ ENUM of how a row of the alignment differs between the captures """
+
+    EQUAL     = 1
+    MISSING   = 2
+    INSERTED  = 3
+    REGRESSED = 4
+
+class DiffRow(object):
+    """ One row of the alignment: an event of the before capture, of the
+    after capture, or one of each that were matched together """
+
+    __slots__ = ('before', 'after', 'status')
+
+    def __init__(self, before, after, status):
+        self.before = before
+        self.after  = after
+        self.status = status
+
+def event_key(e):
+    """ What two events have to share to be aligned """
+    return (e.src.id, e.dst.id, e.event_type.name)
+
+def myers_diff(a, b):
+    """ Shortest edit script between two sequences of hashable items, as a
+    list of (i, j) pairs: (i, j) for a[i] == b[j], (i, None) for an item only
+    in a and (None, j) for one only in b.
+
+    The common prefix and suffix are stripped first.  The greedy search then
+    takes O((N+M)D) time and keeps O(D^2) of history to trace the path back,
+    D being the number of differences. """
+
+    n, m = len(a), len(b)
+
+    # Compare small ints rather than tuples in the inner loop
+    ids = {}
+    a = [ids.setdefault(x, len(ids)) for x in a]
+    b = [ids.setdefault(x, len(ids)) for x in b]
+
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and a[n-1-suffix] == b[m-1-suffix]:
+        suffix += 1
+
+    head = [(i, i) for i in range(prefix)]
+    tail = [(n-suffix+i, m-suffix+i) for i in range(suffix)]
+
+    a = a[prefix:n-suffix]
+    b = b[prefix:m-suffix]
+    middle = [(i + prefix if i is not None else None, j + prefix if j is not None else None) for i, j in _myers(a, b)]
+
+    return head + middle + tail
+
+def _myers(a, b):
+    n, m = len(a), len(b)
+    if not n or not m:
+        return [(i, None) for i in range(n)] + [(None, j) for j in range(m)]
+
+    max_d = n + m
+    offset = max_d + 1
+
+    """ v[offset+k] is the furthest x reached on diagonal k (x - y = k) """
+    v = [0]*(2*max_d + 3)
+
+    """ Copy of the diagonals -d..d of v before each round d """
+    trace = []
+
+    for d in range(max_d + 1):
+        trace.append(v[offset-d:offset+d+1])
+        for k in range(-d, d+1, 2):
+            if k == -d or (k != d and v[offset+k-1] < v[offset+k+1]):
+                x = v[offset+k+1]
+            else:
+                x = v[offset+k-1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset+k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+
+def _backtrack(trace, n, m):
+    """ Walk the rounds of _myers back from (n, m) to (0, 0) """
+    outp = []
+    x, y = n, m
+    for d in range(len(trace)-1, 0, -1):
+        vd = trace[d]
+        k = x - y
+        if k == -d or (k != d and vd[k-1+d] < vd[k+1+d]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = vd[prev_k+d]
+        prev_y = prev_x - prev_k
+
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            outp.append((x, y))
+        if x == prev_x:
+            outp.append((None, prev_y))
+        else:
+            outp.append((prev_x, None))
+        x, y = prev_x, prev_y
+
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        outp.append((x, y))
+
+    outp.reverse()
+    return outp
+
+def diff_events(before, after, regression=0.005):
+    """ Align two time ordered lists of events, returns a list of DiffRows.
+
+    Matched events are REGRESSED when the ACK of the after event is more
+    than 'regression' seconds slower, or when only the before event was ACKed. """
+
+    rows = []
+    for i, j in myers_diff([event_key(e) for e in before], [event_key(e) for e in after]):
+        if j is None:
+            rows.append(DiffRow(before[i], None, DiffStatus.MISSING))
+        elif i is None:
+            rows.append(DiffRow(None, after[j], DiffStatus.INSERTED))
+        else:
+            b, a = before[i], after[j]
+            status = DiffStatus.EQUAL
+            if b.ack_time is not None:
+                if a.ack_time is None or a.ack_time - b.ack_time > regression:
+                    status = DiffStatus.REGRESSED
+            rows.append(DiffRow(b, a, status))
+    return rows
+
+def diff_summary(rows, before_name=None, after_name=None):
+    """ Machine readable summary of an alignment (a dict, ready for json) """
+
+    def describe(e):
+        if e is None:
+            return None
+        return {
+            'time':       e.time.isoformat(),
+            'src':        e.src.id,
+            'dst':        e.dst.id,
+            'eventType':  e.event_type.name,
+            'frameId':    e.frame_id,
+            'ackFrameId': e.ack_frame_id,
+            'ackTime':    e.ack_time,
+        }
+
+    counts = {s.name.lower(): 0 for s in DiffStatus}
+    changes = []
+    for r in rows:
+        counts[r.status.name.lower()] += 1
+        if r.status != DiffStatus.EQUAL:
+            changes.append({
+                'status': r.status.name.lower(),
+                'before': describe(r.before),
+                'after':  describe(r.after),
+            })
+
+    return {
+        'before':  {'source': before_name, 'events': sum(1 for r in rows if r.before is not None)},
+        'after':   {'source': after_name,  'events': sum(1 for r in rows if r.after is not None)},
+        'counts':  counts,
+        'changes': changes,
+    }
+
+class DiffDiagram(so.Diagram):
+    """ The before and after captures drawn side by side, one aligned row per
+    DiffRow, with the missing, inserted and regressed rows highlighted.
+
+    With context, runs of equal rows further than context rows from any
+    change are replaced with "events omitted" markers. """
+
+    def __init__(self, hosts, rows, settings, inkscape=False, context=None):
+        super(DiffDiagram, self).__init__(hosts=hosts, events=[], settings=settings, inkscape=inkscape)
+        self.rows    = rows
+        self.context = context
+
+    def display_rows(self):
+        """ The rows to draw: DiffRows, and lists of DiffRows to draw as one omitted marker """
+
+        if self.context is None:
+            return list(self.rows)
+
+        keep = [False]*len(self.rows)
+        for i, r in enumerate(self.rows):
+            if r.status != DiffStatus.EQUAL:
+                for j in range(max(0, i - self.context), min(len(self.rows), i + self.context + 1)):
+                    keep[j] = True
+
+        outp = []
+        omitted = []
+        for r, k in zip(self.rows, keep):
+            if k:
+                if omitted:
+                    outp.append(omitted)
+                    omitted = []
+                outp.append(r)
+            else:
+                omitted.append(r)
+        if omitted:
+            outp.append(omitted)
+        return outp
+
+    def status_color(self, status):
+        if DiffStatus.MISSING == status:
+            return self.settings.diff_missing_color
+        elif DiffStatus.INSERTED == status:
+            return self.settings.diff_inserted_color
+        elif DiffStatus.REGRESSED == status:
+            return self.settings.diff_regressed_color
+        return None
+
+    def side_events(self, display_rows, side):
+        """ The events (and omitted markers) of one side, spaced one row apart """
+
+        step = datetime.timedelta(seconds=self.settings.diff_row_height/float(self.settings.time_spacing))
+        events = []
+        for i, r in enumerate(display_rows):
+            if isinstance(r, list):
+                omitted = [getattr(x, side) for x in r]
+                e = so.OmittedEvents(events=omitted, settings=self.settings)
+            else:
+                e = getattr(r, side)
+                if e is None:
+                    continue
+            # Always label the times, neighbouring rows may be far apart in time
+            e.prev = None
+            e.dt = step*i
+            events.append(e)
+        return events
+
+    def document(self):
+        """ Lay out both sides, returns the svg.Document """
+
+        display_rows = self.display_rows()
+        side_width = len(self.hosts)*self.settings.host_spacing + self.settings.time_margin_left
+        row_h = self.settings.diff_row_height
+        time_top = self.hosts[0].display_options.height + 10
+
+        svg_hosts = []
+        svg_events = []
+        for s, side in enumerate(('before', 'after')):
+            offset = s*side_width
+            events = self.side_events(display_rows, side)
+
+            for i, h in enumerate(self.hosts):
+                h.display_options.x = self.settings.host_spacing*i + self.settings.time_margin_left + offset
+                h.display_options.y = 0
+                h.last_event = next((e for e in reversed(events) if e.src==h or e.dst==h), None)
+                h.compile(settings=self.settings)
+            svg_hosts.append(svg.G(attrs={'id': 'diff-%s-hosts'%side}, children=[h.to_element() for h in self.hosts]))
+
+            group = svg.G(attrs={'id': 'diff-%s-events'%side})
+            for i, r in enumerate(display_rows):
+                color = None if isinstance(r, list) else self.status_color(r.status)
+                if color is None or (r.status == DiffStatus.MISSING) != (side == 'before'):
+                    continue
+                group.append(svg.Rect(
+                    attrs={'x': offset, 'y': i*row_h - row_h/2.0, 'width': side_width, 'height': row_h},
+                    style='fill:%s;fill-opacity:0.25;stroke:none'%color,
+                ))
+
+            for e in events:
+                self.layout_event(e)
+                e.display_options.x += offset
+                group.append(e.to_element())
+            svg_events.append(group)
+
+        page_width = 2*side_width + self.hosts[-1].display_options.width
+        page_height = int(len(display_rows)*row_h) + time_top + 40
+
+        return svg.build_document(
+            page_width=page_width,
+            page_height=page_height,
+            hosts=svg_hosts,
+            events=svg_events,
+            time_left=0,
+            time_top=time_top,
+        )
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
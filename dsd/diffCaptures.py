@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import sys
+import json
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+from dsd.diff import diff_events, diff_summary, DiffDiagram
+from dsd.profiling import Profiler, stage
+from dsd import compression
+
+def is_csv(filename):
+    """ Whether a file is an events CSV (possibly compressed) rather than a capture """
+    return compression.strip_suffix(filename).lower().endswith('.csv')
+
+def load_events(filename, hosts, event_type_names, event_types, settings, verbose=False, profiler=None):
+    """ Events of a CSV (as written by queryCaptureLogs --write-events), or
+    queried out of a capture file """
+
+    if is_csv(filename):
+        return ld.read_events(filename, hosts=hosts, event_types=event_types, settings=settings, verbose=verbose, profiler=profiler)
+
+    events = ld.query_logs(
+        capture_filename=filename,
+        hosts=hosts,
+        event_type_names=event_type_names,
+        event_types=event_types,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+    )
+    so.Event.sort_and_process(events=events, settings=settings)
+    return events
+
+def main():
+    """ Compare the events of a before and an after capture of the same scenario """
+
+    parser = ld.get_arg_parse(description='Align the events of two captures (or event CSVs) and show what changed')
+    parser.add_argument('--before', metavar='FILE', dest='before', required=True, type=ld.argparse_file_exists, help='Capture file or events CSV of the reference run')
+    parser.add_argument('--after',  metavar='FILE', dest='after',  required=True, type=ld.argparse_file_exists, help='Capture file or events CSV to compare against it')
+    parser.add_argument('--hosts', metavar='HOSTS', dest='hosts', nargs='+', help='List of hosts to include (required to query captures)')
+    parser.add_argument('-e', '--events', metavar='EVENTS', dest='events', nargs='+', default=['StartCall', 'EndCall', 'endMedia', 'CDRType1'], help='List of events to query')
+    parser.add_argument('-o', '--output-svg', metavar='SVG_OUTFILE', dest='svg_outfile', help='If provided, draw the two runs side by side with the differences highlighted')
+    parser.add_argument('-s', '--summary', metavar='SUMMARY_OUTFILE', dest='summary_outfile', default='-', help='Where to write the JSON summary of the differences (default: stdout)')
+    parser.add_argument('--regression', metavar='SECONDS', dest='regression', type=float, default=0.005, help='How much slower (s) an ACK has to be to count as a regression')
+    parser.add_argument('--context', metavar='N', dest='context', type=int, default=None, help='Only draw the differences and N rows around them')
+
+    args = parser.parse_args()
+
+    profiler = Profiler.from_args(args)
+    try:
+        with stage(profiler, 'read_config'):
+            all_hosts, event_types, settings = ld.read_config(args.config)
+
+        hosts = all_hosts
+        if args.hosts:
+            hosts = ld.match_hosts(all_hosts, args.hosts)
+        elif not (is_csv(args.before) and is_csv(args.after)):
+            parser.error('--hosts is required to query capture files')
+
+        with stage(profiler, 'read_events'):
+            before = load_events(args.before, hosts, args.events, event_types, settings, verbose=args.verbose, profiler=profiler)
+            after  = load_events(args.after,  hosts, args.events, event_types, settings, verbose=args.verbose, profiler=profiler)
+
+        with stage(profiler, 'diff'):
+            rows = diff_events(before, after, regression=args.regression)
+        if profiler:
+            profiler.count('diff_rows', len(rows))
+
+        summary = diff_summary(rows, before_name=args.before, after_name=args.after)
+        if args.summary_outfile == '-':
+            json.dump(summary, sys.stdout, indent=4)
+            print()
+        else:
+            with open(args.summary_outfile, 'w') as f:
+                json.dump(summary, f, indent=4)
+
+        if args.svg_outfile:
+            hosts = list(hosts)
+            ld.filter_hosts(hosts=hosts, events=before + after)
+            if not hosts:
+                print('No events in either run', file=sys.stderr)
+                sys.exit(1)
+
+            with stage(profiler, 'generate'):
+                diag = DiffDiagram(hosts=hosts, rows=rows, settings=settings, inkscape=args.inkscape, context=args.context)
+                contents = diag.generate()
+            with stage(profiler, 'write'):
+                ld.write_output(args.svg_outfile, contents, profiler=profiler)
+    finally:
+        if profiler:
+            profiler.report(filename=args.profile_outfile or None)
+
+if __name__ == "__main__":
+    main()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
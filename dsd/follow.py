@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import os
+import re
+import datetime
+import threading
+from pyshark.capture.pipe_capture import PipeCapture
+
+import dsd.svgobjs as svg
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+
+class FileTailer(threading.Thread):
+    """ Copy a (growing) file into a pipe, like tail -c +1 -f """
+
+    def __init__(self, filename, fd, poll_interval=0.5, chunk_size=1<<20):
+        super(FileTailer, self).__init__(daemon=True)
+        self.filename      = filename
+        self.fd            = fd
+        self.poll_interval = poll_interval
+        self.chunk_size    = chunk_size
+        self._stop_event   = threading.Event()
+
+    def run(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                while not self._stop_event.is_set():
+                    data = f.read(self.chunk_size)
+                    if not data:
+                        self._stop_event.wait(self.poll_interval)
+                        continue
+                    view = memoryview(data)
+                    while len(view):
+                        view = view[os.write(self.fd, view):]
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(self.fd)
+
+    def stop(self):
+        self._stop_event.set()
+
+class FollowDiagram(so.Diagram):
+    """ Diagram written to disk once and then extended in place as events
+    arrive.
+
+    The header (hosts and page size) is written with fixed width, zero padded
+    numbers for the lifeline lengths and the page height, so they can be
+    patched in place.  New event fragments are written over the closing tags,
+    which are then written again after them.  The cost of an update therefore
+    only depends on the number of new events. """
+
+    """ Width of the numbers that get patched in place """
+    FIELD_WIDTH = 10
+
+    EVENTS_MARK = '<!-- events -->'
+
+    def __init__(self, filename, hosts, settings, inkscape=False):
+        super(FollowDiagram, self).__init__(hosts=hosts, events=[], settings=settings, inkscape=inkscape)
+        self.filename = filename
+
+        """ First and latest events added, used to compute dt incrementally """
+        self.first_event = None
+        self.last_event  = None
+
+        """ Latest event rendered """
+        self.last_rendered = None
+
+        self._f           = None
+        self._tail        = b''
+        self._tail_offset = 0
+
+        """ Dict of field index -> [byte offsets], and of field index -> current value """
+        self._field_offsets = {}
+        self._field_values  = {}
+
+    def _token(self, i):
+        return 'FIELD%0*d'%(self.FIELD_WIDTH-5, i)
+
+    def _format_field(self, value):
+        return ('%0*d'%(self.FIELD_WIDTH, value)).encode('ascii')
+
+    def start(self):
+        """ Write the header (hosts with empty lifelines) and closing tags """
+
+        self.layout_hosts()
+        svg_hosts = []
+        for i, h in enumerate(self.hosts):
+            h.display_options.lifeline_length = self._token(i)
+            svg_hosts.append(h.to_element())
+
+        # The document is split where the events go
+        doc = svg.build_document(
+            page_width=self.page_width(),
+            page_height=self._token(len(self.hosts)),
+            hosts=svg_hosts,
+            events=[svg.Raw(self.EVENTS_MARK)],
+            time_left=0,
+            time_top=self.hosts[0].display_options.height + 10,
+        )
+        head, tail = doc.to_svg(self.svg_type).split(self.EVENTS_MARK)
+
+        data = head.encode('utf-8')
+        self._tail = tail.encode('utf-8')
+
+        for i in range(len(self.hosts)+1):
+            token = self._token(i).encode('ascii')
+            initial = 40 if i == len(self.hosts) else 0
+            self._field_offsets[i] = [m.start() for m in re.finditer(re.escape(token), data)]
+            self._field_values[i]  = initial
+            data = data.replace(token, self._format_field(initial))
+
+        self._f = open(self.filename, 'w+b')
+        self._f.write(data)
+        self._tail_offset = len(data)
+        self._f.write(self._tail)
+        self._f.flush()
+
+    def add(self, e):
+        """ Link a new event to the previous one and compute its dt, as
+        Event.sort_and_process would.  Events must be added in time order. """
+
+        e.settings = self.settings
+        if self.first_event is None:
+            self.first_event = e
+            e.dt = datetime.timedelta(seconds=0)
+        else:
+            e.prev = self.last_event
+            self.last_event.next = e
+
+            gap = e.time - self.last_event.time
+            if gap < datetime.timedelta(0):
+                gap = datetime.timedelta(0)
+            if float(self.settings.max_time_gap) > 0:
+                gap = min(gap, datetime.timedelta(seconds=self.settings.max_time_gap))
+            e.dt = self.last_event.dt + gap
+
+        if self.settings.time_unit == 'secondsSinceStart':
+            e.time_label = '%4.3f'%(e.time - self.first_event.time).total_seconds()
+
+        self.last_event = e
+
+    def _set_field(self, i, value):
+        if self._field_values[i] == value:
+            return
+        self._field_values[i] = value
+        data = self._format_field(value)
+        for offset in self._field_offsets[i]:
+            self._f.seek(offset)
+            self._f.write(data)
+
+    def append(self, events):
+        """ Render events (already passed to add()) at the end of the file, and
+        extend the lifelines and page to fit them """
+
+        if not events:
+            return
+
+        fragments = ''
+        for e in events:
+            self.layout_event(e)
+            fragments += e.to_svg(self.svg_type)
+            self.events.append(e)
+            if self.last_rendered is None or e.dt > self.last_rendered.dt:
+                self.last_rendered = e
+
+        data = fragments.encode('utf-8')
+        self._f.seek(self._tail_offset)
+        self._f.write(data)
+        self._tail_offset += len(data)
+        self._f.write(self._tail)
+        self._f.truncate()
+
+        for i, h in enumerate(self.hosts):
+            for e in events:
+                if e.src == h or e.dst == h:
+                    length = int(e.dt.total_seconds() * self.settings.time_spacing) + h.display_options.height
+                    self._set_field(i, max(self._field_values[i], length))
+        self._set_field(len(self.hosts), self.page_height(self.last_rendered))
+
+        self._f.flush()
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+def follow_logs(capture_filename, hosts, event_type_names, event_types, svg_filename, settings, inkscape=False, poll_interval=0.5, verbose=False, profiler=None, all_hosts=None):
+    """ Follow a capture file that is still being written (e.g. by dumpcap),
+    matching ACKs and extending svg_filename as packets arrive.
+
+    Events are drawn in capture order as ld.EventStreamer hands them over,
+    i.e. once they are ACKed or have waited longer than the ackTimeout
+    setting (measured in capture time).  Runs until interrupted (Ctrl-C),
+    then draws whatever is left and returns all the events found. """
+
+    msgs_df = ld.generate_display_filter(
+        hosts=hosts,
+        event_type_names=event_type_names,
+        line_breaks=False
+    )
+
+    if verbose:
+        print('Display Filter:\n%s'%msgs_df)
+        print('Following', capture_filename)
+
+    r, w = os.pipe()
+    tailer = FileTailer(capture_filename, w, poll_interval=poll_interval)
+    tailer.start()
+
+    # -l so tshark hands over every packet as soon as it is dissected
+    cap = PipeCapture(pipe=r, display_filter=msgs_df, custom_parameters=['-l'])
+
+    streamer = ld.EventStreamer(hosts=hosts, event_types=event_types, settings=settings, verbose=verbose, profiler=profiler, all_hosts=all_hosts)
+    diag = FollowDiagram(svg_filename, hosts=hosts, settings=settings, inkscape=inkscape)
+    diag.start()
+
+    def draw(events):
+        for e in events:
+            diag.add(e)
+        diag.append(events)
+
+    try:
+        for p in cap:
+            draw(streamer.feed(p))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        tailer.stop()
+        draw(streamer.finish())
+        diag.close()
+        cap.close()
+
+    if profiler:
+        streamer.matcher.report(profiler)
+
+    return diag.events
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
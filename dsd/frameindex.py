@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+""" Sidecar index of a capture file mapping frame numbers and timestamps to
+byte offsets, so a range of frames can be read without going through
+everything before it.
+
+The index (<capture>.frames.json) is built on first use with a single pass
+over the framing of the capture (no dissection), and rebuilt whenever the
+size or modification time of the capture changes.  It holds a checkpoint
+every 'stride' frames, plus the offsets of the header records needed to make
+a valid capture out of the frames following any checkpoint, and the times of
+the earliest and latest packets (to skip whole files of a capture set, see
+dsd.captureset). """
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import bisect
+import threading
+from pyshark.capture.pipe_capture import PipeCapture
+
+from dsd import pcapio
+from dsd import compression
+
+INDEX_VERSION = 2
+
+""" Default number of frames between checkpoints """
+DEFAULT_STRIDE = 1000
+
+def index_filename(capture_filename):
+    return capture_filename + '.frames.json'
+
+class FrameIndex(object):
+    """ Checkpoints of a capture file, see the module docstring """
+
+    def __init__(self, capture_filename, data):
+        self.capture_filename = capture_filename
+        self.data = data
+
+        """ [offset, length] of every header record of the capture """
+        self.headers = data['headers']
+
+        """ Columns of the checkpoints, sorted by frame number """
+        self.numbers = [c[0] for c in data['checkpoints']]
+        self.times   = [c[1] for c in data['checkpoints']]
+        self.offsets = [c[2] for c in data['checkpoints']]
+        self.header_ranges = [(c[3], c[4]) for c in data['checkpoints']]
+
+        # Captures aren't always strictly in time order, search on the
+        # running maximum so a checkpoint is never after the requested time
+        self.max_times = []
+        m = None
+        for t in self.times:
+            m = t if m is None or (t is not None and t > m) else m
+            self.max_times.append(m if m is not None else float('-inf'))
+
+    @property
+    def frames(self):
+        """ Number of frames in the capture """
+        return self.data['frames']
+
+    @property
+    def first_time(self):
+        """ Time (epoch seconds) of the earliest packet, or None if there are none """
+        return self.data['firstTime']
+
+    @property
+    def last_time(self):
+        """ Time (epoch seconds) of the latest packet, or None if there are none """
+        return self.data['lastTime']
+
+    def checkpoint_for_frame(self, number):
+        """ Index of the last checkpoint at or before frame 'number' """
+        return max(bisect.bisect_right(self.numbers, number) - 1, 0)
+
+    def checkpoint_for_time(self, t):
+        """ Index of a checkpoint before any frame at or after time t (epoch seconds) """
+        return max(bisect.bisect_left(self.max_times, t) - 1, 0)
+
+    def frame_after_time(self, t):
+        """ Number of a checkpoint frame after time t (epoch seconds), such
+        that the frames after it are past t too, or None if there's none """
+        i = bisect.bisect_right(self.max_times, t)
+        return self.numbers[i] if i < len(self.numbers) else None
+
+    def header_bytes(self, checkpoint, f):
+        """ Raw header records in effect at a checkpoint, read from the open capture f """
+        start, end = self.header_ranges[checkpoint]
+        data = b''
+        for offset, length in self.headers[start:end]:
+            f.seek(offset)
+            data += f.read(length)
+        return data
+
+    def iter_records(self, f, checkpoint):
+        """ Records of the open capture f from a checkpoint on, with the right
+        frame numbers.  The header records in effect are yielded first. """
+        header = self.header_bytes(checkpoint, f)
+        return pcapio.iter_records(
+            _ResumedFile(header, f, self.offsets[checkpoint]),
+            first_number=self.numbers[checkpoint]
+        )
+
+class _ResumedFile(object):
+    """ File-like object reading 'header' and then f from 'offset' on, as if
+    they were one file.  Only what pcapio needs is implemented. """
+
+    def __init__(self, header, f, offset):
+        self.header = io.BytesIO(header)
+        self.f = f
+        self.base = offset - len(header)
+        self.f.seek(offset)
+
+    def read(self, n):
+        data = self.header.read(n)
+        if len(data) < n:
+            data += self.f.read(n - len(data))
+        return data
+
+    def tell(self):
+        if self.header.tell() < len(self.header.getbuffer()):
+            return self.base + self.header.tell()
+        return self.f.tell()
+
+    def seek(self, pos):
+        if pos < self.base + len(self.header.getbuffer()):
+            self.header.seek(pos - self.base)
+            self.f.seek(self.base + len(self.header.getbuffer()))
+        else:
+            self.header.seek(0, io.SEEK_END)
+            self.f.seek(pos)
+
+def build_frame_index(capture_filename, stride=DEFAULT_STRIDE, verbose=False):
+    """ Scan a capture and write its index, returns the FrameIndex """
+
+    st = os.stat(capture_filename)
+    headers = []
+    checkpoints = []
+
+    # Header records in effect: those since the last section header
+    section_start = 0
+    frames = 0
+    first_time = last_time = None
+
+    with open(capture_filename, 'rb') as f:
+        for r in pcapio.iter_records(f):
+            if not r.is_packet:
+                if r.block_type == pcapio.PCAPNG_SHB:
+                    section_start = len(headers)
+                if r.block_type in (None, pcapio.PCAPNG_SHB, pcapio.PCAPNG_IDB):
+                    headers.append([r.offset, len(r.raw)])
+                continue
+
+            if (r.number - 1) % stride == 0:
+                checkpoints.append([r.number, r.time, r.offset, section_start, len(headers)])
+            frames = r.number
+            if r.time is not None:
+                first_time = r.time if first_time is None else min(first_time, r.time)
+                last_time  = r.time if last_time is None else max(last_time, r.time)
+
+    data = {
+        'version':     INDEX_VERSION,
+        'sourceSize':  st.st_size,
+        'sourceMtime': st.st_mtime,
+        'stride':      stride,
+        'frames':      frames,
+        'firstTime':   first_time,
+        'lastTime':    last_time,
+        'headers':     headers,
+        'checkpoints': checkpoints,
+    }
+
+    try:
+        with open(index_filename(capture_filename), 'w') as f:
+            json.dump(data, f)
+    except OSError as e:
+        # e.g. a read-only capture directory, the index is only an optimisation
+        print('Could not write the frame index: %s'%e, file=sys.stderr)
+
+    if verbose:
+        print('Indexed %d frames of %s'%(frames, capture_filename))
+
+    return FrameIndex(capture_filename, data)
+
+def load_frame_index(capture_filename, build=True, stride=DEFAULT_STRIDE, verbose=False):
+    """ The index of a capture, (re)building it if it is missing or stale and
+    build is set.  Returns None if there's no usable index, e.g. for
+    compressed captures, which can't be read from an offset. """
+
+    if compression.is_compressed(capture_filename):
+        return None
+
+    try:
+        with open(index_filename(capture_filename)) as f:
+            data = json.load(f)
+        st = os.stat(capture_filename)
+        if data.get('version') == INDEX_VERSION and data.get('sourceSize') == st.st_size and data.get('sourceMtime') == st.st_mtime:
+            return FrameIndex(capture_filename, data)
+    except (OSError, ValueError):
+        pass
+
+    if not build:
+        return None
+    try:
+        return build_frame_index(capture_filename, stride=stride, verbose=verbose)
+    except pcapio.CaptureFormatError:
+        # Some other format tshark can read, just don't index it
+        return None
+
+class WindowWriter(threading.Thread):
+    """ Write the frames from_frame..to_frame (inclusive, either can be None)
+    of an indexed capture into a pipe, as a valid capture of the same format """
+
+    def __init__(self, index, fd, from_frame=None, to_frame=None):
+        super(WindowWriter, self).__init__(daemon=True)
+        self.index      = index
+        self.fd         = fd
+        self.from_frame = from_frame or 1
+        self.to_frame   = to_frame
+        self._stop_event = threading.Event()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while len(view):
+            view = view[os.write(self.fd, view):]
+
+    def run(self):
+        try:
+            with open(self.index.capture_filename, 'rb') as f:
+                checkpoint = self.index.checkpoint_for_frame(self.from_frame)
+                for r in self.index.iter_records(f, checkpoint):
+                    if self._stop_event.is_set():
+                        break
+                    if r.is_packet:
+                        if self.to_frame is not None and r.number > self.to_frame:
+                            break
+                        if r.number < self.from_frame:
+                            continue
+                    self._write(r.raw)
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(self.fd)
+
+    def stop(self):
+        self._stop_event.set()
+
+class _FedPipeCapture(PipeCapture):
+    """ pyshark capture reading a pipe fed by a writer thread (self.writer).
+
+    PipeCapture.close() closes the pipe and then runs close_async(), which
+    has to close it too when called on its own (e.g. by dsd.asyncquery), so
+    the pipe is only closed by close_async(): the fd may have been reused by
+    the time it would be closed a second time. """
+
+    def close(self):
+        # Not PipeCapture.close(), which closes the pipe itself
+        self.eventloop.run_until_complete(self.close_async())
+
+    async def close_async(self):
+        self.writer.stop()
+        await super(_FedPipeCapture, self).close_async()
+        if self._pipe is not None:
+            os.close(self._pipe)
+            self._pipe = None
+
+class WindowCapture(_FedPipeCapture):
+    """ pyshark capture of the frames from_frame..to_frame of an indexed
+    capture file.  tshark numbers the frames from 1, add frame_offset to get
+    the frame numbers of the full capture. """
+
+    def __init__(self, index, from_frame=None, to_frame=None, **kwargs):
+        r, w = os.pipe()
+        super(WindowCapture, self).__init__(pipe=r, **kwargs)
+        self.frame_offset = (from_frame or 1) - 1
+        self.writer = WindowWriter(index, w, from_frame=from_frame, to_frame=to_frame)
+        self.writer.start()
+
+class DecompressedCapture(_FedPipeCapture):
+    """ pyshark capture of a gzip or zstd compressed capture file, which is
+    decompressed into tshark's stdin as it reads it (see dsd.compression) """
+
+    frame_offset = 0
+
+    def __init__(self, capture_filename, **kwargs):
+        r, w = os.pipe()
+        super(DecompressedCapture, self).__init__(pipe=r, **kwargs)
+        self.writer = compression.DecompressWriter(capture_filename, w)
+        self.writer.start()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
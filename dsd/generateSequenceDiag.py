@@ -7,6 +7,11 @@ import sys
 
 import dsd.solaobjs as so
 import dsd.loaddata as ld
+from dsd.minimap import Minimap
+from dsd.ackstats import AckStats, write_ack_stats
+from dsd.propagation import join_hops, propagation_paths, PropagationStats, PropagationAnnotations, write_propagation_stats
+from dsd.profiling import Profiler, stage
+from dsd.watch import DiagramWatcher
 
 def main():
     """ Loads all the data and prepares the SVG """
@@ -14,38 +19,152 @@ def main():
     # Load CLI parameters
     parser = ld.get_arg_parse(description='Generate an SVG of a sequence diagram based on input data')
     parser.add_argument('-i', '--input',      dest='data',       action='store', required=ld.argparse_file_exists, type=str, help='CSV file listing the events')
-    parser.add_argument('-o', '--output',     dest='output',     action='store', required=True, type=str, help='Output SVG name')
+    parser.add_argument('-o', '--output',     dest='output',     action='store', default=None,  type=str, help='Output SVG name')
     parser.add_argument('-f', '--from-frame', dest='from_frame', action='store', default=None,  type=int, help='Start frame')
     parser.add_argument('-t', '--to-frame',   dest='to_frame',   action='store', default=None,  type=int, help='To frame')
+    parser.add_argument('-j', '--jobs', dest='jobs',       action='store', default=1,     type=int, metavar='N', help='Parse the CSV with N processes (0 for one per CPU), for very large files')
+    parser.add_argument('--watch',      dest='watch',      action='store_true', help='Keep running, and re-render the SVG whenever the config or the CSV changes.  Only the events affected by a change are serialized again')
+    parser.add_argument('--watch-poll', dest='watch_poll', action='store', default=0.5,   type=float, metavar='SECONDS', help='With --watch, how often to check the inputs for changes')
+    ld.add_time_window_args(parser)
+    ld.add_minimap_args(parser)
+    ld.add_anomaly_args(parser)
+    ld.add_burst_args(parser)
+    ld.add_ack_stats_args(parser)
+    ld.add_propagation_args(parser)
 
     args = parser.parse_args()
 
+    if not args.output and not args.minimap_outfile and not args.ack_stats_outfile and not args.propagation_outfile:
+        parser.error('At least one of --output, --minimap-svg, --ack-stats or --propagation is required')
+    if args.watch and not args.output:
+        parser.error('--watch requires --output')
+    if args.watch:
+        # The watcher only re-renders the diagram
+        unsupported = [
+            ('--minimap-svg',             args.minimap_outfile),
+            ('--ack-stats',               args.ack_stats_outfile),
+            ('--ack-stats-table',         args.ack_stats_table),
+            ('--propagation',             args.propagation_outfile),
+            ('--propagation-annotations', args.propagation_annotations),
+            ('--jobs',                    args.jobs != 1),
+            ('--profile',                 args.profile_outfile is not None),
+            ('--profile-dump',            args.profile_dump_dir),
+            ('--memory-report',           args.memory_report),
+            ('--memory-budget',           args.memory_budget is not None),
+        ]
+        given = [option for option, value in unsupported if value]
+        if given:
+            parser.error('--watch cannot be combined with %s'%', '.join(given))
+
     # /Load CLI parameters
 
-    hosts, event_types, settings = ld.read_config(args.config)
-    event_data = ld.read_events(
-        args.data,
-        hosts=hosts,
-        event_types=event_types,
-        from_frame=args.from_frame,
-        to_frame=args.to_frame,
-        settings=settings,
-        verbose=args.verbose
-    )
-    ld.filter_hosts(hosts=hosts, events=event_data)
-
-    if not hosts:
-        print('No hosts were involved in any of the events.  Aborting', file=sys.stderr)
-        sys.exit(1)
-
-    if not event_data:
-        print('No events were provided.  Aborting', file=sys.stderr)
-        sys.exit(1)
-
-    diag = so.Diagram(hosts=hosts, events=event_data, settings=settings, inkscape=args.inkscape)
-    contents = diag.generate()
-
-    with open(args.output, 'w') as f: f.write(contents)
+    if args.watch:
+        watcher = DiagramWatcher(
+            config_filename=args.config,
+            data_filename=args.data,
+            output=args.output,
+            from_frame=args.from_frame,
+            to_frame=args.to_frame,
+            from_time=args.from_time,
+            to_time=args.to_time,
+            anomalies_only=args.anomalies_only,
+            context_events=args.context_events,
+            context_time=args.context_time,
+            coalesce_bursts=args.coalesce_bursts,
+            burst_window=args.burst_window,
+            inkscape=args.inkscape,
+            verbose=args.verbose,
+        )
+        watcher.run(poll_interval=args.watch_poll)
+        return
+
+    profiler = Profiler.from_args(args)
+    try:
+        with stage(profiler, 'read_config'):
+            hosts, event_types, settings = ld.read_config(args.config)
+
+        with stage(profiler, 'read_events'):
+            event_data = ld.read_events(
+                args.data,
+                hosts=hosts,
+                event_types=event_types,
+                from_frame=args.from_frame,
+                to_frame=args.to_frame,
+                from_time=args.from_time,
+                to_time=args.to_time,
+                settings=settings,
+                verbose=args.verbose,
+                profiler=profiler,
+                jobs=args.jobs,
+            )
+        ld.filter_hosts(hosts=hosts, events=event_data)
+
+        if not hosts:
+            print('No hosts were involved in any of the events.  Aborting', file=sys.stderr)
+            sys.exit(1)
+
+        if not event_data:
+            print('No events were provided.  Aborting', file=sys.stderr)
+            sys.exit(1)
+
+        ack_stats = None
+        if args.ack_stats_outfile or args.ack_stats_table:
+            with stage(profiler, 'ack_stats'):
+                ack_stats = AckStats(window=args.ack_stats_window).add_events(event_data)
+            if args.ack_stats_outfile:
+                with stage(profiler, 'write_ack_stats'):
+                    write_ack_stats(args.ack_stats_outfile, ack_stats)
+
+        # Joined on all the events, before any are left out of the SVG
+        annotations = None
+        if args.propagation_outfile or (args.output and args.propagation_annotations):
+            window = args.propagation_window if args.propagation_window is not None else settings.propagation_window
+            with stage(profiler, 'propagation'):
+                hops = join_hops(event_data, window=window)
+                paths = propagation_paths(hops)
+            if profiler:
+                profiler.count('hops_joined', len(hops))
+            if args.propagation_outfile:
+                with stage(profiler, 'write_propagation'):
+                    write_propagation_stats(args.propagation_outfile, PropagationStats().add_hops(hops).add_paths(paths))
+            if args.propagation_annotations:
+                annotations = PropagationAnnotations(paths, settings)
+
+        if args.minimap_outfile:
+            with stage(profiler, 'minimap'):
+                minimap = Minimap(events=event_data, settings=settings, bins=args.minimap_bins)
+                contents = minimap.generate()
+            with stage(profiler, 'write'):
+                ld.write_output(args.minimap_outfile, contents, profiler=profiler)
+
+        if args.output and args.coalesce_bursts:
+            with stage(profiler, 'coalesce_bursts'):
+                event_data = ld.coalesce_bursts(events=event_data, settings=settings, window=args.burst_window)
+
+        if args.output and args.anomalies_only:
+            with stage(profiler, 'filter_anomalies'):
+                event_data = ld.filter_anomalies(
+                    events=event_data,
+                    settings=settings,
+                    context_events=args.context_events,
+                    context_time=args.context_time,
+                )
+            ld.filter_hosts(hosts=hosts, events=event_data)
+
+            if not event_data:
+                print('No slow events were found.  Aborting', file=sys.stderr)
+                sys.exit(1)
+
+        if args.output:
+            with stage(profiler, 'generate'):
+                diag = so.Diagram(hosts=hosts, events=event_data, settings=settings, inkscape=args.inkscape, summary=ack_stats if args.ack_stats_table else None, annotations=annotations)
+                # The events are rendered as they are written out
+                ld.write_diagram(args.output, diag, profiler=profiler)
+            if profiler:
+                profiler.count('events_rendered', len(event_data))
+    finally:
+        if profiler:
+            profiler.report(filename=args.profile_outfile or None)
 
 if __name__ == "__main__":
     main()
@@ -4,30 +4,46 @@ from __future__ import print_function
 
 import argparse
 import dsd.loaddata as ld
+import dsd.solaobjs as so
+from dsd.profiling import Profiler, stage
 
 def main():
-    """ Provided with host names, produce wireshark display filters """
+    """ Provided with host names, produce wireshark display filters (or a
+    capture filter with --capture-filter) """
 
     # Load CLI arguments
     parser = ld.get_arg_parse(description='Generate an SVG of a sequence diagram based on input data')
     parser.add_argument('--hosts', metavar='HOSTS', dest='hosts', nargs='+', help='List of hosts to include', default=[])
     parser.add_argument('--nice', action='store_true', dest='nice', help='Format nicely')
     parser.add_argument('-e', '--events', metavar='EVENTS', dest='events', help='List of events to query', default=['StartCall', 'EndCall', 'endMedia', 'CDRType1'])
+    parser.add_argument('--capture-filter', action='store_true', dest='capture_filter', help='Produce a BPF capture filter (for dumpcap/tcpdump) instead of a display filter, to only record the traffic of the hosts')
+    parser.add_argument('--ports', metavar='PORT', dest='ports', nargs='+', type=int, help='TCP ports the events are sent to, for --capture-filter (default: %(default)s)', default=ld.DEFAULT_HTTP_PORTS)
 
     args = parser.parse_args()
 
     # /Load CLI arguments
 
-    all_hosts, *ed = ld.read_config(args.config)
+    profiler = Profiler.from_args(args)
+
+    with stage(profiler, 'read_config'):
+        all_hosts, *ed = ld.read_config(args.config)
 
     hosts=[]
     for hname in args.hosts:
-        h = Host.match(hosts=all_hosts, name_or_ip=hname)
+        h = so.Host.match(hosts=all_hosts, name_or_ip=hname)
         if h is not None:
             hosts.append(h)
 
-    outp = ld.generate_display_filter(hosts=hosts, event_type_names=args.events, line_breaks=args.nice)
+    if args.capture_filter:
+        with stage(profiler, 'generate_capture_filter'):
+            outp = ld.generate_capture_filter(hosts=hosts, ports=args.ports)
+    else:
+        with stage(profiler, 'generate_display_filter'):
+            outp = ld.generate_display_filter(hosts=hosts, event_type_names=args.events, line_breaks=args.nice)
     print(outp)
 
+    if profiler:
+        profiler.report(filename=args.profile_outfile or None)
+
 if __name__ == "__main__":
     main()
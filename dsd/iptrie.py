@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+""" Longest prefix match of IP addresses against the addresses and subnets
+of the configured hosts. """
+
+from __future__ import print_function
+
+import ipaddress
+
+class IpTrie(object):
+    """ Binary radix trie of IP networks (one per address family).  A lookup
+    walks at most one node per bit of the longest prefix configured, however
+    many networks there are. """
+
+    def __init__(self):
+        """ Root node per IP version.  A node is [child 0, child 1, value] """
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+
+    def insert(self, network, value):
+        """ Map an ipaddress network to value.  An existing value for the same network is replaced. """
+        node = self.roots[network.version]
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            b = (bits >> (width - 1 - i)) & 1
+            if node[b] is None:
+                node[b] = [None, None, None]
+            node = node[b]
+        node[2] = value
+
+    def lookup(self, address):
+        """ Value of the most specific network containing address (an
+        ipaddress address), or None """
+        node = self.roots[address.version]
+        bits = int(address)
+        width = address.max_prefixlen
+        found = node[2]
+        for i in range(width):
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+class HostIndex(object):
+    """ Resolves packet IPs (strings) to the configured hosts.  Results are
+    memoized, as captures see the same few addresses over and over.
+
+    hosts should be every configured host, with selected the ones wanted (all
+    of them by default): an address whose most specific match isn't selected
+    resolves to None, rather than to a selected host with a wider subnet. """
+
+    def __init__(self, hosts, selected=None):
+        self.trie = IpTrie()
+        # Insert in reverse, so when two hosts list the same network the
+        # first one wins
+        for h in reversed(hosts):
+            for n in h.networks:
+                self.trie.insert(n, h)
+        self.selected = None if selected is None else set(id(h) for h in selected)
+        self._cache = {}
+
+    def lookup(self, ip):
+        """ The host whose address or subnet most specifically contains ip,
+        or None if there's none or it isn't selected """
+        try:
+            return self._cache[ip]
+        except KeyError:
+            pass
+
+        try:
+            h = self.trie.lookup(ipaddress.ip_address(ip))
+        except ValueError:
+            h = None
+        if h is not None and self.selected is not None and id(h) not in self.selected:
+            h = None
+        self._cache[ip] = h
+        return h
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
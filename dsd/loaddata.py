@@ -7,12 +7,22 @@ import os
 import re
 import csv
 import json
+import heapq
+import bisect
+import itertools
+import collections
 import argparse
 import datetime
-import pyshark
+import time
 
 import dsd.solaobjs as so
 import dsd.svgobjs as svg
+from dsd.profiling import stage, parse_size
+from dsd.pcapio import first_packet_time
+from dsd.iptrie import HostIndex
+from dsd import csvchunks
+from dsd import compression
+from dsd import captureset
 
 class Settings(object):
     """ Config object to hold various settings """
@@ -36,6 +46,41 @@ class Settings(object):
             'ackThresholdFast':     0.001, # s
             'ackThresholdSlow':     0.001, # s
             'ackThresholdVerySlow': 0.010, # s
+            'ackThresholdSlowColor':     '#c87137',
+            'ackThresholdVerySlowColor': '#ff0000',
+
+            # Overview (minimap) rendering
+            'minimapBins':         200,
+            'minimapCellWidth':    1.5, # mm
+            'minimapCellHeight':   6,   # mm
+            'minimapLabelWidth':   40,  # mm
+            'minimapFastColor':    '#9ccc65',
+            'minimapNormalColor':  '#506b83',
+
+            # Anomaly-only rendering
+            'omittedColor':        '#999999',
+            'omittedMarkerHeight': 8,   # mm
+
+            # Coalescing bursts of the same event (--coalesce-bursts)
+            'burstWindow':         0.1, # s
+
+            # Propagation latency across hosts (--propagation)
+            'propagationWindow':   1.0, # s
+            'propagationColor':    '#6a1b9a',
+
+            # Side by side diffs (diffCaptures)
+            'diffRowHeight':       6,   # mm
+            'diffMissingColor':    '#ff0000',
+            'diffInsertedColor':   '#2e7d32',
+            'diffRegressedColor':  '#c87137',
+
+            # How long (s, capture time) to wait for an ACK before giving up on it
+            'ackTimeout':          5,
+
+            # Merging captures from several taps
+            'mergeDedupWindow':    0.005, # s
+            'clockOffsetSamples':  500,
+            'clockOffsetMaxSkew':  2,     # s
 
             # SVG output type
             'svg_type':         svg.SvgType.PLAIN
@@ -67,75 +112,187 @@ def read_config(filename):
 
     return hosts, event_types, settings
 
-def read_events(filename, hosts, event_types, settings, from_frame=None, to_frame=None, verbose=False):
-    csv.register_dialect('EventType', delimiter = ',', skipinitialspace=True)
+def read_events(filename, hosts, event_types, settings, from_frame=None, to_frame=None, verbose=False, profiler=None, from_time=None, to_time=None, jobs=1):
+    """ Read an events CSV.  from_time/to_time (see parse_time) select a
+    time window, relative times are counted from the first event.
+
+    With jobs other than 1, the file is parsed by that many processes (one
+    per CPU for None or 0), see dsd.csvchunks.  The events are the same
+    either way.  Compressed files (see dsd.compression) are decompressed as
+    they are read, always by a single process as they can't be split. """
 
     if verbose:
         print('Reading event data from %s'%filename)
 
-    data = []
-    with open(filename, 'r') as csv_file:
-        reader = csv.reader(csv_file, dialect='EventType')
-        for i, row in enumerate(reader):
-            if i<1:
-                continue
-            if len(row) < 4:
-                continue
-            if re.match('^\s*#', row[0]):
-                continue
+    if jobs == 1 or compression.is_compressed(filename):
+        with compression.open_input(filename, 'r') as csv_file:
+            data = _events_from_rows(csvchunks.iter_rows(csv_file), hosts, event_types, settings, from_frame, to_frame)
+    else:
+        with stage(profiler, 'parse_csv'):
+            rows = csvchunks.read_rows_parallel(filename, jobs=jobs or None)
+        data = _events_from_rows(rows, hosts, event_types, settings, from_frame, to_frame)
 
-            src = next(s for s in hosts if s.id == row[1])
-            dst = next(s for s in hosts if s.id == row[2])
+    if profiler:
+        profiler.count('events_read', len(data))
 
-            try:
-                et = next(e for e in event_types if e.name == row[3])
-            except (StopIteration):
-                print('Cannot match event "%s", skipping event'%row[3], file=sys.stderr)
-                continue
+    with stage(profiler, 'sort_and_process'):
+        so.Event.sort_and_process(events=data, settings=settings)
 
-            ack_time = None
-            if len(row) > 3:
-                ack_time = row[4]
-                if not len(ack_time):
-                    ack_time = None
-
-            frame_id = None
-            if len(row) > 4:
-                frame_id = int(row[5])
-
-            ack_frame_id = None
-            if len(row) > 5:
-                ack_frame_id = row[6]
-                if len(ack_frame_id):
-                    ack_frame_id = int(ack_frame_id)
-                else:
-                    ack_frame_id = None
+    if data and (from_time is not None or to_time is not None):
+        start = data[0].time
+        data = select_time_window(data, resolve_time(from_time, start), resolve_time(to_time, start), settings=settings)
 
-            if from_frame and frame_id < from_frame:
-                continue
+    return data
 
-            if to_frame and ack_frame_id > to_frame:
-                break
+def _events_from_rows(rows, hosts, event_types, settings, from_frame=None, to_frame=None):
+    """ Events of the rows (see csvchunks.iter_rows) of an events CSV, in file order """
 
-            e = so.Event(
-                settings     = settings,
-                time         = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f'),
-                src          = src,
-                dst          = dst,
-                event_type   = et,
-                ack_time     = ack_time,
-                frame_id     = frame_id,
-                ack_frame_id = ack_frame_id,
-            )
-            data.append(e)
+    # The first of any duplicates wins, as in a linear search
+    hosts_by_id = {}
+    for h in hosts:
+        hosts_by_id.setdefault(h.id, h)
+    event_types_by_name = {}
+    for e in event_types:
+        event_types_by_name.setdefault(e.name, e)
 
-    so.Event.sort_and_process(events=data, settings=settings)
+    data = []
+    for t, row in rows:
+        src = hosts_by_id[row[1]]
+        dst = hosts_by_id[row[2]]
+
+        et = event_types_by_name.get(row[3])
+        if et is None:
+            print('Cannot match event "%s", skipping event'%row[3], file=sys.stderr)
+            continue
+
+        ack_time = None
+        if len(row) > 3:
+            ack_time = row[4]
+            if not len(ack_time):
+                ack_time = None
+
+        frame_id = None
+        if len(row) > 4:
+            frame_id = int(row[5])
+
+        ack_frame_id = None
+        if len(row) > 5:
+            ack_frame_id = row[6]
+            if len(ack_frame_id):
+                ack_frame_id = int(ack_frame_id)
+            else:
+                ack_frame_id = None
+
+        if from_frame and frame_id < from_frame:
+            continue
 
+        if to_frame and ack_frame_id > to_frame:
+            break
+
+        e = so.Event(
+            settings     = settings,
+            time         = t if t is not None else csvchunks.parse_time(row[0]),
+            src          = src,
+            dst          = dst,
+            event_type   = et,
+            ack_time     = ack_time,
+            frame_id     = frame_id,
+            ack_frame_id = ack_frame_id,
+        )
+        data.append(e)
     return data
 
+def parse_time(value):
+    """ Used by argparse for --from-time/--to-time: a number of seconds since
+    the start (returned as a float), or an absolute (local) time such as
+    '2019-08-08 12:00:05.250' (returned as a datetime) """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        t = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected a number of seconds or a time like "2019-08-08 12:00:05.250", got %s'%value)
+    if t.tzinfo is not None:
+        # Packet and event times are naive local times
+        t = t.astimezone().replace(tzinfo=None)
+    return t
+
+def resolve_time(value, start):
+    """ Turn a value from parse_time into an absolute time, relative values
+    being counted from start """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return start + datetime.timedelta(seconds=value)
+
+def capture_start_time(capture_filename):
+    """ Time of the first packet of a capture (or of a capture set, given
+    as a list of files), to resolve relative times against """
+    if not isinstance(capture_filename, str):
+        times = [t for t in map(first_packet_time, capture_filename) if t is not None]
+        t = min(times) if times else None
+    else:
+        t = first_packet_time(capture_filename)
+    if t is None:
+        return None
+    return datetime.datetime.fromtimestamp(t)
+
+def _bisect_time(events, t, right=False):
+    """ bisect_left (or bisect_right) of time t in a list of events sorted by time """
+    lo, hi = 0, len(events)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if events[mid].time < t or (right and events[mid].time == t):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def select_time_window(events, from_time=None, to_time=None, settings=None):
+    """ The events (sorted by time, e.g. by Event.sort_and_process) between
+    the absolute times from_time and to_time inclusive.  The window is found
+    by bisection, and only the events in it are processed again so their dt
+    and links start from the first event of the window. """
+
+    lo = _bisect_time(events, from_time) if from_time is not None else 0
+    hi = _bisect_time(events, to_time, right=True) if to_time is not None else len(events)
+    if lo == 0 and hi == len(events):
+        return events
+
+    window = events[lo:hi]
+    if window:
+        window[0].prev = None
+        window[-1].next = None
+        if settings is not None:
+            so.Event.sort_and_process(events=window, settings=settings)
+    return window
+
+def add_time_window_args(parser):
+    """ Add --from-time/--to-time to a parser """
+
+    parser.add_argument(
+        '--from-time',
+        metavar='TIME',
+        dest='from_time',
+        type=parse_time,
+        default=None,
+        help='Only keep events from this time on: seconds since the start, or an absolute time like "2019-08-08 12:00:05.250"',
+    )
+    parser.add_argument(
+        '--to-time',
+        metavar='TIME',
+        dest='to_time',
+        type=parse_time,
+        default=None,
+        help='Only keep events up to this time: seconds since the start, or an absolute time',
+    )
+
+    return parser
+
 def write_events(filename, events):
-    """ Write the events to a CSV file """
-    with open(filename, 'w') as f:
+    """ Write the events to a CSV file (compressed for .gz or .zst, see dsd.compression) """
+    with compression.open_output(filename, 'w') as f:
         colHeadings = ['time', 'src', 'dst', 'eventType', 'ackTime', 'frameId', 'ackFrameId']
         writer = csv.DictWriter(f, delimiter=',', fieldnames=colHeadings)
 
@@ -151,6 +308,24 @@ def write_events(filename, events):
                 'ackFrameId': e.ack_frame_id,
             })
 
+def write_output(filename, contents, profiler=None):
+    """ Write a generated file (SVG, etc) to disk, compressed for .svgz, .gz
+    or .zst (see dsd.compression) """
+    with compression.open_output(filename, 'w', encoding='utf-8') as f:
+        f.write(contents)
+
+    if profiler:
+        profiler.count('bytes_written', os.path.getsize(filename))
+
+def write_diagram(filename, diagram, profiler=None):
+    """ Stream a Diagram to disk as it is rendered (see Diagram.write),
+    compressed like write_output does """
+    with compression.open_output(filename, 'w', encoding='utf-8') as f:
+        diagram.write(f)
+
+    if profiler:
+        profiler.count('bytes_written', os.path.getsize(filename))
+
 def filter_hosts(hosts, events):
     """ Remove hosts that aren't involved in any events """
     host_copy = hosts.copy()
@@ -163,6 +338,155 @@ def filter_hosts(hosts, events):
         if not found:
             hosts.remove(s)
 
+def filter_anomalies(events, settings, context_events=0, context_time=0):
+    """ Keep only the SLOW/VERY_SLOW events, plus context_events neighbours
+    and context_time seconds on either side of each of them.  Every run of
+    dropped events is replaced with a single so.OmittedEvents marker.
+
+    events must already have been through Event.sort_and_process.  The kept
+    events are re-linked and re-spaced (dt) for the shorter diagram, so the
+    input list should not be rendered afterwards. """
+
+    slow = (so.EventAckSpeed.SLOW, so.EventAckSpeed.VERY_SLOW)
+    anomalies = [i for i, e in enumerate(events) if e.event_ack_speed in slow]
+    if not anomalies:
+        return []
+
+    # Mark the ranges to keep with a difference array, so overlapping
+    # contexts cost nothing extra
+    times = [e.time for e in events] if context_time else None
+    window = datetime.timedelta(seconds=context_time)
+    marks = [0] * (len(events)+1)
+    for i in anomalies:
+        lo = max(0, i - context_events)
+        hi = min(len(events), i + context_events + 1)
+        if context_time:
+            lo = min(lo, bisect.bisect_left(times, events[i].time - window))
+            hi = max(hi, bisect.bisect_right(times, events[i].time + window))
+        marks[lo] += 1
+        marks[hi] -= 1
+
+    outp = []
+    omitted = []
+    depth = 0
+    for i, e in enumerate(events):
+        depth += marks[i]
+        if depth:
+            if omitted:
+                outp.append(so.OmittedEvents(events=omitted, settings=settings))
+                omitted = []
+            outp.append(e)
+        else:
+            omitted.append(e)
+    if omitted:
+        outp.append(so.OmittedEvents(events=omitted, settings=settings))
+
+    # Re-link and re-space what is left.  Markers get a fixed amount of room
+    # instead of the (possibly huge) time they stand in for.
+    marker_gap = datetime.timedelta(seconds=settings.omitted_marker_height / float(settings.time_spacing))
+    max_gap = datetime.timedelta(seconds=float(settings.max_time_gap)) if float(settings.max_time_gap) > 0 else None
+    for i, e in enumerate(outp):
+        e.prev = outp[i-1] if i > 0 else None
+        e.next = outp[i+1] if i < len(outp)-1 else None
+
+        if i == 0:
+            e.dt = datetime.timedelta(seconds=0)
+            continue
+
+        if isinstance(e, so.OmittedEvents) or isinstance(e.prev, so.OmittedEvents):
+            gap = marker_gap
+        else:
+            gap = e.time - e.prev.time
+            if max_gap is not None and gap > max_gap:
+                gap = max_gap
+        e.dt = e.prev.dt + gap
+
+    return outp
+
+def coalesce_bursts(events, settings, window=None):
+    """ Replace every burst of events with the same source, destination and
+    event type, all within window seconds (the burstWindow setting by
+    default) of the first one, with a single so.CoalescedEvents drawn where
+    the burst starts.  Other events may be interleaved with a burst.
+
+    events must already have been through Event.sort_and_process.  This
+    is a single pass keeping the open burst of each (src, dst, type) in a
+    dict, so it is linear in the number of events.  The result is
+    re-linked; the times (dt) are those of the first event of each burst. """
+
+    if window is None:
+        window = settings.burst_window
+    window = datetime.timedelta(seconds=float(window))
+
+    """ Each slot is the list of events drawn at that position """
+    slots = []
+    open_bursts = {}
+    for e in events:
+        key = (e.src.id, e.dst.id, e.event_type.name)
+        burst = open_bursts.get(key)
+        if burst is not None and e.time - burst[0].time <= window:
+            burst.append(e)
+        else:
+            burst = [e]
+            open_bursts[key] = burst
+            slots.append(burst)
+
+    outp = [b[0] if len(b) == 1 else so.CoalescedEvents(events=b, settings=settings) for b in slots]
+
+    for i, e in enumerate(outp):
+        e.prev = outp[i-1] if i > 0 else None
+        e.next = outp[i+1] if i < len(outp)-1 else None
+
+    return outp
+
+def add_burst_args(parser):
+    """ Add the options controlling the coalescing of bursts to a parser """
+
+    parser.add_argument(
+        '--coalesce-bursts',
+        dest='coalesce_bursts',
+        action='store_true',
+        help='Draw each burst of events with the same source, destination and type as one arrow labelled with the number of events and their ACK time range',
+    )
+    parser.add_argument(
+        '--burst-window',
+        metavar='SECONDS',
+        dest='burst_window',
+        type=float,
+        default=None,
+        help='With --coalesce-bursts, how long after its first event a burst lasts (defaults to the burstWindow setting)',
+    )
+
+    return parser
+
+def add_anomaly_args(parser):
+    """ Add the options controlling the anomaly-only render to a parser """
+
+    parser.add_argument(
+        '--anomalies-only',
+        dest='anomalies_only',
+        action='store_true',
+        help='Only draw events with SLOW or VERY_SLOW ACKs (see the ackThreshold* settings), collapsing everything else',
+    )
+    parser.add_argument(
+        '--context-events',
+        metavar='N',
+        dest='context_events',
+        type=int,
+        default=0,
+        help='With --anomalies-only, also keep N events on either side of each slow event',
+    )
+    parser.add_argument(
+        '--context-time',
+        metavar='SECONDS',
+        dest='context_time',
+        type=float,
+        default=0,
+        help='With --anomalies-only, also keep events within SECONDS of each slow event',
+    )
+
+    return parser
+
 def match_hosts(all_hosts, user_hosts):
     """ Given a list of hosts from a command line, match to Host objects in user_hosts """
     hosts=[]
@@ -183,19 +507,32 @@ def argparse_file_exists(f):
     else:
         return f
 
-def get_arg_parse(*args, **kwargs):
-    """ Factory for argparse library with some of the common elements used by every script already loaded """
-
-    parser = argparse.ArgumentParser(*args, *kwargs)
-    parser.add_argument(
-        '-c', '--config',
-        dest='config',
-        metavar='FILE',
-        action='store',
-        help='JSON Config file',
-        type=argparse_file_exists,
-        default='/tmp/config.json'
-    )
+def positive_int(value):
+    """ Used by argparse for counts that must be at least 1 """
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError('Expected a positive integer, got %s'%value)
+    return n
+
+def get_arg_parse(*args, config=True, **kwargs):
+    """ Factory for argparse library with some of the common elements used by
+    every script already loaded.  Scripts that don't read the config file
+    leave out --config with config=False. """
+
+    parser = argparse.ArgumentParser(*args, **kwargs)
+    if config:
+        parser.add_argument(
+            '-c', '--config',
+            dest='config',
+            metavar='FILE',
+            action='store',
+            help='JSON Config file',
+            type=argparse_file_exists,
+            default='/tmp/config.json'
+        )
 
     parser.add_argument(
         '-v', '--verbose',
@@ -211,11 +548,157 @@ def get_arg_parse(*args, **kwargs):
         help='Do not filter out inkscape tags/attributes (helpful for debugging in Inkscape, but renders the SVG non-standard)',
     )
 
+    parser.add_argument(
+        '--profile',
+        dest='profile_outfile',
+        metavar='JSON_OUTFILE',
+        action='store',
+        nargs='?',
+        const='',
+        default=None,
+        help='Print the time spent in each stage and some counters to stderr, and write them to JSON_OUTFILE if provided',
+    )
+
+    parser.add_argument(
+        '--profile-dump',
+        dest='profile_dump_dir',
+        metavar='DIR',
+        action='store',
+        default=None,
+        help='Run each stage under cProfile and write the stats to DIR/<stage>.prof',
+    )
+
+    parser.add_argument(
+        '--memory-report',
+        dest='memory_report',
+        action='store_true',
+        help='Trace allocations (slow) and report the peak traced memory and RSS of each stage, and the top allocation sites',
+    )
+
+    parser.add_argument(
+        '--memory-budget',
+        dest='memory_budget',
+        metavar='SIZE',
+        type=parse_size,
+        default=None,
+        help='Stop with an error as soon as the process uses more than SIZE of memory (RSS), e.g. 2G',
+    )
+
+    return parser
+
+def add_minimap_args(parser):
+    """ Add the options controlling the overview (minimap) render to a parser """
+
+    parser.add_argument(
+        '--minimap-svg',
+        metavar='MINIMAP_OUTFILE',
+        dest='minimap_outfile',
+        default=None,
+        help='If provided, write a small overview SVG binning the events by time and host pair',
+    )
+    parser.add_argument(
+        '--minimap-bins',
+        metavar='N',
+        dest='minimap_bins',
+        type=positive_int,
+        default=None,
+        help='Number of time bins in the overview (defaults to the minimapBins setting)',
+    )
+
     return parser
 
-def generate_display_filter(hosts, event_type_names, line_breaks=True):
+def add_ack_stats_args(parser):
+    """ Add the options controlling the ACK latency report (see dsd.ackstats) to a parser """
+
+    parser.add_argument(
+        '--ack-stats',
+        metavar='REPORT_OUTFILE',
+        dest='ack_stats_outfile',
+        default=None,
+        help='If provided, write p50/p95/p99 ACK times per source, destination and event type to this file (CSV if it ends in .csv, JSON otherwise)',
+    )
+    parser.add_argument(
+        '--ack-stats-window',
+        metavar='SECONDS',
+        dest='ack_stats_window',
+        type=float,
+        default=None,
+        help='Also break the ACK time report down into time windows of this many seconds',
+    )
+    parser.add_argument(
+        '--ack-stats-table',
+        dest='ack_stats_table',
+        action='store_true',
+        help='Draw a table of the ACK time quantiles below the diagram',
+    )
+
+    return parser
+
+def add_propagation_args(parser):
+    """ Add the options controlling the propagation latency analysis (see dsd.propagation) to a parser """
+
+    parser.add_argument(
+        '--propagation',
+        metavar='REPORT_OUTFILE',
+        dest='propagation_outfile',
+        default=None,
+        help='If provided, write the latency distribution of every hop (e.g. App->Admin->MIS) and path of relayed events to this file (CSV if it ends in .csv, JSON otherwise)',
+    )
+    parser.add_argument(
+        '--propagation-window',
+        metavar='SECONDS',
+        dest='propagation_window',
+        type=float,
+        default=None,
+        help='Longest time an event may take to be relayed by a host (defaults to the propagationWindow setting)',
+    )
+    parser.add_argument(
+        '--propagation-annotations',
+        dest='propagation_annotations',
+        action='store_true',
+        help='Annotate the diagram with the time spent in each host along the paths of relayed events, and the end to end latency',
+    )
+
+    return parser
+
+def add_progress_args(parser):
+    """ Add the options controlling the progress reports of capture queries (see dsd.progress) to a parser """
+
+    parser.add_argument(
+        '--progress',
+        dest='progress',
+        action='store_true',
+        default=None,
+        help='Show a progress bar on stderr (the default when stderr is a terminal, unless --verbose)',
+    )
+    parser.add_argument(
+        '--no-progress',
+        dest='progress',
+        action='store_false',
+        help='Do not show the progress bar',
+    )
+    parser.add_argument(
+        '--progress-json',
+        metavar='FILE',
+        dest='progress_json',
+        default=None,
+        help='Write the progress as JSON lines to this file ("-" for stdout)',
+    )
+    parser.add_argument(
+        '--progress-interval',
+        metavar='SECONDS',
+        dest='progress_interval',
+        type=float,
+        default=1.0,
+        help='Seconds between progress reports',
+    )
+
+    return parser
+
+def generate_display_filter(hosts, event_type_names, line_breaks=True, from_time=None, to_time=None):
     """ Generate a display filter intended to search for Solacom events in a
-    capture file between specified hosts """
+    capture file between specified hosts, optionally only between two
+    absolute times (datetimes) """
 
     is_first = True
 
@@ -236,10 +719,10 @@ def generate_display_filter(hosts, event_type_names, line_breaks=True):
                         is_first = False
                     else:
                         outp += 'or '
-                    outp += '(ip.src=={s1} and ip.dst=={s2})\n'.format(s1=s1.ip, s2=s2.ip)
+                    outp += '({s1} and {s2})\n'.format(s1=_ip_predicate('src', s1), s2=_ip_predicate('dst', s2))
             outp += '   )\n'
         else:
-            outp += '    ip.src={s}\n'.format(s=hosts[0].ip)
+            outp += '    {s}\n'.format(s=_ip_predicate('src', hosts[0]))
 
         outp += '   and '
 
@@ -259,8 +742,15 @@ def generate_display_filter(hosts, event_type_names, line_breaks=True):
             outp += '   )\n'
 
         elif len(event_type_names) == 1:
-            outp += ('   %s"\n'%et_filter).format(event=e)
-            outp += 'or %s\n'%ack_filter
+            outp += '(\n'
+            outp += ('         %s"\n'%et_filter).format(event=event_type_names[0])
+            outp += '      or %s\n'%ack_filter
+            outp += '   )\n'
+
+    if from_time is not None:
+        outp += '   and frame.time_epoch >= %0.6f\n'%from_time.timestamp()
+    if to_time is not None:
+        outp += '   and frame.time_epoch <= %0.6f\n'%to_time.timestamp()
 
     outp += ')'
 
@@ -270,96 +760,761 @@ def generate_display_filter(hosts, event_type_names, line_breaks=True):
 
     return outp
 
-def query_logs(capture_filename, hosts, event_type_names, event_types, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False):
-    """ Query a capture file for events """
+def _ip_predicate(direction, host):
+    """ Display filter predicate matching packets from (direction='src') or to
+    (direction='dst') any of the addresses or subnets of a host """
+    parts = []
+    for n, a in zip(host.networks, host.filter_addresses):
+        parts.append('{proto}.{d}=={a}'.format(proto='ipv6' if n.version == 6 else 'ip', d=direction, a=a))
+    if len(parts) == 1:
+        return parts[0]
+    return '(%s)'%' or '.join(parts)
+
+""" TCP ports the events are POSTed to, used by generate_capture_filter """
+DEFAULT_HTTP_PORTS = [80, 8080]
+
+def generate_capture_filter(hosts, ports=DEFAULT_HTTP_PORTS):
+    """ Generate a BPF capture filter (for dumpcap, tcpdump, etc.) keeping
+    the traffic generate_display_filter can match: TCP on the HTTP ports
+    between the hosts (or from/to the host if there's only one).  Capture
+    filters can't look into the payload, so every event type and the ACKs
+    get through. """
+
+    parts = ['tcp']
+    if ports:
+        parts.append(_bpf_or(['port %d'%p for p in ports]))
+
+    if len(hosts) > 1:
+        pairs = []
+        for s1 in hosts:
+            others = [s2 for s2 in hosts if s2 != s1]
+            pairs.append('(%s and %s)'%(_bpf_host('src', [s1]), _bpf_host('dst', others)))
+        parts.append(_bpf_or(pairs))
+    elif len(hosts) == 1:
+        parts.append(_bpf_host('', hosts))
+
+    return ' and '.join(parts)
+
+def _bpf_host(direction, hosts):
+    """ BPF primitive matching packets from (direction='src'), to ('dst') or
+    either way ('') any of the addresses or subnets of the hosts """
+    prefix = direction + ' ' if direction else ''
+    parts = []
+    for h in hosts:
+        for n, a in zip(h.networks, h.filter_addresses):
+            parts.append('%s%s %s'%(prefix, 'host' if n.prefixlen == n.max_prefixlen else 'net', a))
+    return _bpf_or(parts)
+
+def _bpf_or(parts):
+    if len(parts) == 1:
+        return parts[0]
+    return '(%s)'%' or '.join(parts)
+
+def find_event_type(layer_xml):
+    """ Extract the text of the <eventType> tag from a dissected XML layer """
+    tag = layer_xml.get_field('tag')
+
+    t_idx = None
+    for i,t in enumerate(tag.fields):
+        if t.showname == '<eventType>':
+            t_idx = i
+            break
+
+    # The -1 is because of the nest level I think?
+    return layer_xml.get_field('cdata').fields[t_idx-1].binary_value.decode('ascii')
+
+""" Frames read past --to-frame to leave time for the last ACKs to show up """
+ACK_FRAME_SLACK = 20
+
+def ip_layer(p):
+    """ The IPv4 or IPv6 layer of a packet """
+    return p['ip'] if 'ip' in p else p['ipv6']
+
+class EventMatcher(object):
+    """ Turns dissected packets into Events, pairing each HTTP POST with the
+    200 response that ACKs it.  Requests waiting for their ACK are kept in a
+    dict keyed on frame ID, so matching an ACK doesn't depend on how many
+    events have been seen.
+
+    tshark only links a response to its request (http.request_in) when both
+    are in the file it reads.  A response without that link (e.g. in the
+    next file of a capture set) is paired with the request waiting on its
+    TCP connection, but only when exactly one is: the connection may also
+    carry requests that weren't selected, so with several waiting there's
+    no telling which one it answers, and it's counted as unmatched.
+
+    Packet addresses are resolved against all_hosts (every configured host,
+    defaults to hosts) and the packets of hosts that aren't selected are
+    skipped, so a host isn't mistaken for a selected pool whose subnet
+    contains its address. """
+
+    """ Kinds of packet returned by process() """
+    POST = 1
+    ACK  = 2
+
+    def __init__(self, hosts, event_types, settings=None, verbose=False, profiler=None, frame_offset=0, all_hosts=None):
+        self.hosts        = hosts
+        self.event_types  = event_types
+        self.settings     = settings
+        self.verbose      = verbose
+        self.profiler     = profiler
+
+        """ Added to tshark's frame numbers, when reading part of a capture """
+        self.frame_offset = frame_offset
+
+        """ Resolves packet IPs to the selected hosts, by address or subnet """
+        self.host_index   = HostIndex(all_hosts or hosts, selected=hosts)
+
+        """ Events still waiting for their ACK, by frame_id.  Events are
+        dropped from it once ACKed or released, so the matcher only holds
+        the requests in flight. """
+        self.pending = {}
+
+        """ Frame IDs of the requests sent on each TCP connection (src ip,
+        src port, dst ip, dst port), oldest first, for the responses tshark
+        couldn't link to their request """
+        self.pending_flows = {}
+
+        """ Time of the first packet, used for the default time labels """
+        self.start_time = None
+
+        # Counters for the profiler and the progress reports
+        self.n_events         = 0
+        self.n_unacked        = 0
+        self.n_packets        = 0
+        self.n_acks           = 0
+        self.n_unmatched_acks = 0
+        self.ack_time         = 0.0
+
+    def process(self, p):
+        """ Process one packet.  Returns (EventMatcher.POST, new event),
+        (EventMatcher.ACK, acked event) or (None, None) """
+
+        if self.start_time is None:
+            self.start_time = p.sniff_time
+
+        if 'xml' in p and p['http'].request_method=='POST':
+            # Look for event type
+
+            # Default time label is dt
+            dt = (p.sniff_time - self.start_time)
+
+            ip = ip_layer(p)
+            src = self.host_index.lookup(str(ip.src))
+            dst = self.host_index.lookup(str(ip.dst))
+            if src is None or dst is None:
+                if self.verbose:
+                    print('Skipping frame %d between unselected addresses %s and %s'%(int(p.number), ip.src, ip.dst), file=sys.stderr)
+                return None, None
+
+            et = next(e for e in self.event_types if e.name == find_event_type(p['xml']))
+
+            e = so.Event(
+                time=p.sniff_time,
+                time_label='%3.2f'%(dt.microseconds/1000),
+                settings=self.settings,
+                src=src,
+                dst=dst,
+                event_type=et,
+                frame_id=int(p.number) + self.frame_offset,
+            )
+            self.n_events += 1
+            self.pending[e.frame_id] = e
+            flow = (ip.src, p['tcp'].srcport, ip.dst, p['tcp'].dstport)
+            self.pending_flows.setdefault(flow, collections.deque()).append(e.frame_id)
+            if self.verbose:
+                print('pid=%d event=%s\n'%(e.frame_id, e))
+
+            return self.POST, e
+
+        elif p['tcp'].ack and 'http' in p and hasattr(p['http'], 'response_code') and int(p['http'].response_code)==200:
+            if self.profiler:
+                t0 = time.perf_counter()
+            ip = ip_layer(p)
+            flow_key = (ip.dst, p['tcp'].dstport, ip.src, p['tcp'].srcport)
+            flow = self.pending_flows.get(flow_key)
+            if flow is not None:
+                # Drop the requests of the connection already ACKed
+                while flow and flow[0] not in self.pending:
+                    flow.popleft()
+
+            linked = hasattr(p['http'], 'request_in')
+            if linked:
+                request_frame = int(p['http'].request_in) + self.frame_offset
+                if flow and flow[0] == request_frame:
+                    flow.popleft()
+            elif flow is not None and len(flow) == 1:
+                request_frame = flow.popleft()
+            else:
+                request_frame = None
+
+            if flow is not None and not flow:
+                del self.pending_flows[flow_key]
+            e = self.pending.pop(request_frame, None)
+            if self.profiler:
+                self.ack_time += time.perf_counter() - t0
+            if e:
+                self.n_acks += 1
+                # Pending events haven't been released, so their time is
+                # still in the capture's clock (see EventStreamer)
+                e.ack_time = float(p['http'].time) if linked else (p.sniff_time - e.time).total_seconds()
+                e.ack_frame_id = int(p.number) + self.frame_offset
+                return self.ACK, e
+
+            else:
+                self.n_unmatched_acks += 1
+                if self.verbose:
+                    print("Could not find event for request_frame=%s"%request_frame, file=sys.stderr)
+        else:
+            pass
+            # print('Skipping %d'%int(p.number), p['tcp'].ack, p['http'].responce_code)
+
+        return None, None
+
+    def release(self, e):
+        """ Stop waiting for the ACK of event e (e.g. it timed out), once it
+        is handed over: an ACK showing up later is then counted as unmatched
+        rather than change the event """
+        if self.pending.pop(e.frame_id, None) is not None:
+            self.n_unacked += 1
+
+    def report(self, profiler):
+        """ Add the matching counters to a profiler """
+        profiler.count('packets', self.n_packets)
+        profiler.count('posts_matched', self.n_events)
+        profiler.count('acks_matched', self.n_acks)
+        profiler.count('acks_unmatched', self.n_unmatched_acks)
+        profiler.count('requests_unmatched', self.n_unacked + len(self.pending))
+        profiler.add_time('ack_matching', self.ack_time, calls=self.n_acks + self.n_unmatched_acks)
+
+class EventStreamer(object):
+    """ Wraps an EventMatcher to turn a stream of packets into a time ordered
+    stream of events.
+
+    An event is held back until its ACK has been seen, or until a packet
+    ackTimeout seconds later shows up, so memory only depends on the number of
+    requests in flight.  An ACK showing up after its event was handed over
+    is dropped.  clock_offset (s) is added to every event time, as the
+    events are handed over.
+
+    from_time and to_time (datetimes, in the capture's clock) select the
+    requests sent in that window. """
+
+    def __init__(self, hosts, event_types, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False, profiler=None, clock_offset: float=0, frame_offset: int=0, from_time=None, to_time=None, all_hosts=None):
+        self.matcher     = EventMatcher(hosts=hosts, event_types=event_types, settings=settings, verbose=verbose, profiler=profiler, frame_offset=frame_offset, all_hosts=all_hosts)
+        self.from_frame  = from_frame
+        self.to_frame    = to_frame
+        self.offset      = datetime.timedelta(seconds=clock_offset)
+        self.ack_timeout = datetime.timedelta(seconds=settings.ack_timeout if settings else 5)
+        self.from_time   = from_time
+        self.to_time     = to_time
+
+        """ Set once the end of the requested frame range has been passed """
+        self.done = False
+
+        """ Events not returned yet, by frame_id, in capture order """
+        self.waiting = collections.OrderedDict()
+
+    def feed(self, p):
+        """ Process a packet, return the list of events that are now complete """
+
+        matcher = self.matcher
+        matcher.n_packets += 1
+        if matcher.start_time is None:
+            matcher.start_time = p.sniff_time
+
+        number = int(p.number) + matcher.frame_offset
+        if self.from_frame and number < self.from_frame:
+            return []
+
+        if self.to_frame and number > self.to_frame + ACK_FRAME_SLACK:
+            self.done = True
+            return []
+
+        if self.from_time and p.sniff_time < self.from_time:
+            return []
+
+        if self.to_time and p.sniff_time > self.to_time + self.ack_timeout:
+            self.done = True
+            return []
+
+        kind, e = matcher.process(p)
+        if kind == EventMatcher.POST and self.to_time and e.time > self.to_time:
+            # Only read to find the ACKs of the requests in the window
+            matcher.pending.pop(e.frame_id, None)
+        elif kind == EventMatcher.POST:
+            self.waiting[e.frame_id] = e
+        elif kind == EventMatcher.ACK and self.to_frame and e.ack_frame_id > self.to_frame:
+            self.done = True
+            return []
+
+        ready = []
+        while self.waiting:
+            first = next(iter(self.waiting.values()))
+            if first.ack_frame_id is None and p.sniff_time - first.time < self.ack_timeout:
+                break
+            del self.waiting[first.frame_id]
+            matcher.release(first)
+            first.time += self.offset
+            ready.append(first)
+
+        return ready
+
+    def finish(self):
+        """ Return every event still waiting, whether or not it was ACKed """
+        ready = list(self.waiting.values())
+        self.waiting.clear()
+        for e in ready:
+            self.matcher.release(e)
+            e.time += self.offset
+        return ready
+
+def open_capture(capture_filename, hosts, event_type_names, verbose=False, from_frame: int=None, to_frame: int=None, from_time=None, to_time=None, **kwargs):
+    """ Open a capture file with the display filter selecting the events
+    between hosts.  kwargs are passed on to pyshark.FileCapture.  gzip and
+    zstd compressed captures are decompressed into tshark as it reads them.
+
+    With a frame range, only that range (plus ACK_FRAME_SLACK frames) is
+    handed to tshark, found with the capture's frame index (see frameindex).
+    The capture's frame_offset attribute then has to be added to the frame
+    numbers tshark reports.  Likewise, only the packets between the
+    (absolute) times from_time and to_time are read. """
+
+    # Imported here rather than at the top: pyshark pulls in asyncio and lxml,
+    # which more than doubles the start up time of the commands that never
+    # open a capture
+    import pyshark
+    from dsd.frameindex import load_frame_index, WindowCapture, DecompressedCapture
 
     msgs_df = generate_display_filter(
         hosts=hosts,
         event_type_names=event_type_names,
-        line_breaks=False
+        line_breaks=False,
+        from_time=from_time,
+        to_time=to_time,
     )
 
     if verbose:
         print('Display Filter:\n%s'%msgs_df)
 
+    index = None
+    if from_frame or to_frame or from_time or to_time:
+        index = load_frame_index(capture_filename, verbose=verbose)
+
+    if index is not None and index.frames:
+        if from_time:
+            from_frame = max(from_frame or 1, index.numbers[index.checkpoint_for_time(from_time.timestamp())])
+        if to_time:
+            end = index.frame_after_time(to_time.timestamp())
+            if end is not None:
+                to_frame = min(to_frame, end) if to_frame else end
+
     if verbose:
         print('Reading', capture_filename)
-    cap = pyshark.FileCapture(
+    if index is not None and index.frames:
+        cap = WindowCapture(
+            index,
+            from_frame=from_frame,
+            to_frame=to_frame + ACK_FRAME_SLACK if to_frame else None,
+            display_filter=msgs_df,
+            **kwargs
+        )
+    elif compression.is_compressed(capture_filename):
+        cap = DecompressedCapture(
+            capture_filename,
+            display_filter=msgs_df,
+            **kwargs
+        )
+    else:
+        cap = pyshark.FileCapture(
+            capture_filename,
+            display_filter=msgs_df,
+            **kwargs
+        )
+    if verbose:
+        cap.set_debug()
+
+    return cap
+
+def _stream_capture(cap, streamer, progress=None):
+    """ Feed the packets of an open capture to an EventStreamer, yielding
+    the events as they are completed """
+    if progress is not None:
+        capture = progress.start_capture(streamer.matcher)
+    for p in cap:
+        if progress is not None:
+            progress.packet(p, capture)
+        for e in streamer.feed(p):
+            yield e
+        if streamer.done:
+            break
+        if progress is not None and progress.stop_requested:
+            break
+
+def iter_capture_events(capture_filename, hosts, event_type_names, event_types, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False, profiler=None, clock_offset: float=0, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Stream the events of a capture file in capture (time) order, see
+    EventStreamer.  from_time and to_time are absolute times (datetimes).
+    capture_filename can also be a list of the files of a capture set, see
+    iter_capture_set_events.
+
+    progress (a dsd.progress.Progress) counts the packets, and ends the
+    stream early, with the events found so far, once it's asked to stop.
+    all_hosts are every configured host, see EventMatcher. """
+
+    if not isinstance(capture_filename, str):
+        yield from iter_capture_set_events(
+            capture_filenames=capture_filename,
+            hosts=hosts,
+            all_hosts=all_hosts,
+            event_type_names=event_type_names,
+            event_types=event_types,
+            from_frame=from_frame,
+            to_frame=to_frame,
+            settings=settings,
+            verbose=verbose,
+            profiler=profiler,
+            clock_offset=clock_offset,
+            from_time=from_time,
+            to_time=to_time,
+            progress=progress,
+        )
+        return
+
+    # Keep reading past to_time for the ACKs
+    ack_timeout = datetime.timedelta(seconds=settings.ack_timeout if settings else 5)
+    cap = open_capture(
         capture_filename,
-        display_filter=msgs_df,
+        hosts=hosts,
+        event_type_names=event_type_names,
+        verbose=verbose,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        from_time=from_time,
+        to_time=to_time + ack_timeout if to_time else None,
+    )
+
+    streamer = EventStreamer(
+        hosts=hosts,
+        all_hosts=all_hosts,
+        event_types=event_types,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+        clock_offset=clock_offset,
+        frame_offset=getattr(cap, 'frame_offset', 0),
+        from_time=from_time,
+        to_time=to_time,
+    )
+    try:
+        for e in _stream_capture(cap, streamer, progress):
+            yield e
+
+        for e in streamer.finish():
+            yield e
+
+    finally:
+        # Reap tshark so its CPU time is accounted for
+        cap.close()
+
+        if profiler:
+            streamer.matcher.report(profiler)
+
+def iter_capture_set_events(capture_filenames, hosts, event_type_names, event_types, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False, profiler=None, clock_offset: float=0, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Stream the events of a capture set (e.g. a dumpcap ring buffer, see
+    dsd.captureset) as if it were one capture: the files are read one after
+    the other through the same EventStreamer, so frame numbers run on across
+    files and requests ACKed in the next file are still matched.  Files
+    entirely outside the frame range or the time window are skipped. """
+
+    ack_timeout = datetime.timedelta(seconds=settings.ack_timeout if settings else 5)
+    files = captureset.capture_set(capture_filenames, verbose=verbose)
+    selected = captureset.select_files(
+        files,
+        from_frame=from_frame,
+        to_frame=to_frame + ACK_FRAME_SLACK if to_frame else None,
+        from_time=from_time,
+        to_time=to_time + ack_timeout if to_time else None,
     )
     if verbose:
-        cap.set_debug()
+        print('Reading %d of the %d files of the capture set'%(len(selected), len(files)))
+    if profiler:
+        profiler.count('capture_files_skipped', len(files) - len(selected))
 
-    def find_event_type(layer_xml):
-        tag = layer_xml.get_field('tag')
+    streamer = EventStreamer(
+        hosts=hosts,
+        all_hosts=all_hosts,
+        event_types=event_types,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+        clock_offset=clock_offset,
+        from_time=from_time,
+        to_time=to_time,
+    )
+    try:
+        for c in selected:
+            # The frame range within this file
+            local_from = from_frame - c.frame_offset if from_frame and from_frame - c.frame_offset > 1 else None
+            local_to   = to_frame - c.frame_offset if to_frame and 0 < to_frame - c.frame_offset < c.frames else None
+
+            cap = open_capture(
+                c.filename,
+                hosts=hosts,
+                event_type_names=event_type_names,
+                verbose=verbose,
+                from_frame=local_from,
+                to_frame=local_to,
+                from_time=from_time,
+                to_time=to_time + ack_timeout if to_time else None,
+            )
+            streamer.matcher.frame_offset = c.frame_offset + getattr(cap, 'frame_offset', 0)
+            try:
+                for e in _stream_capture(cap, streamer, progress):
+                    yield e
+            finally:
+                cap.close()
 
-        t_idx = None
-        for i,t in enumerate(tag.fields):
-            if t.showname == '<eventType>':
-                t_idx = i
+            if streamer.done or (progress is not None and progress.stop_requested):
                 break
 
-        # The -1 is because of the nest level I think?
-        return layer_xml.get_field('cdata').fields[t_idx-1].binary_value.decode('ascii')
+        for e in streamer.finish():
+            yield e
 
-    events = []
-    is_first=True
-    sniff_start_time = 0
-    for p in cap:
-        if is_first:
-            sniff_start_time = p.sniff_time
-            is_first=False
+    finally:
+        if profiler:
+            streamer.matcher.report(profiler)
 
-        if from_frame and int(p.number) < from_frame:
-            continue
+def query_logs(capture_filename, hosts, event_type_names, event_types, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False, profiler=None, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Query a capture file for events """
 
-        if to_frame and int(p.number) > to_frame + 20:
-            # 20 is an arbitrary number provided to allow time to find the ACK message
+    events = list(iter_capture_events(
+        capture_filename=capture_filename,
+        hosts=hosts,
+        all_hosts=all_hosts,
+        event_type_names=event_type_names,
+        event_types=event_types,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+        from_time=from_time,
+        to_time=to_time,
+        progress=progress,
+    ))
+
+    with stage(profiler, 'sort_and_process'):
+        so.Event.sort_and_process(events=events, settings=settings)
+
+    return events
+
+def query_many_logs(capture_filenames, hosts, event_type_names, event_types, settings: Settings=None, verbose=False, profiler=None, from_time=None, to_time=None, progress=None, frame_maps=None, all_hosts=None):
+    """ Query captures holding disjoint parts of the same traffic (e.g. the
+    shards written by shardCapture) one after the other, so only one tshark
+    runs at a time.  The events are sorted once they are all read.
+
+    frame_maps holds, for each capture, the frame numbers in the original
+    capture of its frames (see shards.load_frame_map), which are then used
+    for the frame ids of the events. """
+
+    events = []
+    for i, f in enumerate(capture_filenames):
+        if progress is not None and progress.stop_requested:
             break
+        found = iter_capture_events(
+            capture_filename=f,
+            hosts=hosts,
+            all_hosts=all_hosts,
+            event_type_names=event_type_names,
+            event_types=event_types,
+            settings=settings,
+            verbose=verbose,
+            profiler=profiler,
+            from_time=from_time,
+            to_time=to_time,
+            progress=progress,
+        )
+        if frame_maps is not None:
+            found = _map_frames(found, frame_maps[i])
+        events.extend(found)
+
+    with stage(profiler, 'sort_and_process'):
+        so.Event.sort_and_process(events=events, settings=settings)
 
-        if 'xml' in p and p['http'].request_method=='POST':
-            # Look for event type
+    return events
 
-            # Default time label is dt
-            dt = (p.sniff_time - sniff_start_time)
+def _map_frames(events, frame_map):
+    for e in events:
+        e.frame_id = frame_map[e.frame_id - 1]
+        if e.ack_frame_id is not None:
+            e.ack_frame_id = frame_map[e.ack_frame_id - 1]
+        yield e
+
+def estimate_clock_offset(reference, events, max_skew, resolution):
+    """ Estimate the offset (s) to add to the times of 'events' so they line up
+    with 'reference', where both are samples of the same traffic seen on two
+    taps.  Every pair of events with the same hosts and type within max_skew
+    votes for their time difference, and the densest cluster of votes (of
+    width resolution) wins.  Returns None if the samples share no events. """
+
+    by_key = {}
+    for r in reference:
+        by_key.setdefault((r.src, r.dst, r.event_type), []).append(r.time)
+
+    diffs = []
+    for e in events:
+        for t in by_key.get((e.src, e.dst, e.event_type), ()):
+            d = (t - e.time).total_seconds()
+            if abs(d) <= max_skew:
+                diffs.append(d)
+
+    if not diffs:
+        return None
+
+    # Sliding window over the sorted differences to find the densest cluster
+    diffs.sort()
+    best_lo, best_n = 0, 0
+    lo = 0
+    for hi in range(len(diffs)):
+        while diffs[hi] - diffs[lo] > resolution:
+            lo += 1
+        if hi - lo + 1 > best_n:
+            best_lo, best_n = lo, hi - lo + 1
+    cluster = diffs[best_lo:best_lo+best_n]
+
+    return cluster[len(cluster)//2]
+
+def merge_capture_events(capture_filenames, hosts, event_type_names, event_types, clock_offsets=None, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False, profiler=None, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Stream the events of several captures (e.g. from different taps) as a
+    single time ordered stream.
+
+    clock_offsets is a list (one per capture) of offsets in seconds to add to
+    that capture's times, or None to estimate it against the first capture
+    from the first clockOffsetSamples events of each.  The captures are merged
+    with a heap, so only one event per capture (plus the requests waiting for
+    their ACK) is held in memory.  Events seen on two taps within
+    mergeDedupWindow seconds of each other are only yielded once.
+
+    from_time and to_time are in the clock of the first capture. """
+
+    if clock_offsets is None:
+        clock_offsets = [None] * len(capture_filenames)
+    if len(clock_offsets) != len(capture_filenames):
+        raise ValueError('Expected %d clock offsets, got %d'%(len(capture_filenames), len(clock_offsets)))
+
+    # Reference capture is never shifted
+    if clock_offsets[0] is None:
+        clock_offsets = [0.0] + list(clock_offsets[1:])
+
+    # The time window is in the reference clock, widen it by the largest
+    # possible skew for the other captures and trim the merged stream
+    skew = datetime.timedelta(seconds=settings.clock_offset_max_skew)
+    stream_from = from_time - skew if from_time else None
+    stream_to   = to_time + skew if to_time else None
+
+    streams = []
+    for f, offset in zip(capture_filenames, clock_offsets):
+        streams.append(iter_capture_events(
+            capture_filename=f,
+            hosts=hosts,
+            all_hosts=all_hosts,
+            event_type_names=event_type_names,
+            event_types=event_types,
+            from_frame=from_frame,
+            to_frame=to_frame,
+            settings=settings,
+            verbose=verbose,
+            profiler=profiler,
+            clock_offset=offset or 0.0,
+            from_time=stream_from,
+            to_time=stream_to,
+            progress=progress,
+        ))
+
+    # Estimate the missing offsets from the heads of the streams, then put
+    # the sampled events back in front of their stream
+    if any(o is None for o in clock_offsets):
+        n = int(settings.clock_offset_samples)
+        heads = [list(itertools.islice(s, n)) for s in streams]
+        for i, offset in enumerate(clock_offsets):
+            if offset is not None:
+                continue
+            est = estimate_clock_offset(heads[0], heads[i], max_skew=settings.clock_offset_max_skew, resolution=settings.merge_dedup_window)
+            if est is None:
+                print('Could not estimate the clock offset of %s, assuming 0'%capture_filenames[i], file=sys.stderr)
+                est = 0.0
+            elif verbose:
+                print('Estimated clock offset of %s: %0.6f s'%(capture_filenames[i], est))
+            for e in heads[i]:
+                e.time += datetime.timedelta(seconds=est)
+            streams[i] = _shift_events(streams[i], est)
+        streams = [itertools.chain(h, s) for h, s in zip(heads, streams)]
+
+    # Tag each event with the index of its capture so only events from
+    # different taps are considered duplicates
+    streams = [_tag_events(i, s) for i, s in enumerate(streams)]
+
+    window = datetime.timedelta(seconds=settings.merge_dedup_window)
+    recent = collections.deque()
+    n_duplicates = 0
+    for i, e in heapq.merge(*streams, key=lambda x: x[1].time):
+        if from_time and e.time < from_time:
+            continue
+        if to_time and e.time > to_time:
+            break
 
-            src = next(s for s in hosts if s.ip == str(p['ip'].src))
-            dst = next(s for s in hosts if s.ip == str(p['ip'].dst))
+        while recent and e.time - recent[0][1].time > window:
+            recent.popleft()
 
-            et = next(e for e in event_types if e.name == find_event_type(p['xml']))
+        dup = next((r for j, r in recent if j != i and r.src == e.src and r.dst == e.dst and r.event_type == e.event_type), None)
+        if dup is not None:
+            n_duplicates += 1
+            if dup.ack_time is None and e.ack_time is not None:
+                dup.ack_time = e.ack_time
+            continue
 
-            events.append(so.Event(
-                time=p.sniff_time,
-                time_label='%3.2f'%(dt.microseconds/1000),
-                settings=settings,
-                src=src,
-                dst=dst,
-                event_type=et,
-                frame_id=int(p.number),
-            ))
-            if verbose:
-                print('pid=%d event=%s\n'%(int(p.number), events[len(events)-1]))
-
-        elif p['tcp'].ack and 'http' in p and hasattr(p['http'], 'response_code') and int(p['http'].response_code)==200 and hasattr(p['http'], 'request_in'):
-            request_frame = int(p['http'].request_in)
-            e = next((e for e in events if e.frame_id == request_frame), None)
-            if e:
-                e.ack_time = float(p['http'].time)
-                e.ack_frame_id = int(p.number)
+        recent.append((i, e))
+        yield e
 
-                if to_frame and e.ack_frame_id > to_frame:
-                    break
+    if profiler:
+        profiler.count('duplicates_merged', n_duplicates)
 
-            else:
-                if verbose:
-                    print("Could not find event for request_frame=%d"%request_frame, file=sys.stderr)
-        else:
-            pass
-            # print('Skipping %d'%int(p.number), p['tcp'].ack, p['http'].responce_code)
+def _tag_events(tag, events):
+    for e in events:
+        yield tag, e
 
+def _shift_events(events, offset):
+    delta = datetime.timedelta(seconds=offset)
+    for e in events:
+        e.time += delta
+        yield e
 
-    so.Event.sort_and_process(events=events, settings=settings)
+def query_merged_logs(capture_filenames, hosts, event_type_names, event_types, clock_offsets=None, from_frame: int=None, to_frame: int=None, settings: Settings=None, verbose=False, profiler=None, from_time=None, to_time=None, progress=None, all_hosts=None):
+    """ Query several capture files of the same traffic, see merge_capture_events """
+
+    events = list(merge_capture_events(
+        capture_filenames=capture_filenames,
+        hosts=hosts,
+        all_hosts=all_hosts,
+        event_type_names=event_type_names,
+        event_types=event_types,
+        clock_offsets=clock_offsets,
+        from_frame=from_frame,
+        to_frame=to_frame,
+        settings=settings,
+        verbose=verbose,
+        profiler=profiler,
+        from_time=from_time,
+        to_time=to_time,
+        progress=progress,
+    ))
+
+    with stage(profiler, 'sort_and_process'):
+        so.Event.sort_and_process(events=events, settings=settings)
 
     return events
 
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import math
+
+import dsd.svgobjs as svg
+import dsd.solaobjs as so
+
+class MinimapBin(object):
+    """ Accumulator for all the events that fall in one (host pair, time slot) cell """
+
+    def __init__(self):
+        self.count          = 0
+        self.worst          = None
+        self.first_frame_id = None
+        self.last_frame_id  = None
+
+    def add(self, e):
+        self.count += 1
+
+        if self.worst is None or e.event_ack_speed.value > self.worst.value:
+            self.worst = e.event_ack_speed
+
+        last_frame_id = e.ack_frame_id if e.ack_frame_id is not None else e.frame_id
+        if self.first_frame_id is None or e.frame_id < self.first_frame_id:
+            self.first_frame_id = e.frame_id
+        if self.last_frame_id is None or last_frame_id > self.last_frame_id:
+            self.last_frame_id = last_frame_id
+
+class Minimap(object):
+    """ Small overview "heat map" of a (possibly huge) list of events.
+
+    Events are binned by time (columns) and host pair (rows), so the size of
+    the output only depends on the number of bins and host pairs, never on the
+    number of events.  Each cell is coloured by the worst EventAckSpeed in it,
+    and clicking it reports the frame range to feed back into
+    --from-frame/--to-frame. """
+
+    def __init__(self, events, settings, bins=None):
+        self.events   = events
+        self.settings = settings
+        self.bins     = int(bins if bins is not None else settings.minimap_bins)
+        if self.bins < 1:
+            raise ValueError('The minimap needs at least one time bin, got %d'%self.bins)
+
+        """ Host pairs, in order of first appearance """
+        self.pairs = []
+
+        """ Dict of (pair index, bin index) -> MinimapBin """
+        self.cells = {}
+
+        """ Time of the first event, and width (s) of each time bin """
+        self.start     = None
+        self.bin_width = 0
+
+    def compute(self):
+        """ Bin all the events in a single pass.  Events do not have to be sorted """
+
+        self.pairs = []
+        self.cells = {}
+        if not len(self.events):
+            return
+
+        start = min(e.time for e in self.events)
+        end   = max(e.time for e in self.events)
+        duration = (end - start).total_seconds()
+        self.start     = start
+        self.bin_width = duration / self.bins if duration > 0 else 1.0
+
+        pair_idx = {}
+        for e in self.events:
+            key = (e.src, e.dst)
+            p = pair_idx.get(key)
+            if p is None:
+                p = pair_idx[key] = len(self.pairs)
+                self.pairs.append(key)
+
+            b = int((e.time - start).total_seconds() / self.bin_width)
+            if b >= self.bins:
+                b = self.bins - 1
+
+            cell = self.cells.get((p, b))
+            if cell is None:
+                cell = self.cells[(p, b)] = MinimapBin()
+            cell.add(e)
+
+    def speed_color(self, speed):
+        """ Colour used to draw a cell whose worst event had the given speed """
+        if so.EventAckSpeed.VERY_SLOW == speed:
+            return self.settings.ack_threshold_very_slow_color
+        elif so.EventAckSpeed.SLOW == speed:
+            return self.settings.ack_threshold_slow_color
+        elif so.EventAckSpeed.FAST == speed:
+            return self.settings.minimap_fast_color
+        return self.settings.minimap_normal_color
+
+    SCRIPT = '''
+  <script type="text/javascript">
+// <![CDATA[
+    function show_frame_range(from_frame, to_frame)
+    {
+        window.alert('--from-frame ' + from_frame + ' --to-frame ' + to_frame);
+    }
+// ]]>
+  </script>
+'''
+
+    def document(self):
+        """ Bin the events, returns the svg.Document """
+
+        self.compute()
+
+        cell_w   = self.settings.minimap_cell_width
+        cell_h   = self.settings.minimap_cell_height
+        margin_l = self.settings.minimap_label_width
+        margin_t = 2*cell_h
+
+        max_count = max((c.count for c in self.cells.values()), default=1)
+
+        labels = svg.G(attrs={'id': 'minimap-labels'})
+        for p, (src, dst) in enumerate(self.pairs):
+            labels.append(svg.Text(
+                attrs={'x': margin_l - 1, 'y': margin_t + (p+0.75)*cell_h},
+                style='font-size:%spx;font-family:Sans;text-anchor:end'%(cell_h*0.6),
+                text='%s \u2192 %s'%(src.id, dst.id),
+            ))
+
+        ticks = svg.G(attrs={'id': 'minimap-axis'})
+        tick_every = max(1, self.bins // 10)
+        for b in range(0, self.bins, tick_every):
+            ticks.append(svg.Text(
+                attrs={'x': margin_l + b*cell_w, 'y': cell_h},
+                style='font-size:%spx;font-family:Sans'%(cell_h*0.5),
+                text='%0.1fs'%(b*self.bin_width),
+            ))
+
+        rects = svg.G(attrs={'id': 'minimap-bins'})
+        for (p, b), c in sorted(self.cells.items()):
+            src, dst = self.pairs[p]
+            # Log scale so a single slow event in a quiet bin is still visible
+            opacity = 0.25 + 0.75*math.log1p(c.count)/math.log1p(max_count)
+            rects.append(svg.Rect(
+                attrs={
+                    'x':       margin_l + b*cell_w,
+                    'y':       margin_t + p*cell_h,
+                    'width':   cell_w,
+                    'height':  cell_h,
+                    'onclick': 'show_frame_range(%s, %s)'%(c.first_frame_id, c.last_frame_id),
+                },
+                style='fill:%s;fill-opacity:%0.2f'%(self.speed_color(c.worst), opacity),
+                children=[svg.Element('title', text='%s \u2192 %s %0.3f-%0.3fs: %d events, worst %s, frames %s-%s'%(
+                    src.id, dst.id, b*self.bin_width, (b+1)*self.bin_width,
+                    c.count, c.worst.name, c.first_frame_id, c.last_frame_id,
+                ))],
+            ))
+
+        page_width  = margin_l + self.bins*cell_w + cell_w
+        page_height = margin_t + len(self.pairs)*cell_h + cell_h
+
+        return svg.Document(page_width, page_height, children=[svg.Raw(self.SCRIPT), ticks, labels, rects])
+
+    def generate(self):
+        """ Generate the SVG """
+        return self.document().to_svg()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+""" Minimal streaming reader for pcap and pcapng files.  Only the framing is
+parsed (blocks/records, timestamps and link types), enough to split, index or
+skip through captures without going through tshark. """
+
+from __future__ import print_function
+
+import struct
+import socket
+
+from dsd import compression
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_OPB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+LINKTYPE_ETHERNET  = 1
+LINKTYPE_RAW       = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4      = 228
+
+class CaptureFormatError(Exception):
+    """ The file isn't a pcap or pcapng capture we can read """
+    pass
+
+class Record(object):
+    """ A block (pcapng) or record (pcap) read from a capture file.
+
+    Header records (pcapng section/interface blocks, the pcap global header,
+    and any other non-packet block) have number None.  raw holds the bytes
+    exactly as they are in the file, so records can be copied into another
+    capture of the same format. """
+
+    __slots__ = ('raw', 'offset', 'number', 'time', 'linktype', 'data', 'block_type')
+
+    def __init__(self, raw, offset, number=None, time=None, linktype=None, data=None, block_type=None):
+        self.raw        = raw
+        self.offset     = offset
+        self.number     = number
+        self.time       = time
+        self.linktype   = linktype
+        self.data       = data
+        self.block_type = block_type
+
+    @property
+    def is_packet(self):
+        return self.number is not None
+
+def capture_format(f):
+    """ Peek at the magic number of an open (binary) file: returns 'pcap' or 'pcapng' """
+    if hasattr(f, 'peek'):
+        # Buffered files, including decompressed streams that can't seek
+        magic = f.peek(4)[:4]
+    else:
+        pos = f.tell()
+        magic = f.read(4)
+        f.seek(pos)
+    if len(magic) < 4:
+        raise CaptureFormatError('File too short')
+    if struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+        return 'pcapng'
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4', b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+        return 'pcap'
+    raise CaptureFormatError('Not a pcap or pcapng file')
+
+def iter_records(f, first_number=1):
+    """ Generator of the Records in an open (binary) capture file.  Frame
+    numbers are counted from first_number, like tshark's frame.number """
+
+    fmt = capture_format(f)
+    if fmt == 'pcapng':
+        return _iter_pcapng(f, first_number)
+    return _iter_pcap(f, first_number)
+
+def first_packet_time(filename):
+    """ Time (epoch seconds) of the first packet of a capture file, or None if it has none """
+    with compression.open_input(filename, 'rb') as f:
+        for r in iter_records(f):
+            if r.is_packet and r.time is not None:
+                return r.time
+    return None
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise EOFError()
+    return data
+
+def _iter_pcap(f, number):
+    offset = f.tell()
+    header = _read_exactly(f, 24)
+    magic = header[:4]
+    endian = '<' if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+    nanos = magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')
+    linktype = struct.unpack(endian + 'I', header[20:24])[0] & 0x0FFFFFFF
+    yield Record(header, offset)
+
+    rec_hdr = struct.Struct(endian + 'IIII')
+    divisor = 1e9 if nanos else 1e6
+    while True:
+        offset = f.tell()
+        h = f.read(16)
+        if len(h) < 16:
+            return
+        ts_sec, ts_frac, incl_len, _ = rec_hdr.unpack(h)
+        data = f.read(incl_len)
+        if len(data) < incl_len:
+            return
+        yield Record(h + data, offset, number=number, time=ts_sec + ts_frac/divisor, linktype=linktype, data=data)
+        number += 1
+
+def _tsresol(options, endian):
+    """ Returns (units per second, offset in seconds) from the options of an IDB """
+    units = 1e6
+    tsoffset = 0
+    i = 0
+    while i + 4 <= len(options):
+        code, length = struct.unpack(endian + 'HH', options[i:i+4])
+        value = options[i+4:i+4+length]
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            v = value[0]
+            units = 2.0**(v & 0x7F) if v & 0x80 else 10.0**v
+        elif code == 14 and length >= 8:
+            tsoffset = struct.unpack(endian + 'q', value[:8])[0]
+        i += 4 + length + ((4 - length % 4) % 4)
+    return units, tsoffset
+
+def _iter_pcapng(f, number):
+    endian = '<'
+    interfaces = []
+
+    while True:
+        offset = f.tell()
+        h = f.read(8)
+        if len(h) < 8:
+            return
+
+        block_type = struct.unpack('<I', h[:4])[0]
+        if block_type == PCAPNG_SHB:
+            try:
+                bom = _read_exactly(f, 4)
+                endian = '<' if struct.unpack('<I', bom)[0] == 0x1A2B3C4D else '>'
+                length = struct.unpack(endian + 'I', h[4:8])[0]
+                raw = h + bom + _read_exactly(f, length - 12)
+            except EOFError:
+                return
+            interfaces = []
+            yield Record(raw, offset, block_type=block_type)
+            continue
+
+        block_type, length = struct.unpack(endian + 'II', h)
+        if length < 12:
+            raise CaptureFormatError('Corrupt block at offset %d'%offset)
+        try:
+            raw = h + _read_exactly(f, length - 8)
+        except EOFError:
+            # Truncated block at the end of a file still being written
+            return
+        body = raw[8:-4]
+
+        if block_type == PCAPNG_IDB:
+            linktype = struct.unpack(endian + 'H', body[:2])[0]
+            units, tsoffset = _tsresol(body[8:], endian)
+            interfaces.append((linktype, units, tsoffset))
+            yield Record(raw, offset, block_type=block_type)
+
+        elif block_type in (PCAPNG_EPB, PCAPNG_OPB):
+            if block_type == PCAPNG_EPB:
+                if_id, ts_hi, ts_lo, cap_len, _ = struct.unpack(endian + 'IIIII', body[:20])
+            else:
+                if_id, _, ts_hi, ts_lo, cap_len, _ = struct.unpack(endian + 'HHIIII', body[:20])
+            linktype, units, tsoffset = interfaces[if_id]
+            ts = ((ts_hi << 32) | ts_lo) / units + tsoffset
+            yield Record(raw, offset, number=number, time=ts, linktype=linktype, data=body[20:20+cap_len], block_type=block_type)
+            number += 1
+
+        elif block_type == PCAPNG_SPB:
+            linktype, _, _ = interfaces[0]
+            orig_len = struct.unpack(endian + 'I', body[:4])[0]
+            yield Record(raw, offset, number=number, linktype=linktype, data=body[4:4+orig_len], block_type=block_type)
+            number += 1
+
+        else:
+            yield Record(raw, offset, block_type=block_type)
+
+def _ipv4(linktype, data):
+    """ The IPv4 part of a packet, or None """
+
+    if data is None:
+        return None
+
+    if linktype == LINKTYPE_ETHERNET:
+        i = 12
+        ethertype = struct.unpack('!H', data[i:i+2])[0] if len(data) >= 14 else None
+        # Skip VLAN tags
+        while ethertype in (0x8100, 0x88A8) and len(data) >= i + 6:
+            i += 4
+            ethertype = struct.unpack('!H', data[i:i+2])[0]
+        if ethertype != 0x0800:
+            return None
+        ip = data[i+2:]
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        ip = data
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16 or struct.unpack('!H', data[14:16])[0] != 0x0800:
+            return None
+        ip = data[16:]
+    else:
+        return None
+
+    if len(ip) < 20 or (ip[0] >> 4) != 4:
+        return None
+    return ip
+
+def packet_ips(linktype, data):
+    """ Source and destination IPv4 addresses (as strings) of a packet, or None if it isn't IPv4 """
+    ip = _ipv4(linktype, data)
+    if ip is None:
+        return None
+    return socket.inet_ntoa(ip[12:16]), socket.inet_ntoa(ip[16:20])
+
+def packet_flow(linktype, data):
+    """ (src ip, dst ip, protocol, src port, dst port) of an IPv4 packet, or
+    None.  Ports are None for protocols other than TCP and UDP. """
+    ip = _ipv4(linktype, data)
+    if ip is None:
+        return None
+
+    proto = ip[9]
+    sport = dport = None
+    ihl = (ip[0] & 0x0F) * 4
+    if proto in (6, 17) and len(ip) >= ihl + 4:
+        sport, dport = struct.unpack('!HH', ip[ihl:ihl+4])
+
+    return socket.inet_ntoa(ip[12:16]), socket.inet_ntoa(ip[16:20]), proto, sport, dport
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
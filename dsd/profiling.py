@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import time
+import _thread
+import resource
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+MB = 1 << 20
+
+def parse_size(value):
+    """ Used by argparse for sizes such as 512M or 2G (K, M, G and T are
+    powers of 1024, a plain number is in bytes) """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    v = value.strip().upper().rstrip('B')
+    try:
+        if v and v[-1] in units:
+            return int(float(v[:-1]) * units[v[-1]])
+        return int(v)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected a size like 512M or 2G, got %s'%value)
+
+def current_rss():
+    """ Resident set size of this process in bytes, or its peak so far where
+    the current value isn't available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return max_rss()
+
+def max_rss():
+    """ Peak resident set size of this process in bytes """
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return r if sys.platform == 'darwin' else r * 1024
+
+class MemoryBudgetExceeded(MemoryError):
+    """ Raised in the main thread when the process grows past --memory-budget """
+    pass
+
+class StageTiming(object):
+    """ Accumulated timings for one pipeline stage """
+
+    def __init__(self, name):
+        self.name      = name
+        self.calls     = 0
+        self.wall      = 0.0
+        self.cpu       = 0.0
+        self.child_cpu = 0.0
+
+        """ Peak traced (tracemalloc) memory during the stage, and the peak
+        RSS of the process at the end of it, in bytes (memory reports only) """
+        self.peak_traced = 0
+        self.max_rss     = 0
+
+    def to_json(self):
+        return {
+            'name':       self.name,
+            'calls':      self.calls,
+            'wall':       self.wall,
+            'cpu':        self.cpu,
+            'childCpu':   self.child_cpu,
+            'peakTraced': self.peak_traced,
+            'maxRss':     self.max_rss,
+        }
+
+""" The MemoryWatchdog that interrupted the main thread, if any """
+_interrupted_by = None
+
+def memory_budget_exceeded():
+    """ The MemoryBudgetExceeded to raise if the memory budget was exceeded,
+    or None.  The watchdog interrupts the main thread through the SIGINT
+    handler, so handlers that don't raise KeyboardInterrupt (e.g. the one of
+    dsd.progress) have to check this first. """
+    if _interrupted_by is None:
+        return None
+    return _interrupted_by.error()
+
+class MemoryWatchdog(threading.Thread):
+    """ Polls the RSS of the process and interrupts the main thread once it
+    is over budget, so the run stops with a diagnostic before the machine
+    starts swapping """
+
+    def __init__(self, profiler, budget, interval=0.1):
+        super(MemoryWatchdog, self).__init__(daemon=True)
+        self.profiler = profiler
+        self.budget   = budget
+        self.interval = interval
+        self.rss      = None
+        self.stage    = None
+
+        """ Set once the budget has been exceeded """
+        self.exceeded = threading.Event()
+
+    def run(self):
+        global _interrupted_by
+        while not self.exceeded.is_set():
+            rss = current_rss()
+            if rss > self.budget:
+                self.rss = rss
+                self.stage = '.'.join(self.profiler._stack) or '(none)'
+                self.exceeded.set()
+                print('Memory budget exceeded: RSS %0.1f MB > %0.1f MB in stage %s'%(
+                    rss/MB, self.budget/MB, self.stage
+                ), file=sys.stderr)
+                _interrupted_by = self
+                _thread.interrupt_main()
+                return
+            time.sleep(self.interval)
+
+    def error(self):
+        return MemoryBudgetExceeded('RSS %0.1f MB is over the memory budget of %0.1f MB (in stage %s)'%(
+            self.rss/MB, self.budget/MB, self.stage
+        ))
+
+class Profiler(object):
+    """ Collects wall/CPU time per pipeline stage and a few counters.
+
+    Stages can be nested, a nested stage is reported as "outer.inner" and its
+    time is also included in the outer stage.  "childCpu" is the CPU time of
+    child processes (i.e. tshark) that were reaped during the stage.
+
+    If cprofile_dir is provided, every top level stage is also run under
+    cProfile and dumped to <cprofile_dir>/<stage>.prof
+
+    With memory set, allocations are traced with tracemalloc (which slows
+    everything down) to report the peak traced memory of each stage, the
+    peak RSS of the process at the end of it, and the allocation sites
+    holding the most memory at the end of the hungriest top level stage.  With a memory_budget (bytes), the run is
+    interrupted with MemoryBudgetExceeded once the RSS goes over it. """
+
+    """ Number of allocation sites in the memory report """
+    TOP_ALLOCATIONS = 10
+
+    def __init__(self, cprofile_dir=None, memory=False, memory_budget=None, report=True):
+        self.cprofile_dir  = cprofile_dir
+        self.memory        = memory
+        self.memory_budget = memory_budget
+        self.stages        = {}
+        self.counters      = {}
+        self._stack        = []
+        self._start        = time.perf_counter()
+
+        """ Whether report() prints anything (not when only a budget was set) """
+        self.reporting = report
+
+        """ Peaks of nested stages, carried over to the enclosing stages as
+        each stage resets tracemalloc's peak """
+        self._carried_peaks = []
+
+        """ (stage, traced bytes, snapshot) of the hungriest top level stage """
+        self._snapshot = None
+
+        if cprofile_dir and not os.path.isdir(cprofile_dir):
+            os.makedirs(cprofile_dir)
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.watchdog = None
+        if memory_budget:
+            self.watchdog = MemoryWatchdog(self, memory_budget)
+            self.watchdog.start()
+
+    @classmethod
+    def from_args(cls, args):
+        """ Build a profiler from the --profile and --memory-* options, or return None if none were given """
+        report = args.profile_outfile is not None or args.profile_dump_dir is not None or args.memory_report
+        if not report and args.memory_budget is None:
+            return None
+        return cls(cprofile_dir=args.profile_dump_dir, memory=args.memory_report, memory_budget=args.memory_budget, report=report)
+
+    @staticmethod
+    def _child_cpu():
+        r = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return r.ru_utime + r.ru_stime
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager timing everything in its block as stage 'name' """
+
+        self._stack.append(name)
+        full_name = '.'.join(self._stack)
+        st = self.stages.get(full_name)
+        if st is None:
+            st = self.stages[full_name] = StageTiming(full_name)
+
+        prof = None
+        if self.cprofile_dir and len(self._stack) == 1:
+            prof = cProfile.Profile()
+
+        if self.memory:
+            # Peak of the enclosing stage so far, before it's reset for this one
+            self._carried_peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        wall0  = time.perf_counter()
+        cpu0   = time.process_time()
+        child0 = self._child_cpu()
+        if prof: prof.enable()
+        try:
+            yield st
+        except KeyboardInterrupt:
+            if self.watchdog is not None and self.watchdog.exceeded.is_set():
+                raise self.watchdog.error() from None
+            raise
+        finally:
+            if prof: prof.disable()
+            st.calls     += 1
+            st.wall      += time.perf_counter() - wall0
+            st.cpu       += time.process_time() - cpu0
+            st.child_cpu += self._child_cpu() - child0
+
+            if self.memory:
+                self._end_stage_memory(st)
+            elif self.watchdog is not None:
+                st.max_rss = max_rss()
+            self._stack.pop()
+
+            if prof:
+                prof.dump_stats(os.path.join(self.cprofile_dir, '%s.prof'%full_name))
+
+    def _end_stage_memory(self, st):
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, self._carried_peaks.pop())
+        st.peak_traced = max(st.peak_traced, peak)
+        st.max_rss = max_rss()
+
+        if self._carried_peaks:
+            # The enclosing stage's peak includes this one's
+            self._carried_peaks[-1] = max(self._carried_peaks[-1], peak)
+        elif self._snapshot is None or current > self._snapshot[1]:
+            self._snapshot = (st.name, current, tracemalloc.take_snapshot())
+
+    def add_time(self, name, wall, calls=1):
+        """ Account time measured by the caller (for hot loops where a context manager per iteration is too expensive) """
+        name = '.'.join(self._stack + [name])
+        st = self.stages.get(name)
+        if st is None:
+            st = self.stages[name] = StageTiming(name)
+        st.calls += calls
+        st.wall  += wall
+
+    def count(self, name, n=1):
+        """ Increment counter 'name' by n """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def top_allocations(self):
+        """ [(site, bytes, count)] of the allocation sites holding the most
+        memory at the end of the hungriest top level stage """
+        if self._snapshot is None:
+            return []
+        stats = self._snapshot[2].statistics('lineno')[:self.TOP_ALLOCATIONS]
+        return [('%s:%d'%(s.traceback[0].filename, s.traceback[0].lineno), s.size, s.count) for s in stats]
+
+    def to_json(self):
+        data = {
+            'total':    time.perf_counter() - self._start,
+            'stages':   [s.to_json() for s in self.stages.values()],
+            'counters': self.counters,
+        }
+        if self.memory or self.memory_budget:
+            data['maxRss'] = max_rss()
+            data['memoryBudget'] = self.memory_budget
+        if self.memory:
+            data['topAllocationsStage'] = self._snapshot[0] if self._snapshot else None
+            data['topAllocations'] = [{'site': site, 'size': size, 'count': count} for site, size, count in self.top_allocations()]
+        return data
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f, indent=4)
+
+    def report_table(self):
+        """ Human readable summary of the stages and counters """
+
+        width = max([len(s) for s in self.stages] + [len(c) for c in self.counters] + [5])
+
+        lines = []
+        header = '%-*s %6s %10s %10s %10s'%(width, 'Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Child (s)')
+        if self.memory:
+            # ru_maxrss is the peak of the process so far, not of the stage
+            header += ' %10s %13s'%('Peak (MB)', 'Peak RSS (MB)')
+        lines.append(header)
+        for s in self.stages.values():
+            line = '%-*s %6d %10.3f %10.3f %10.3f'%(width, s.name, s.calls, s.wall, s.cpu, s.child_cpu)
+            if self.memory:
+                line += ' %10.1f %13.1f'%(s.peak_traced/MB, s.max_rss/MB)
+            lines.append(line)
+        lines.append('%-*s %6s %10.3f'%(width, 'total', '', time.perf_counter() - self._start))
+
+        if self.memory and self._snapshot is not None:
+            lines.append('')
+            lines.append('Top allocations at the end of %s (MB, blocks):'%self._snapshot[0])
+            for site, size, count in self.top_allocations():
+                lines.append('  %8.2f %9d  %s'%(size/MB, count, site))
+
+        if self.counters:
+            lines.append('')
+            lines.append('%-*s %10s'%(width, 'Counter', 'Value'))
+            for k,v in self.counters.items():
+                lines.append('%-*s %10d'%(width, k, v))
+
+        return '\n'.join(lines)
+
+    def report(self, filename=None, file=sys.stderr):
+        """ Print the table, and write the JSON report if a filename is provided """
+        if self.reporting:
+            print(self.report_table(), file=file)
+        if filename:
+            self.write_json(filename)
+
+@contextlib.contextmanager
+def stage(profiler, name):
+    """ profiler.stage(name) if there is a profiler, otherwise do nothing """
+    if profiler is None:
+        yield None
+    else:
+        with profiler.stage(name) as st:
+            yield st
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+""" Progress of capture queries: a bar on stderr and/or a stream of JSON
+lines with the frames read, the frame rate, the events found, the requests
+still waiting for their ACK, and an ETA.
+
+tshark only hands over the packets that pass the display filter, so the
+frames read are taken from the frame numbers of those packets (tshark counts
+every frame it reads), and the total from the frame indexes the captures
+already have (see dsd.frameindex) or the frame range asked for.
+
+Progress also turns SIGINT and SIGTERM into a request to stop, which the
+capture loops check between packets: the query then ends as if the capture
+had, with the events found so far, so they can still be written out and
+drawn.  A second signal interrupts right away. """
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import signal
+import contextlib
+
+from dsd.profiling import memory_budget_exceeded
+
+def _capture_frames(capture, from_frame=None, to_frame=None):
+    """ Number of frames tshark will read from a capture (or a capture set,
+    given as a list of files, see dsd.captureset) for a frame range, or None
+    if it isn't known.  Only frame indexes that already exist are used:
+    building one is a pass over the whole capture, too much for a progress
+    bar.  Without them, the size of the frame range is the best guess. """
+
+    # Imported here, it pulls in pyshark
+    from dsd.frameindex import load_frame_index
+
+    frames = 0
+    for f in [capture] if isinstance(capture, str) else capture:
+        index = load_frame_index(f, build=False)
+        if index is None:
+            frames = None
+            break
+        frames += index.frames
+
+    if frames is None:
+        if not to_frame:
+            return None
+        last = to_frame
+    else:
+        last = min(to_frame, frames) if to_frame else frames
+    return max(last - (from_frame or 1) + 1, 0)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d'%(seconds//3600, seconds//60%60, seconds%60)
+
+class Progress(object):
+    """ Tracks a query, see the module docstring.
+
+    total_frames is the number of frames that will be read, for the ETA,
+    or None if it isn't known (e.g. captures not indexed yet, or time
+    windows).
+    The bar is written to bar_file (e.g. sys.stderr) and the JSON lines to
+    json_file, each at most every interval seconds; either can be None. """
+
+    def __init__(self, total_frames=None, bar_file=None, json_file=None, interval=1.0):
+        self.total_frames = total_frames
+        self.bar_file     = bar_file
+        self.json_file    = json_file
+        self.interval     = interval
+
+        """ Frames read from each capture opened (see start_capture), i.e.
+        the number of the last packet tshark returned.  Captures read at
+        the same time (merged taps) each have their own. """
+        self.captures = []
+
+        """ EventMatchers of the captures being read, for the event counts """
+        self.matchers = []
+
+        """ Signal that asked the query to stop, or None """
+        self.stop_signal = None
+
+        """ Whether the query ran to the end (see finish) """
+        self.complete = False
+
+        self._start       = time.monotonic()
+        self._last_report = self._start
+        self._bar_width   = 0
+
+    @classmethod
+    def from_args(cls, args, captures):
+        """ The Progress the command line asked for (see
+        loaddata.add_progress_args), for captures (file names, or lists of
+        the files of capture sets).  The bar is shown by default when stderr
+        is a terminal and --verbose isn't printing every event. """
+
+        bar = args.progress
+        if bar is None:
+            bar = sys.stderr.isatty() and not args.verbose
+
+        json_file = None
+        if args.progress_json == '-':
+            json_file = sys.stdout
+        elif args.progress_json:
+            json_file = open(args.progress_json, 'w')
+
+        # Time windows are found by tshark, so their size isn't known
+        total = None
+        if (bar or json_file is not None) and args.from_time is None and args.to_time is None:
+            try:
+                totals = [_capture_frames(c, args.from_frame, args.to_frame) for c in captures]
+                if None not in totals:
+                    total = sum(totals)
+            except OSError:
+                pass
+
+        return cls(total_frames=total, bar_file=sys.stderr if bar else None, json_file=json_file, interval=args.progress_interval)
+
+    @property
+    def stop_requested(self):
+        return self.stop_signal is not None
+
+    @contextlib.contextmanager
+    def handle_signals(self, raise_interrupt=False):
+        """ Within the block, SIGINT and SIGTERM ask the query to stop (see
+        stop_requested), or raise KeyboardInterrupt with raise_interrupt """
+
+        def handler(signum, frame):
+            # The memory watchdog interrupts the main thread through SIGINT
+            error = memory_budget_exceeded()
+            if error is not None:
+                raise error
+            first = self.stop_signal is None
+            self.stop_signal = signum
+            if raise_interrupt or not first:
+                raise KeyboardInterrupt()
+            print('\nStopping, press Ctrl-C again to abort without writing anything', file=sys.stderr)
+
+        previous = {s: signal.signal(s, handler) for s in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            yield self
+        finally:
+            for s, h in previous.items():
+                signal.signal(s, h)
+
+    def start_capture(self, matcher):
+        """ Called when tshark is started on a capture, with the EventMatcher
+        reading it (the same one for every file of a capture set).  Returns
+        the number of the capture, to pass to packet. """
+        if matcher not in self.matchers:
+            self.matchers.append(matcher)
+        self.captures.append(0)
+        return len(self.captures) - 1
+
+    @property
+    def frames(self):
+        # Once done, tshark has also read the frames after the last packet
+        # it returned
+        if self.complete and self.total_frames:
+            return max(sum(self.captures), self.total_frames)
+        return sum(self.captures)
+
+    def packet(self, p, capture=0):
+        """ Count the frames read by tshark up to packet p of a capture (see
+        start_capture), and report if it's time to """
+        self.captures[capture] = max(self.captures[capture], int(p.number))
+
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report(now)
+
+    def status(self, now=None):
+        """ The current figures, as a dict (the JSON lines) """
+
+        elapsed = (now or time.monotonic()) - self._start
+        frames = self.frames
+        rate = frames/elapsed if elapsed > 0 else None
+
+        eta = None
+        if self.total_frames and rate:
+            eta = max(self.total_frames - frames, 0)/rate
+
+        return {
+            'elapsed':          elapsed,
+            'frames':           frames,
+            'totalFrames':      self.total_frames,
+            'framesPerSecond':  rate,
+            'events':           sum(m.n_events for m in self.matchers),
+            'pendingAcks':      sum(len(m.pending) for m in self.matchers),
+            'eta':              eta,
+        }
+
+    def report(self, now=None, done=False):
+        s = self.status(now)
+        if self.json_file is not None:
+            s['done'] = done
+            print(json.dumps(s), file=self.json_file)
+            self.json_file.flush()
+        if self.bar_file is not None:
+            self._write_bar(s, done)
+
+    def _write_bar(self, s, done):
+        parts = []
+        if s['totalFrames']:
+            # Frames are only counted up to the last packet that passed the
+            # display filter, and reads past a frame range for the ACKs
+            fraction = min(s['frames']/float(s['totalFrames']), 1.0)
+            filled = int(fraction*20)
+            parts.append('[%s%s] %3.0f%%'%('#'*filled, '.'*(20 - filled), fraction*100))
+            parts.append('%d/%d frames'%(s['frames'], s['totalFrames']))
+        else:
+            parts.append('%d frames'%s['frames'])
+        if s['framesPerSecond'] is not None:
+            parts.append('%0.0f frames/s'%s['framesPerSecond'])
+        parts.append('%d events'%s['events'])
+        parts.append('%d pending ACKs'%s['pendingAcks'])
+        if done:
+            parts.append('in %s'%format_duration(s['elapsed']))
+        elif s['eta'] is not None:
+            parts.append('ETA %s'%format_duration(s['eta']))
+
+        line = '  '.join(parts)
+        pad = ' '*max(self._bar_width - len(line), 0)
+        self._bar_width = len(line)
+        self.bar_file.write('\r' + line + pad + ('\n' if done else ''))
+        self.bar_file.flush()
+
+    def finish(self):
+        """ Final report, once the query is over """
+        self.complete = not self.stop_requested
+        self.report(done=True)
+        if self.json_file not in (None, sys.stdout):
+            self.json_file.close()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
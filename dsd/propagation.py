@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+""" Propagation latency of events relayed from host to host, e.g. a
+StartCall sent App2A->Admin2A and then forwarded Admin2A->MIS2A.
+
+The events don't carry a call identifier, so the hops are joined on the
+event type and on time.  The events are hash partitioned on (source,
+destination, event type), and each partition B->C is merge joined, in time
+order, with every partition A->B of the same event type: each B->C event is
+matched with the oldest A->B event not yet forwarded to C that arrived at
+most a window earlier (first in, first out).  This is linear in the number
+of events (up to the log of the number of partitions merged), where
+comparing every pair of events would be quadratic.
+
+The matched hops are chained into paths (App2A->Admin2A->MIS2A), and the
+latency of every hop and every path end to end is counted in the quantile
+sketches of dsd.ackstats. """
+
+from __future__ import print_function
+
+import os
+import csv
+import heapq
+import json
+import datetime
+import collections
+
+import dsd.svgobjs as svg
+import dsd.solaobjs as so
+from dsd import compression
+from dsd.ackstats import QuantileSketch, QUANTILES, quantile_name
+
+class Hop(object):
+    """ An event (upstream) and the event it was forwarded as (downstream) """
+
+    __slots__ = ('upstream', 'downstream')
+
+    def __init__(self, upstream, downstream):
+        self.upstream   = upstream
+        self.downstream = downstream
+
+    @property
+    def latency(self):
+        """ Time (s) the event spent in the intermediate host """
+        return (self.downstream.time - self.upstream.time).total_seconds()
+
+def partition_events(events):
+    """ Dict of (src id, dst id, event type name) -> the events of that
+    partition, in the order of events """
+    partitions = collections.defaultdict(list)
+    for e in events:
+        partitions[(e.src.id, e.dst.id, e.event_type.name)].append(e)
+    return partitions
+
+def join_hops(events, window):
+    """ Hops between the events (sorted by time, e.g. by
+    Event.sort_and_process), see the module docstring.  window is the
+    longest an event may spend in a host (s).
+
+    An event can be forwarded to several hosts, but each event is the
+    downstream of at most one hop.  Events sent back to the host they came
+    from (A->B then B->A) are replies, not hops. """
+
+    window = datetime.timedelta(seconds=float(window))
+    partitions = partition_events(events)
+
+    """ (dst id, event type name) -> keys of the partitions arriving there """
+    incoming = collections.defaultdict(list)
+    for key in partitions:
+        incoming[(key[1], key[2])].append(key)
+
+    hops = []
+    for (b, c, event_type), downstream in partitions.items():
+        upstream_keys = [k for k in incoming.get((b, event_type), []) if k[0] != c]
+        if not upstream_keys:
+            continue
+
+        upstream = heapq.merge(*[partitions[k] for k in upstream_keys], key=lambda e: e.time)
+        next_up = next(upstream, None)
+        pending = collections.deque()
+        for d in downstream:
+            while next_up is not None and next_up.time <= d.time:
+                pending.append(next_up)
+                next_up = next(upstream, None)
+            while pending and d.time - pending[0].time > window:
+                pending.popleft()
+            if pending:
+                hops.append(Hop(pending.popleft(), d))
+
+    hops.sort(key=lambda h: h.upstream.time)
+    return hops
+
+def propagation_paths(hops):
+    """ The hops chained into paths, as lists of events from the first host
+    to the last.  An event forwarded to several hosts starts one path per
+    host it reaches last. """
+
+    forward = collections.defaultdict(list)
+    forwarded = set()
+    for h in hops:
+        forward[id(h.upstream)].append(h.downstream)
+        forwarded.add(id(h.downstream))
+
+    paths = []
+    seen = set()
+    for h in hops:
+        start = h.upstream
+        if id(start) in forwarded or id(start) in seen:
+            continue
+        seen.add(id(start))
+
+        stack = [[start]]
+        while stack:
+            path = stack.pop()
+            nexts = [d for d in forward.get(id(path[-1]), []) if d not in path]
+            if not nexts:
+                paths.append(path)
+            for d in reversed(nexts):
+                stack.append(path + [d])
+    return paths
+
+def path_hosts(path):
+    """ Host ids along a path """
+    return tuple([path[0].src.id] + [e.dst.id for e in path])
+
+class PropagationStats(object):
+    """ Latency distributions of the hops (src, via, dst, event type) and of
+    the paths end to end (hosts, event type) """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+
+        """ Dict of (host ids, event type name) -> QuantileSketch """
+        self.hops  = {}
+        self.paths = {}
+
+    def _sketch(self, groups, key):
+        s = groups.get(key)
+        if s is None:
+            s = groups[key] = QuantileSketch(relative_accuracy=self.relative_accuracy)
+        return s
+
+    def add_hops(self, hops):
+        for h in hops:
+            key = ((h.upstream.src.id, h.upstream.dst.id, h.downstream.dst.id), h.upstream.event_type.name)
+            self._sketch(self.hops, key).add(h.latency)
+        return self
+
+    def add_paths(self, paths):
+        for p in paths:
+            key = (path_hosts(p), p[0].event_type.name)
+            self._sketch(self.paths, key).add((p[-1].time - p[0].time).total_seconds())
+        return self
+
+    def rows(self):
+        """ One dict per hop, then one per path, as written to the reports.
+        Times are in seconds. """
+
+        rows = []
+        for kind, groups in (('hop', self.hops), ('path', self.paths)):
+            for (hosts, event_type), s in sorted(groups.items()):
+                row = {
+                    'kind':      kind,
+                    'hosts':     '>'.join(hosts),
+                    'eventType': event_type,
+                    'events':    s.count,
+                    'min':       s.min,
+                    'mean':      s.mean,
+                    'max':       s.max,
+                }
+                for q in QUANTILES:
+                    row[quantile_name(q)] = s.quantile(q)
+                rows.append(row)
+        return rows
+
+def write_propagation_stats(filename, stats):
+    """ Write the report of a PropagationStats, as CSV if filename ends in
+    .csv and JSON otherwise (like dsd.ackstats.write_ack_stats) """
+
+    rows = stats.rows()
+    if os.path.splitext(compression.strip_suffix(filename))[1].lower() == '.csv':
+        fields = ['kind', 'hosts', 'eventType', 'events', 'min', 'mean'] + [quantile_name(q) for q in QUANTILES] + ['max']
+        with compression.open_output(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({k: ('' if v is None else v) for k, v in row.items()})
+    else:
+        with compression.open_output(filename, 'w') as f:
+            json.dump({
+                'relativeAccuracy': stats.relative_accuracy,
+                'groups':           rows,
+            }, f, indent=4)
+
+class PropagationAnnotations(object):
+    """ Overlay of the paths on a Diagram (see Diagram.annotations): a
+    dashed line down the lifeline of every intermediate host labelled with
+    the time spent there, and for events relayed more than once the end to
+    end latency after the last arrow.
+
+    Paths with events that aren't drawn (e.g. left out by --anomalies-only
+    or folded into a burst) are skipped. """
+
+    def __init__(self, paths, settings):
+        self.paths    = paths
+        self.settings = settings
+
+    def to_elements(self, events):
+        """ The annotations of the paths drawn among events, laid out """
+
+        drawn = set(id(e) for e in events)
+        color = self.settings.propagation_color
+
+        label_style = 'font-size:2.5px;font-family:Sans;fill:%s'%color
+        elements = []
+        for i, path in enumerate(self.paths):
+            if not all(id(e) in drawn for e in path):
+                continue
+
+            id_prefix = 'propagation-%d'%i
+            group = svg.G(attrs={'id': '%s-group'%id_prefix})
+            for j, (u, d) in enumerate(zip(path, path[1:])):
+                x = u.dst.display_options.abs_center
+                y0, y1 = u.display_options.y, d.display_options.y
+                group.append(svg.Path(
+                    attrs={'id': '%s-hop-%d'%(id_prefix, j), 'd': 'M %s,%s V %s'%(x, y0, y1)},
+                    style='fill:none;stroke:%s;stroke-width:0.30;stroke-dasharray:0.8,0.8;stroke-opacity:1'%color,
+                ))
+                group.append(svg.Text(
+                    attrs={'id': '%s-hop-%d-label'%(id_prefix, j), 'x': x + 1, 'y': (y0 + y1)/2.0 + 0.8},
+                    style=label_style,
+                    children=['+' + so.format_ack_time((d.time - u.time).total_seconds())],
+                ))
+
+            # With a single hop the end to end latency is the hop's
+            last = path[-1]
+            if len(path) > 2:
+                group.append(svg.Text(
+                    attrs={'id': '%s-total-label'%id_prefix, 'x': last.dst.display_options.abs_center + 2, 'y': last.display_options.y + 0.8},
+                    style=label_style,
+                    children=['%s end to end'%so.format_ack_time((last.time - path[0].time).total_seconds())],
+                ))
+            elements.append(group)
+        return elements
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
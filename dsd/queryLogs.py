@@ -2,8 +2,29 @@
 
 from __future__ import print_function
 
+import os
+import sys
+import argparse
+
 import dsd.loaddata as ld
 from dsd.solaobjs import Diagram
+from dsd.minimap import Minimap
+from dsd.ackstats import AckStats, write_ack_stats
+from dsd.propagation import join_hops, propagation_paths, PropagationStats, PropagationAnnotations, write_propagation_stats
+from dsd.profiling import Profiler, stage
+from dsd.progress import Progress
+from dsd import compression
+from dsd.shards import find_shard_manifest, select_shards, load_frame_map
+from dsd.captureset import expand_capture_set, is_pattern
+
+def parse_clock_offset(value):
+    """ Used by argparse for --clock-offset: a float, or 'auto' (None) """
+    if value == 'auto':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected a number of seconds or "auto", got %s'%value)
 
 def main():
     """ Loads all the data and prepares the SVG """
@@ -19,11 +40,21 @@ def main():
     )
     parser.add_argument(
         '-i', '--capture-file',
-        metavar='EVENTS',
-        dest='capture_filename',
+        metavar='CAPTURE',
+        dest='capture_filenames',
         action='store',
+        nargs='+',
         required=True,
-        help='List of events to query'
+        help='Capture file(s) to query.  A glob or a file name prefix (quoted) selects a capture set, e.g. the files of a dumpcap ring buffer, read in time order as one capture.  Several captures of the same traffic (e.g. from different taps) are merged into one stream of events'
+    )
+    parser.add_argument(
+        '--clock-offset',
+        metavar='SECONDS',
+        dest='clock_offsets',
+        nargs='+',
+        type=parse_clock_offset,
+        default=None,
+        help='With several capture files, the offset (s) to add to the times of each capture, or "auto" to estimate it against the first capture.  Defaults to auto'
     )
     parser.add_argument(
         '-e', '--events',
@@ -61,50 +92,272 @@ def main():
         type=int,
         help='To frame'
     )
+    parser.add_argument(
+        '--no-shards',
+        dest='use_shards',
+        action='store_false',
+        help='Query the capture file itself even if shardCapture has split it'
+    )
+    parser.add_argument(
+        '--follow',
+        dest='follow',
+        action='store_true',
+        help='Keep reading the capture file as it grows (e.g. while dumpcap is running) and extend the SVG as events arrive, until interrupted.  Requires --output-svg'
+    )
+    parser.add_argument(
+        '--follow-poll',
+        dest='follow_poll',
+        metavar='SECONDS',
+        type=float,
+        default=0.5,
+        help='With --follow, how often to check the capture file for new data'
+    )
+    ld.add_time_window_args(parser)
+    ld.add_minimap_args(parser)
+    ld.add_anomaly_args(parser)
+    ld.add_burst_args(parser)
+    ld.add_ack_stats_args(parser)
+    ld.add_propagation_args(parser)
+    ld.add_progress_args(parser)
 
     args = parser.parse_args()
 
-    all_hosts, event_types, settings = ld.read_config(args.config)
-
-    # Match the user entered hosts to the configured hosts
-    hosts=ld.match_hosts(all_hosts, args.hosts)
-
-    if not len(hosts):
-        print('No matched hosts')
-        return
-    else:
-        if args.verbose:
-            print('Examining events between %s'%(' '.join([str(x) for x in hosts])))
-
-    events = ld.query_logs(
-        capture_filename=args.capture_filename,
-        hosts=hosts,
-        event_type_names=args.events,
-        event_types=event_types,
-        from_frame=args.from_frame,
-        to_frame=args.to_frame,
-        settings=settings,
-        verbose=args.verbose
-    )
+    if args.follow and not args.svg_outfile:
+        parser.error('--follow requires --output-svg')
+    if args.follow and (len(args.capture_filenames) > 1 or is_pattern(args.capture_filenames[0])):
+        parser.error('--follow only supports a single capture file')
+    if args.follow and compression.output_compression(args.svg_outfile):
+        parser.error('--follow cannot write a compressed SVG, it updates the file in place')
+    if args.follow and os.path.isfile(args.capture_filenames[0]) and compression.is_compressed(args.capture_filenames[0]):
+        parser.error('--follow cannot read a compressed capture')
+    if args.clock_offsets is not None and len(args.clock_offsets) != len(args.capture_filenames):
+        parser.error('--clock-offset needs one value per capture file')
+    if args.follow:
+        # follow_logs only draws the diagram and writes the events
+        unsupported = [
+            ('--from-time',               args.from_time is not None),
+            ('--to-time',                 args.to_time is not None),
+            ('--from-frame',              args.from_frame is not None),
+            ('--to-frame',                args.to_frame is not None),
+            ('--minimap-svg',             args.minimap_outfile),
+            ('--anomalies-only',          args.anomalies_only),
+            ('--coalesce-bursts',         args.coalesce_bursts),
+            ('--ack-stats',               args.ack_stats_outfile),
+            ('--ack-stats-table',         args.ack_stats_table),
+            ('--propagation',             args.propagation_outfile),
+            ('--propagation-annotations', args.propagation_annotations),
+            ('--no-shards',               not args.use_shards),
+            ('--progress',                args.progress),
+            ('--progress-json',           args.progress_json),
+            ('--progress-interval',       args.progress_interval != 1.0),
+        ]
+        given = [option for option, value in unsupported if value]
+        if given:
+            parser.error('--follow cannot be combined with %s'%', '.join(given))
+
+    profiler = Profiler.from_args(args)
+    try:
+        with stage(profiler, 'read_config'):
+            all_hosts, event_types, settings = ld.read_config(args.config)
+
+        # Match the user entered hosts to the configured hosts
+        hosts=ld.match_hosts(all_hosts, args.hosts)
+
+        if not len(hosts):
+            print('No matched hosts')
+            return
+        else:
+            if args.verbose:
+                print('Examining events between %s'%(' '.join([str(x) for x in hosts])))
+
+        if args.follow:
+            from dsd.follow import follow_logs
+            # follow_logs stops on KeyboardInterrupt, make SIGTERM stop it too
+            with stage(profiler, 'follow_logs'), Progress().handle_signals(raise_interrupt=True):
+                events = follow_logs(
+                    capture_filename=args.capture_filenames[0],
+                    hosts=hosts,
+                    all_hosts=all_hosts,
+                    event_type_names=args.events,
+                    event_types=event_types,
+                    svg_filename=args.svg_outfile,
+                    settings=settings,
+                    inkscape=args.inkscape,
+                    poll_interval=args.follow_poll,
+                    verbose=args.verbose,
+                    profiler=profiler,
+                )
+
+            if args.events_outfile:
+                with stage(profiler, 'write_events'):
+                    ld.write_events(filename=args.events_outfile, events=events)
+            return
+
+        # Each capture is a file, or the list of files of a capture set
+        captures = []
+        for spec in args.capture_filenames:
+            files = expand_capture_set(spec)
+            if not files:
+                print('No capture files match %s'%spec, file=sys.stderr)
+                sys.exit(1)
+            captures.append(files[0] if len(files) == 1 else files)
+
+        # Relative times are counted from the first packet of the (first) capture
+        from_time, to_time = args.from_time, args.to_time
+        if isinstance(from_time, float) or isinstance(to_time, float):
+            start = ld.capture_start_time(captures[0])
+            if start is None:
+                print('No packets in %s'%args.capture_filenames[0])
+                return
+            from_time = ld.resolve_time(from_time, start)
+            to_time   = ld.resolve_time(to_time, start)
+
+        # Shards written by shardCapture.  Their frames are numbered from 1
+        # in each shard, so frame ranges are read from the capture itself
+        # (through its frame index), and the frame ids of the events found
+        # in shards are mapped back to those of the capture
+        shard_filenames = None
+        if args.use_shards and len(captures) == 1 and isinstance(captures[0], str) and args.from_frame is None and args.to_frame is None:
+            manifest = find_shard_manifest(captures[0])
+            if manifest is not None:
+                shard_filenames = select_shards(manifest, hosts, all_hosts=all_hosts)
+                if args.verbose:
+                    print('Querying %d of %d shards'%(len(shard_filenames), len(manifest['shards'])))
+                if profiler:
+                    profiler.count('shards_queried', len(shard_filenames))
+
+        # Ctrl-C (or SIGTERM) stops the query, the events found so far are
+        # still written out and drawn
+        progress = Progress.from_args(args, shard_filenames or captures)
+        with stage(profiler, 'query_logs'), progress.handle_signals():
+            if shard_filenames is not None:
+                events = ld.query_many_logs(
+                    capture_filenames=shard_filenames,
+                    hosts=hosts,
+                    all_hosts=all_hosts,
+                    event_type_names=args.events,
+                    event_types=event_types,
+                    settings=settings,
+                    verbose=args.verbose,
+                    profiler=profiler,
+                    from_time=from_time,
+                    to_time=to_time,
+                    progress=progress,
+                    frame_maps=[load_frame_map(f) for f in shard_filenames],
+                )
+            elif len(captures) > 1:
+                events = ld.query_merged_logs(
+                    capture_filenames=captures,
+                    hosts=hosts,
+                    all_hosts=all_hosts,
+                    event_type_names=args.events,
+                    event_types=event_types,
+                    clock_offsets=args.clock_offsets,
+                    from_frame=args.from_frame,
+                    to_frame=args.to_frame,
+                    settings=settings,
+                    verbose=args.verbose,
+                    profiler=profiler,
+                    from_time=from_time,
+                    to_time=to_time,
+                    progress=progress,
+                )
+            else:
+                events = ld.query_logs(
+                    capture_filename=captures[0],
+                    hosts=hosts,
+                    all_hosts=all_hosts,
+                    event_type_names=args.events,
+                    event_types=event_types,
+                    from_frame=args.from_frame,
+                    to_frame=args.to_frame,
+                    settings=settings,
+                    verbose=args.verbose,
+                    profiler=profiler,
+                    from_time=from_time,
+                    to_time=to_time,
+                    progress=progress,
+                )
+        progress.finish()
+        if progress.stop_requested:
+            print('Stopped early, keeping the %d events found so far'%len(events), file=sys.stderr)
+
+        # Filter out hosts not used in any events
+        ld.filter_hosts(hosts=hosts, events=events)
+
+        if not len(events):
+            print('No events were found for the selected hosts: %s'%(', '.join(hosts) if len(hosts) else '[no matched hosts]'))
+            return
+        else:
+            if args.verbose:
+                print('Examining %d events between hosts %s'%(len(events), ' '.join([str(x) for x in hosts])))
+
+        if args.events_outfile:
+            with stage(profiler, 'write_events'):
+                ld.write_events(filename=args.events_outfile, events=events)
+
+        # Statistics over all the events, before any are left out of the SVG
+        ack_stats = None
+        if args.ack_stats_outfile or args.ack_stats_table:
+            with stage(profiler, 'ack_stats'):
+                ack_stats = AckStats(window=args.ack_stats_window).add_events(events)
+            if args.ack_stats_outfile:
+                with stage(profiler, 'write_ack_stats'):
+                    write_ack_stats(args.ack_stats_outfile, ack_stats)
+
+        # Joined on all the events, before any are left out of the SVG
+        annotations = None
+        if args.propagation_outfile or (args.svg_outfile and args.propagation_annotations):
+            window = args.propagation_window if args.propagation_window is not None else settings.propagation_window
+            with stage(profiler, 'propagation'):
+                hops = join_hops(events, window=window)
+                paths = propagation_paths(hops)
+            if profiler:
+                profiler.count('hops_joined', len(hops))
+            if args.propagation_outfile:
+                with stage(profiler, 'write_propagation'):
+                    write_propagation_stats(args.propagation_outfile, PropagationStats().add_hops(hops).add_paths(paths))
+            if args.propagation_annotations:
+                annotations = PropagationAnnotations(paths, settings)
+
+        if args.minimap_outfile:
+            with stage(profiler, 'minimap'):
+                minimap = Minimap(events=events, settings=settings, bins=args.minimap_bins)
+                contents = minimap.generate()
+            with stage(profiler, 'write'):
+                ld.write_output(args.minimap_outfile, contents, profiler=profiler)
 
-    # Filter out hosts not used in any events
-    ld.filter_hosts(hosts=hosts, events=events)
+        if args.svg_outfile and args.coalesce_bursts:
+            with stage(profiler, 'coalesce_bursts'):
+                events = ld.coalesce_bursts(events=events, settings=settings, window=args.burst_window)
 
-    if not len(events):
-        print('No events were found for the selected hosts: %s'%(', '.join(hosts) if len(hosts) else '[no matched hosts]'))
-        return
-    else:
-        if args.verbose:
-            print('Examining %d events between hosts %s'%(len(events), ' '.join([str(x) for x in hosts])))
+        if args.svg_outfile and args.anomalies_only:
+            with stage(profiler, 'filter_anomalies'):
+                events = ld.filter_anomalies(
+                    events=events,
+                    settings=settings,
+                    context_events=args.context_events,
+                    context_time=args.context_time,
+                )
+            ld.filter_hosts(hosts=hosts, events=events)
 
-    if args.events_outfile:
-        ld.write_events(filename=args.events_outfile, events=events)
+            if not events:
+                print('No slow events were found')
+                return
 
-    if args.svg_outfile:
-        diag = Diagram(hosts=hosts, events=events, settings=settings)
-        contents = diag.generate()
+        if args.svg_outfile:
+            with stage(profiler, 'generate'):
+                diag = Diagram(hosts=hosts, events=events, settings=settings, summary=ack_stats if args.ack_stats_table else None, annotations=annotations)
+                # The events are rendered as they are written out
+                ld.write_diagram(args.svg_outfile, diag, profiler=profiler)
+            if profiler:
+                profiler.count('events_rendered', len(events))
 
-        with open(args.svg_outfile, 'w') as f: f.write(contents)
+        if progress.stop_requested:
+            sys.exit(128 + progress.stop_signal)
+    finally:
+        if profiler:
+            profiler.report(filename=args.profile_outfile or None)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import dsd.loaddata as ld
+from dsd.shards import shard_capture
+from dsd.profiling import Profiler, stage
+
+def main():
+    """ Split a capture into per host pair shards that queryCaptureLogs can use """
+
+    parser = ld.get_arg_parse(config=False, description='Split a capture by host pair (and optionally time) so queries only read the traffic of the hosts they look at')
+    parser.add_argument(
+        '-i', '--capture-file',
+        metavar='CAPTURE',
+        dest='capture_filename',
+        action='store',
+        required=True,
+        type=ld.argparse_file_exists,
+        help='Capture file (pcap or pcapng) to split'
+    )
+    parser.add_argument(
+        '-o', '--output-dir',
+        metavar='DIR',
+        dest='outdir',
+        default=None,
+        help='Where to write the shards and manifest.  Defaults to CAPTURE.shards, which is where queryCaptureLogs looks for them'
+    )
+    parser.add_argument(
+        '--bucket',
+        metavar='SECONDS',
+        dest='bucket_seconds',
+        type=float,
+        default=None,
+        help='Also split each host pair into buckets of this many seconds'
+    )
+
+    args = parser.parse_args()
+
+    profiler = Profiler.from_args(args)
+    try:
+        with stage(profiler, 'shard_capture'):
+            manifest = shard_capture(
+                capture_filename=args.capture_filename,
+                outdir=args.outdir,
+                bucket_seconds=args.bucket_seconds,
+                verbose=args.verbose,
+                profiler=profiler,
+            )
+        print('%d shards written'%len(manifest['shards']))
+    finally:
+        if profiler:
+            profiler.report(filename=args.profile_outfile or None)
+
+if __name__ == "__main__":
+    main()
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
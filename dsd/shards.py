@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+""" Split a capture into per host pair (and optionally per time bucket)
+shards, and find the shards relevant to a query.
+
+The shards are written in a directory next to the capture (<capture>.shards
+by default) along with a manifest.json describing them.  The manifest records
+the size and modification time of the source capture, so shards of a capture
+that has since changed are ignored.
+
+Next to each shard, <shard>.frames holds the frame number in the source
+capture of every frame of the shard (as little endian 32 bit integers), so
+events found in shards can be reported with the frame numbers of the
+capture (see load_frame_map). """
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import array
+import collections
+
+from dsd import pcapio
+from dsd import compression
+from dsd.iptrie import HostIndex
+
+MANIFEST_NAME = 'manifest.json'
+
+""" Bumped when the shards change, older ones are ignored """
+MANIFEST_VERSION = 2
+
+""" Flows idle for this many buckets are forgotten (a new packet of the same
+flow then starts in the current bucket) """
+IDLE_BUCKETS = 2
+
+class Shard(object):
+    """ One output file of shard_capture """
+
+    def __init__(self, filename, ips, bucket=None):
+        self.filename = filename
+        self.ips      = ips
+        self.bucket   = bucket
+
+        self.first_time = None
+        self.last_time  = None
+        self.packets    = 0
+
+        """ Frame numbers in the source capture of the packets written """
+        self.frames = array.array('I')
+
+        """ Open file handle, None when closed to save file descriptors """
+        self.f = None
+
+    def write(self, raw):
+        self.f.write(raw)
+
+    def write_frame_map(self):
+        frames = self.frames
+        if sys.byteorder == 'big':
+            frames = array.array('I', frames)
+            frames.byteswap()
+        with open(frame_map_filename(self.filename), 'wb') as f:
+            frames.tofile(f)
+
+    def to_json(self, outdir):
+        return {
+            'file':      os.path.relpath(self.filename, outdir),
+            'ips':       list(self.ips),
+            'bucket':    self.bucket,
+            'firstTime': self.first_time,
+            'lastTime':  self.last_time,
+            'packets':   self.packets,
+        }
+
+def default_shard_dir(capture_filename):
+    return capture_filename + '.shards'
+
+def frame_map_filename(shard_filename):
+    return shard_filename + '.frames'
+
+def load_frame_map(shard_filename):
+    """ Frame numbers in the source capture of the frames of a shard: frame
+    n of the shard is frame map[n - 1] of the capture """
+    frames = array.array('I')
+    with open(frame_map_filename(shard_filename), 'rb') as f:
+        frames.frombytes(f.read())
+    if sys.byteorder == 'big':
+        frames.byteswap()
+    return frames
+
+def _source_stat(capture_filename):
+    st = os.stat(capture_filename)
+    return st.st_size, st.st_mtime
+
+def shard_capture(capture_filename, outdir=None, bucket_seconds=None, max_open=256, verbose=False, profiler=None):
+    """ Split a capture into one file per IPv4 host pair in a single
+    streaming pass, and write the manifest.  Returns the manifest (as a dict).
+
+    With bucket_seconds, each host pair is further split by time.  A TCP or
+    UDP flow stays in the bucket it started in, so requests and their ACKs
+    always end up in the same shard.  Packets that aren't IPv4 are dropped.
+
+    At most max_open shard files are kept open at a time, the least recently
+    written ones are closed (and re-opened for appending if needed). """
+
+    if outdir is None:
+        outdir = default_shard_dir(capture_filename)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    size, mtime = _source_stat(capture_filename)
+
+    """ Header records (pcapng SHB and IDBs, or the pcap header) seen so far,
+    copied at the top of every new shard """
+    headers = []
+
+    """ Shards by (ip pair, bucket), and the open ones by least recent write """
+    shards    = {}
+    open_lru  = collections.OrderedDict()
+
+    """ Bucket of each flow, and the time it was last seen """
+    flows = {}
+
+    n_packets = 0
+    n_skipped = 0
+    fmt = None
+
+    def open_shard(shard):
+        if shard.f is None:
+            if len(open_lru) >= max_open:
+                _, oldest = open_lru.popitem(last=False)
+                oldest.f.close()
+                oldest.f = None
+            shard.f = open(shard.filename, 'ab')
+        open_lru[id(shard)] = shard
+        open_lru.move_to_end(id(shard))
+
+    with compression.open_input(capture_filename, 'rb') as src:
+        fmt = pcapio.capture_format(src)
+        ext = '.pcapng' if fmt == 'pcapng' else '.pcap'
+
+        for r in pcapio.iter_records(src):
+            if not r.is_packet:
+                if r.block_type == pcapio.PCAPNG_SHB:
+                    headers = []
+                if r.block_type in (None, pcapio.PCAPNG_SHB, pcapio.PCAPNG_IDB):
+                    headers.append(r.raw)
+                    # New interfaces have to be known to the shards already started
+                    for shard in shards.values():
+                        open_shard(shard)
+                        shard.write(r.raw)
+                continue
+
+            n_packets += 1
+            flow = pcapio.packet_flow(r.linktype, r.data)
+            if flow is None:
+                n_skipped += 1
+                continue
+
+            src_ip, dst_ip, proto, sport, dport = flow
+            pair = tuple(sorted((src_ip, dst_ip)))
+
+            bucket = None
+            if bucket_seconds and r.time is not None:
+                flow_key = (proto,) + tuple(sorted(((src_ip, sport), (dst_ip, dport)), key=str))
+                fb = flows.get(flow_key)
+                if fb is None or sport is None:
+                    bucket = int(r.time // bucket_seconds)
+                else:
+                    bucket = fb[0]
+                flows[flow_key] = (bucket, r.time)
+
+                # Forget flows idle for a while, this bounds memory on long captures
+                if n_packets % 100000 == 0:
+                    horizon = r.time - IDLE_BUCKETS * bucket_seconds
+                    flows = {k: v for k, v in flows.items() if v[1] >= horizon}
+
+            key = (pair, bucket)
+            shard = shards.get(key)
+            if shard is None:
+                name = '%s_%s'%pair
+                if bucket is not None:
+                    name += '_%d'%bucket
+                shard = Shard(os.path.join(outdir, name + ext), ips=pair, bucket=bucket)
+                shards[key] = shard
+                open(shard.filename, 'wb').close()
+                open_shard(shard)
+                for h in headers:
+                    shard.write(h)
+            else:
+                open_shard(shard)
+
+            shard.write(r.raw)
+            shard.packets += 1
+            shard.frames.append(r.number)
+            if r.time is not None:
+                if shard.first_time is None:
+                    shard.first_time = r.time
+                shard.last_time = r.time
+
+    for shard in open_lru.values():
+        shard.f.close()
+        shard.f = None
+    for shard in shards.values():
+        shard.write_frame_map()
+
+    manifest = {
+        'version':       MANIFEST_VERSION,
+        'source':        os.path.abspath(capture_filename),
+        'sourceSize':    size,
+        'sourceMtime':   mtime,
+        'format':        fmt,
+        'bucketSeconds': bucket_seconds,
+        'packets':       n_packets,
+        'skipped':       n_skipped,
+        'shards':        [s.to_json(outdir) for s in sorted(shards.values(), key=lambda s: (s.ips, s.bucket or 0))],
+    }
+    with open(os.path.join(outdir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    if verbose:
+        print('Wrote %d shards of %d packets (%d not IPv4) to %s'%(len(shards), n_packets, n_skipped, outdir), file=sys.stderr)
+    if profiler:
+        profiler.count('packets_sharded', n_packets)
+        profiler.count('shards_written', len(shards))
+
+    return manifest
+
+def find_shard_manifest(capture_filename, shard_dir=None):
+    """ The manifest of the shards of capture_filename, or None if there are
+    none or they are stale (the capture changed since they were written) """
+
+    if shard_dir is None:
+        shard_dir = default_shard_dir(capture_filename)
+    manifest_filename = os.path.join(shard_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_filename):
+        return None
+
+    try:
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+    except ValueError:
+        print('Ignoring unreadable shard manifest %s'%manifest_filename, file=sys.stderr)
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        print('Ignoring shards in %s written by an older version, run shardCapture again to use them'%shard_dir, file=sys.stderr)
+        return None
+
+    size, mtime = _source_stat(capture_filename)
+    if manifest.get('sourceSize') != size or manifest.get('sourceMtime') != mtime:
+        print('Ignoring stale shards in %s, the capture has changed since they were written'%shard_dir, file=sys.stderr)
+        return None
+
+    manifest['dir'] = shard_dir
+    return manifest
+
+def select_shards(manifest, hosts, all_hosts=None):
+    """ Filenames of the shards that can hold traffic matched by
+    loaddata.generate_display_filter for these hosts: shards between two of
+    the hosts, or any shard of the host if there's only one.  Addresses are
+    resolved against all_hosts (every configured host), see HostIndex. """
+
+    index = HostIndex(all_hosts or hosts, selected=hosts)
+    selected = []
+    for s in manifest['shards']:
+        a, b = [index.lookup(ip) for ip in s['ips']]
+        if len(hosts) > 1:
+            keep = a is not None and b is not None and a is not b
+        else:
+            keep = a is not None or b is not None
+        if keep:
+            selected.append(os.path.join(manifest['dir'], s['file']))
+    return selected
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
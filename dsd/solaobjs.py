@@ -5,6 +5,7 @@ from __future__ import print_function
 import re
 import random
 import datetime
+import ipaddress
 from aenum import Enum
 
 import dsd.svgobjs as svg
@@ -58,10 +59,10 @@ class DisplayOptions(JsonSerializatble):
         self.update(data)
 
     def __getattr__(self, attr):
-        if super(DisplayOptions, self).__getattr__(attr) is None and attr in super(DisplayOptions, self).__getattr__('_defaults'):
-            return super(DisplayOptions, self).__getattr__('_defaults')[attr]
-        else:
-            return super(DisplayOptions, self).__getattr__(attr)
+        value = super(DisplayOptions, self).__getattr__(attr)
+        if value is None:
+            return self._defaults.get(attr)
+        return value
 
     def __str__(self):
         return str(self._data)
@@ -131,11 +132,18 @@ class HostType(Enum):
 class Host(SerializeToSvg):
     """ Host (App, Admin, etc) system """
 
-    def __init__(self, id: str, name: str, ip: str, host_type: HostType, sort_nudge: int=100, display_options: DisplayOptions=None, description: str=None, settings=None):
+    def __init__(self, id: str, name: str, ip, host_type: HostType, sort_nudge: int=100, display_options: DisplayOptions=None, description: str=None, settings=None):
         super(Host, self).__init__()
         self.id          = id
         self.name        = name
-        self.ip          = ip
+
+        """ Addresses and/or CIDR subnets of the host.  ip is either one of
+        them or a list of them """
+        addresses = ip if isinstance(ip, list) else [ip]
+        self.networks = [ipaddress.ip_network(a, strict=False) for a in addresses]
+
+        """ Address(es) as displayed """
+        self.ip          = ', '.join(addresses)
         self.sort_nudge  = sort_nudge
         self.host_type   = host_type
         self.description = description
@@ -172,7 +180,9 @@ class Host(SerializeToSvg):
 
     @staticmethod
     def match(hosts, name_or_ip):
-        """ Provided with a list of systems form a config file, match a specific system by its IP or its name """
+        """ Provided with a list of systems form a config file, match a
+        specific system by its name, its IP, or an IP in one of its subnets
+        (the most specific one) """
 
         for h in hosts:
             if h.id.lower() == name_or_ip.lower():
@@ -182,7 +192,22 @@ class Host(SerializeToSvg):
             elif h.ip.lower() == name_or_ip.lower():
                 return h
 
-        return None
+        try:
+            address = ipaddress.ip_address(name_or_ip)
+        except ValueError:
+            return None
+
+        best = None
+        for h in hosts:
+            for n in h.networks:
+                if address in n and (best is None or n.prefixlen > best[0]):
+                    best = (n.prefixlen, h)
+        return best[1] if best else None
+
+    @property
+    def filter_addresses(self):
+        """ Addresses and subnets as written in Wireshark filters """
+        return [str(n.network_address) if n.prefixlen == n.max_prefixlen else str(n) for n in self.networks]
 
     def __str__(self):
         return '%s [%s]'%(self.name, self.ip)
@@ -198,8 +223,8 @@ class Host(SerializeToSvg):
         if self.last_event:
             self.display_options.lifeline_length = int(self.last_event.dt.total_seconds() * settings.time_spacing)  + self.display_options.height
 
-    def to_svg(self):
-        """ Serialize to an XML block """
+    def to_element(self):
+        """ The host as an svg.G: title box, lifeline and labels """
 
         # Name
         y_t=self.display_options.height * (3/7)
@@ -217,13 +242,12 @@ class Host(SerializeToSvg):
         )
 
         def escape(s):
-            s = s.replace("'", r"\\'")
+            s = s.replace("'", r"\'")
             return s
 
-        description_action = ''
+        description_action = None
         if type(self.description) is str and len(self.description):
-            description_action=' onclick="show_host_info(\'{description}\')"'.format(description=escape(self.description))
-
+            description_action = "show_host_info('{description}')".format(description=escape(self.description))
 
         host_name = svg.Tspan(self.name, settings=self.settings)
         host_name.position = (self.display_options.width/2, y_t)
@@ -241,46 +265,43 @@ class Host(SerializeToSvg):
         host_ip.text_anchor = 'middle'
         host_ip.role = 'line'
 
-        svg_content = '''<g
-       transform="translate({x_g},{y_g})"
-       id="host-{host}">
-      <rect
-         id="host-{host}-titlebox"
-         width="{width}"
-         height="{height}"
-         x="{x_r}"
-         y="{y_r}"
-         style="{rect_style}"
-         {description_action} />
-      <path
-         style="fill:none;stroke:#000000;stroke-width:0.20;stroke-linecap:butt;stroke-linejoin:miter;stroke-opacity:1;stroke-miterlimit:4;stroke-dasharray:0.60,0.20;stroke-dashoffset:0"
-         d="m {x_l},{y_l} v {lifeline_length}"
-         id="host-{host}-lifeline"
-         inkscape:connector-curvature="0"
-         sodipodi:nodetypes="cc" />
-      <text
-         xml:space="preserve"
-         style="{text_style}"
-         x="{x_t}"
-         y="{y_t}"
-         id="host-{host}-label">{host_name}{ip}</text>
-    </g>'''.format(
-            host=self.id.lower(),
-            host_name=host_name.to_svg(),
-            ip=host_ip.to_svg(),
-            width=self.display_options.width,
-            rect_style=rect_style,
-            description_action=description_action,
-            height=self.display_options.height,
-            text_style=self.display_options.text_style(),
-            x_g=self.display_options.x, y_g=self.display_options.y,
-            x_r=0, y_r=0,
-            x_t=self.display_options.width/2, y_t=y_t,
-            x_l=self.display_options.width/2, y_l=self.display_options.height,
-            lifeline_length=self.display_options.lifeline_length
-        )
-
-        return svg_content
+        host = self.id.lower()
+        return svg.G(attrs={'transform': 'translate(%s,%s)'%(self.display_options.x, self.display_options.y), 'id': 'host-%s'%host}, children=[
+            svg.Rect(
+                attrs={
+                    'id':      'host-%s-titlebox'%host,
+                    'width':   self.display_options.width,
+                    'height':  self.display_options.height,
+                    'x':       0,
+                    'y':       0,
+                    'onclick': description_action,
+                },
+                style=rect_style,
+            ),
+            svg.Path(
+                attrs={
+                    'd':  'm {x},{y} v {length}'.format(x=self.display_options.width/2, y=self.display_options.height, length=self.display_options.lifeline_length),
+                    'id': 'host-%s-lifeline'%host,
+                },
+                style='fill:none;stroke:#000000;stroke-width:0.20;stroke-linecap:butt;stroke-linejoin:miter;stroke-opacity:1;stroke-miterlimit:4;stroke-dasharray:0.60,0.20;stroke-dashoffset:0',
+                inkscape={'connector-curvature': '0'},
+                sodipodi={'nodetypes': 'cc'},
+            ),
+            svg.Text(
+                attrs={
+                    'xml:space': 'preserve',
+                    'x':         self.display_options.width/2,
+                    'y':         y_t,
+                    'id':        'host-%s-label'%host,
+                },
+                style=self.display_options.text_style(),
+                children=[host_name, host_ip],
+            ),
+        ])
+
+    def to_svg(self, svg_type=None):
+        """ Serialize to an XML block """
+        return self.to_element().to_svg(svg_type)
 
 class EventType(object):
     """ Hold information about an event """
@@ -309,6 +330,11 @@ class EventType(object):
     def __repr__(self):
         return '%s(%s)'%(self.name, self.display_options.color)
 
+def format_ack_time(ack_time):
+    if ack_time > 1:
+        return '%0.1f s'%ack_time
+    return '%0.0f ms'%(ack_time*1e3)
+
 class EventAckSpeed(Enum):
     """ ENUM for how we consider how fast an Event is """
 
@@ -364,6 +390,7 @@ class Event(SerializeToSvg):
         self.event_ack_speed = EventAckSpeed.NORMAL
 
         """ Time it took to receive the ACK (s) """
+        self._ack_time = None
         self.ack_time = ack_time
 
         """ Pointer to previous event (set in sort_and_process) """
@@ -418,54 +445,72 @@ class Event(SerializeToSvg):
         if len(events) < 2:
             return
 
-        # Make sure there are no huge gaps in the times.  If there are, reduce them
+        # Make sure there are no huge gaps in the times.  If there are, reduce
+        # them, carrying the total reduction so far along in a single pass
         if float(settings.max_time_gap) > 0:
             mdt = datetime.timedelta(seconds=settings.max_time_gap)
+            shift = datetime.timedelta(0)
             for i,e in enumerate(events):
                 if i==0: continue
                 dt = events[i].time - events[i-1].time
                 if dt > mdt:
+                    shift += dt-mdt
+                e.dt = e.dt - shift
 
-                    for en in events[i:]:
-                        en.dt = en.dt - (dt-mdt)
+    def svg_key(self):
+        """ Everything to_svg depends on.  Two events with the same key
+        serialize to the same fragment (up to the random offset of the
+        label), so this is what FragmentCache keys on. """
 
-    def to_svg(self):
-        """ Serialize to an XML block """
+        label_hidden = False
+        if self.prev:
+            label_hidden = self.time - self.prev.time < datetime.timedelta(seconds=self.settings.min_label_time_gap)
+
+        event_options = self.event_type.display_options
+        return (
+            self.time, self.time_label, label_hidden,
+            self.frame_id, self.ack_frame_id, self.ack_time, self.event_ack_speed,
+            self.display_options.x, self.display_options.y,
+            self.src.display_options.x, self.src.display_options.width, self.src.display_options.abs_center,
+            self.dst.display_options.abs_center,
+            self.event_type.name, event_options.color, event_options.text_style(),
+            self.settings.ack_threshold_slow_color, self.settings.ack_threshold_very_slow_color,
+        )
+
+    def to_element(self):
+        """ The event as an svg.G: arrow, label, and the time label unless
+        it is too close to the previous event's """
 
         id_prefix = 'time-%s'%re.sub('\W', '', str(self.time))
 
-        a_len = self.dst.display_options.abs_center - self.src.display_options.abs_center
-        if self.dst.display_options.abs_center < self.src.display_options.abs_center:
-            a_len = -1 * a_len
+        # DisplayOptions lookups aren't cheap, read each of them once
+        src_options   = self.src.display_options
+        event_options = self.event_type.display_options
+        event_color   = event_options.color
+        x, y = self.display_options.x, self.display_options.y
 
-        # Abs
-        a_start = self.src.display_options.abs_center
+        src_center = src_options.abs_center
+        dst_center = self.dst.display_options.abs_center
+        a_len = dst_center - src_center
+        if dst_center < src_center:
+            a_len = -1 * a_len
 
         # Position the label randomely a little
         label_pos = a_len/2.0 + random.randint(int(-1*a_len/4), int(a_len/4))
 
-        time_label_tspan = svg.Tspan(self.time_label)
-        time_label_tspan.position = (0,0)
-        time_label_tspan.id = '{id}-time-label-tspan'.format(id=id_prefix)
-
-        x_t = 0
-        time_text_obj = '''<text
-       id="{id}-time-label-text"
-       x="{x_t}"
-       y="{y_t}"
-       style="{text_style}"
-       xml:space="preserve">{t}</text>'''.format(
-            id='%s-text'%id_prefix,
-            x_t=x_t, y_t=0,
-            text_style=self.event_type.display_options.text_style(),
-            t=time_label_tspan.to_svg(),
-        )
+        text_style = event_options.text_style()
 
-        if self.prev:
-            dt = self.time - self.prev.time
-            if dt < datetime.timedelta(seconds=self.settings.min_label_time_gap):
-                time_text_obj=''
+        time_text = None
+        if not self.prev or self.time - self.prev.time >= datetime.timedelta(seconds=self.settings.min_label_time_gap):
+            time_label_tspan = svg.Tspan(self.time_label)
+            time_label_tspan.position = (0,0)
+            time_label_tspan.id = '{id}-time-label-tspan'.format(id=id_prefix)
 
+            time_text = svg.Text(
+                attrs={'id': '%s-text-time-label-text'%id_prefix, 'x': 0, 'y': 0, 'xml:space': 'preserve'},
+                style=text_style,
+                children=[time_label_tspan],
+            )
 
         def arrow_id(e):
             """ Select the proper arrow ID, these are defined in the template """
@@ -476,17 +521,14 @@ class Event(SerializeToSvg):
             else:
                 return 'ArrowRightNormal'
 
+        event_label_tspan = svg.Tspan(self.label_text())
+        event_label_tspan.id = '{id}-label-tspan'.format(id=id_prefix)
+        event_label_tspan.font_size = '2.5px'
+        event_label_tspan.font_color = event_color
+        event_label_tspan.on_click = self.capture_info()
 
-        event_label = self.event_type.name
         if type(self.ack_time) is float and EventAckSpeed.FAST != self.event_ack_speed:
-            event_label += ' ('
-
-            if self.ack_time > 1:
-                unit = 's'
-                val = '%0.1f %s'%(self.ack_time, unit)
-            else:
-                unit = 'ms'
-                val = '%0.0f %s'%(self.ack_time*1e3, unit)
+            val = self.ack_time_text()
 
             if self.event_ack_speed != EventAckSpeed.NORMAL:
                 event_label_ack_tspan = svg.Tspan(val)
@@ -495,108 +537,334 @@ class Event(SerializeToSvg):
                     event_label_ack_tspan.font_color = self.settings.ack_threshold_very_slow_color
                 else:
                     event_label_ack_tspan.font_color = self.settings.ack_threshold_slow_color
-                event_label += event_label_ack_tspan.to_svg()
+                event_label_tspan.extend([' (', event_label_ack_tspan, ')'])
             else:
-                event_label += '%s'%(val)
-            event_label += ')'
+                event_label_tspan.append(' (%s)'%val)
+
+        group = svg.G(attrs={'id': '%s-event-group'%id_prefix, 'transform': 'translate(%s,%s)'%(x, y)}, children=[
+            svg.G(
+                attrs={
+                    'id':        '%s-event'%id_prefix,
+                    'transform': 'translate(%s,%s)'%(src_options.x - x + (src_options.width/2.0), 0),
+                },
+                children=[
+                    svg.Path(
+                        attrs={'id': '%s-arrow'%id_prefix, 'd': 'm 0,0 h %s'%a_len},
+                        style='fill:none;stroke:{event_color};stroke-width:0.40;stroke-linecap:butt;stroke-linejoin:miter;stroke-miterlimit:4;stroke-dasharray:none;stroke-opacity:1;marker-end:url(#{arrow_id})'.format(
+                            event_color=event_color,
+                            arrow_id=arrow_id(self),
+                        ),
+                        inkscape={'connector-curvature': '0'},
+                    ),
+                    svg.Text(
+                        attrs={'id': '%s-label'%id_prefix, 'x': label_pos, 'y': 0, 'xml:space': 'preserve'},
+                        style=text_style,
+                        children=[event_label_tspan],
+                    ),
+                ],
+            ),
+        ])
+        if time_text is not None:
+            group.append(time_text)
+
+        return group
+
+    def label_text(self):
+        """ Text of the arrow's label """
+        return self.event_type.name
+
+    def ack_time_text(self):
+        """ The ACK time as shown after the label """
+        return format_ack_time(self.ack_time)
+
+    def capture_info(self):
+        """ Tiny lambda to include some additional info about the event in
+        the SVG.  This is done this way because I am still unsure of a good
+        way to do this, so a lambda gives me flexibility. """
+
+        return '''show_capture_info({{'time': new Date('{time}'), 'eventType': '{event_type}', 'frameId': {frame_id}, 'ackFrameId': {ack_frame_id}, 'ackTime': {ack_time}}})'''.format(
+                time=self.time,
+                event_type=self.event_type.name,
+                ack_time=self.ack_time,
+                frame_id=self.frame_id,
+                ack_frame_id=self.ack_frame_id,
+            )
+
+    def to_svg(self, svg_type=None):
+        """ Serialize to an XML block """
+        return self.to_element().to_svg(svg_type)
+
+class OmittedEvents(SerializeToSvg):
+    """ Placeholder drawn in place of a run of events that were elided from
+    the diagram (see loaddata.filter_anomalies) """
 
+    def __init__(self, events, settings=None):
+        super().__init__()
 
-        def inject_capture_info(e):
-            """ Tiny lambda to include some additional info about the event in
-            the SVG.  This is done this way because I am still unsure of a good
-            way to do this, so a lambda gives me flexibility. """
+        self.settings = settings
 
-            return '''show_capture_info({{'time': new Date('{time}'), 'eventType': '{event_type}', 'frameId': {frame_id}, 'ackFrameId': {ack_frame_id}, 'ackTime': {ack_time}}})'''.format(
-                    time=e.time,
-                    event_type=e.event_type.name,
-                    ack_time=e.ack_time,
-                    frame_id=e.frame_id,
-                    ack_frame_id=e.ack_frame_id,
-                )
+        """ Number of events this marker stands in for """
+        self.count = len(events)
 
-        event_label_tspan = svg.Tspan('%s'%event_label)
-        event_label_tspan.id = '{id}-label-tspan'.format(id=id_prefix)
-        event_label_tspan.font_size = '2.5px'
-        event_label_tspan.font_color = self.event_type.display_options.color
-        event_label_tspan.on_click = inject_capture_info(self)
-
-        svg_content = '''<g
-     id="{id}-event-group"
-     transform="translate({x_g},{y_g})">
-    <g
-       id="{id}-event"
-       transform="translate({x_e},{y_e})">
-      <path
-         inkscape:connector-curvature="0"
-         id="{id}-arrow"
-         d="m {x_a},{y_a} h {a_len}"
-         style="fill:none;stroke:{event_color};stroke-width:0.40;stroke-linecap:butt;stroke-linejoin:miter;stroke-miterlimit:4;stroke-dasharray:none;stroke-opacity:1;marker-end:url(#{arrow_id})" />
-      <text
-         id="{id}-label"
-         x="{x_l}"
-         y="{y_l}"
-         style="{text_style}"
-         xml:space="preserve">{event_label}</text>
-    </g>'''.format(
-            x_g=self.display_options.x, y_g=self.display_options.y,
-            x_e=self.src.display_options.x - self.display_options.x + (self.src.display_options.width/2.0), y_e=0,
-            x_a=0, y_a=0, a_len=a_len,
-            x_l=label_pos, y_l=0,
-            id=id_prefix,
-            arrow_id=arrow_id(self),
-            text_style=self.event_type.display_options.text_style(),
-            event_color=self.event_type.display_options.color,
-            event_label=event_label_tspan.to_svg(),
+        """ Time of the first omitted event, used to position the marker """
+        self.time = events[0].time
+        self.dt   = events[0].dt
+
+        """ Frame range covered by the omitted events """
+        self.frame_id     = events[0].frame_id
+        self.ack_frame_id = events[-1].ack_frame_id if events[-1].ack_frame_id is not None else events[-1].frame_id
+
+        self.time_label = ''
+
+        """ Markers are not between two hosts """
+        self.src = None
+        self.dst = None
+
+        self.prev = None
+        self.next = None
+
+    def __str__(self):
+        return '%d events omitted'%self.count
+
+    def __repr__(self):
+        return '%s: %d events omitted'%(self.time, self.count)
+
+    def to_element(self):
+        """ The marker as an svg.G: a dashed line across the diagram and a label """
+
+        id_prefix = 'omitted-%d'%self.frame_id
+
+        label = svg.Tspan('%d events omitted (frames %d-%d)'%(self.count, self.frame_id, self.ack_frame_id))
+        label.id = '%s-label-tspan'%id_prefix
+        label.font_size = '2.5px'
+        label.font_color = self.settings.omitted_color
+
+        return svg.G(attrs={'id': '%s-group'%id_prefix, 'transform': 'translate(%s,%s)'%(self.display_options.x, self.display_options.y)}, children=[
+            svg.Path(
+                attrs={'id': '%s-line'%id_prefix, 'd': 'm 0,0 h %s'%self.display_options.width},
+                style='fill:none;stroke:%s;stroke-width:0.30;stroke-dasharray:1.0,1.0;stroke-opacity:1'%self.settings.omitted_color,
+            ),
+            svg.Text(
+                attrs={'id': '%s-label'%id_prefix, 'x': self.display_options.width/2.0, 'y': -0.8, 'xml:space': 'preserve'},
+                style=self.display_options.text_style(),
+                children=[label],
+            ),
+        ])
+
+    def to_svg(self, svg_type=None):
+        """ Serialize to an XML block """
+        return self.to_element().to_svg(svg_type)
+
+class CoalescedEvents(Event):
+    """ A burst of events with the same source, destination and event type
+    drawn as one arrow labelled xN, with the range of their ACK times (see
+    loaddata.coalesce_bursts).  Clicking the label lists the frame IDs of
+    every event of the burst.
+
+    The arrow is drawn at the time of the first event, and takes the
+    slowest ACK of the burst for its colour. """
+
+    def __init__(self, events, settings=None):
+        first = events[0]
+        acks = [e.ack_time for e in events if e.ack_time is not None]
+
+        super().__init__(
+            time=first.time,
+            src=first.src,
+            dst=first.dst,
+            event_type=first.event_type,
+            settings=settings,
+            frame_id=first.frame_id,
+            ack_time=max(acks) if acks else None,
+            ack_frame_id=events[-1].ack_frame_id,
         )
-        if time_text_obj:
-            svg_content += '\n    ' + time_text_obj + '\n'
-        svg_content += '  </g>'
 
-        return svg_content
+        """ The events of the burst, in time order """
+        self.events = events
+
+        """ Number of events in the burst """
+        self.count = len(events)
+
+        """ Fastest and slowest ACK of the burst (s), None if none were ACKed """
+        self.min_ack_time = min(acks) if acks else None
+        self.max_ack_time = self.ack_time
+
+        self.time_label = first.time_label
+        self.dt         = first.dt
+
+    def __str__(self):
+        return '%s x%d'%(super().__str__(), self.count)
+
+    def __repr__(self):
+        return '%s x%d'%(super().__repr__(), self.count)
+
+    def svg_key(self):
+        return super().svg_key() + (self.count, self.min_ack_time, tuple(e.frame_id for e in self.events))
+
+    def label_text(self):
+        return '%s ×%d'%(self.event_type.name, self.count)
+
+    def ack_time_text(self):
+        lo = format_ack_time(self.min_ack_time)
+        hi = format_ack_time(self.max_ack_time)
+        if lo == hi:
+            return hi
+        lo_value, lo_unit = lo.split(' ')
+        if hi.endswith(' ' + lo_unit):
+            return '%s-%s'%(lo_value, hi)
+        return '%s-%s'%(lo, hi)
+
+    def capture_info(self):
+        def js(value):
+            return 'null' if value is None else str(value)
+
+        return '''show_capture_info({{'time': new Date('{time}'), 'eventType': '{event_type}', 'count': {count}, 'minAckTime': {min_ack_time}, 'maxAckTime': {max_ack_time}, 'frameIds': [{frame_ids}], 'ackFrameIds': [{ack_frame_ids}]}})'''.format(
+                time=self.time,
+                event_type=self.event_type.name,
+                count=self.count,
+                min_ack_time=js(self.min_ack_time),
+                max_ack_time=js(self.max_ack_time),
+                frame_ids=', '.join(str(e.frame_id) for e in self.events),
+                ack_frame_ids=', '.join(js(e.ack_frame_id) for e in self.events),
+            )
+
+class FragmentCache(object):
+    """ SVG fragments of events keyed on Event.svg_key, so re-rendering a
+    diagram after a change only serializes the events the change affected.
+
+    Only the fragments used by the latest render are kept. """
+
+    def __init__(self):
+        self.fragments = {}
+        self._used     = {}
+
+        """ Counters of the latest render """
+        self.hits   = 0
+        self.misses = 0
+
+    def begin(self):
+        self._used  = {}
+        self.hits   = 0
+        self.misses = 0
+
+    def fragment(self, e, svg_type=None):
+        key = (svg_type,) + e.svg_key()
+        f = self.fragments.get(key)
+        if f is None:
+            f = self._used.get(key)
+        if f is None:
+            self.misses += 1
+            f = e.to_svg(svg_type)
+        else:
+            self.hits += 1
+        self._used[key] = f
+        return f
+
+    def end(self):
+        self.fragments = self._used
+        self._used = {}
 
 class Diagram(object):
     """ Class to build our diagram.  Collects all the data, and then generates an SVG file  """
 
-    def __init__(self, hosts, events, settings, inkscape=False):
-        self.template    = svg.get_template()
+    def __init__(self, hosts, events, settings, inkscape=False, cache: FragmentCache=None, summary=None, annotations=None):
         self.hosts       = hosts
         self.events      = events
         self.settings    = settings
         self.inkscape    = inkscape
 
-    def generate(self):
-        """ Generate the SVG """
+        """ Output type, the inkscape/sodipodi attributes are only written for SvgType.INKSCAPE """
+        self.svg_type    = svg.SvgType.INKSCAPE if inkscape else svg.SvgType.PLAIN
+
+        """ Optional FragmentCache to reuse event fragments across renders """
+        self.cache       = cache
 
-        # First we have to position everything
-        svg_hosts = ''
+        """ Optional table drawn below the timeline, anything with a
+        to_element(x, y) returning (svg element, height), e.g.
+        ackstats.AckStats """
+        self.summary     = summary
+
+        """ Optional overlay drawn over the events once they are laid out,
+        anything with to_elements(events) returning svg elements, e.g.
+        propagation.PropagationAnnotations """
+        self.annotations = annotations
+
+    def layout_hosts(self):
+        """ Position the hosts and size their lifelines to the last event they take part in """
         for i, h in enumerate(self.hosts):
             h.display_options.x = self.settings.host_spacing*i + self.settings.time_margin_left
             h.display_options.y = 0
             h.last_event = next((e for e in reversed(self.events) if e.src==h or e.dst==h), None)
             h.compile(settings=self.settings)
-            svg_hosts = svg_hosts + h.to_svg()
-
-        events_svg = ''
-        for i, e in enumerate(self.events):
-            e.display_options.x = self.settings.time_margin_left
-            e.display_options.y = int(e.dt.total_seconds() * self.settings.time_spacing)
-            e.compile()
-            events_svg = events_svg + e.to_svg()
-
-        page_height = int(self.events[len(self.events)-1].dt.total_seconds() * self.settings.time_spacing) + 40
-        page_width = len(self.hosts)*self.settings.host_spacing + self.settings.time_margin_left + self.hosts[len(self.hosts)-1].display_options.width
-
-        outp = re.sub('{{hosts}}',       svg_hosts, self.template)
-        outp = re.sub('{{time-left}}',   str(0), outp)
-        outp = re.sub('{{time-top}}',    str(self.hosts[0].display_options.height + 10), outp)
-        outp = re.sub('{{events}}',      events_svg, outp)
-        outp = re.sub('{{page_width}}',  str(page_width), outp)
-        outp = re.sub('{{page_height}}', str(page_height), outp)
-
-        if not self.inkscape:
-            outp = re.sub('inkscape:[a-z-]+=".*?"\s*', '', outp)
-            outp = re.sub('sodipodi:[a-z-]+=".*?"\s*', '', outp)
-
-        return outp
+
+    def layout_event(self, e):
+        """ Position an event on the timeline """
+        e.display_options.x = self.settings.time_margin_left
+        e.display_options.width = len(self.hosts)*self.settings.host_spacing
+        e.display_options.y = int(e.dt.total_seconds() * self.settings.time_spacing)
+        e.compile()
+
+    def render_event(self, e):
+        """ SVG fragment of a positioned event, from the cache if there's one """
+        if self.cache is None or not hasattr(e, 'svg_key'):
+            return e.to_svg(self.svg_type)
+        return self.cache.fragment(e, self.svg_type)
+
+    def page_width(self):
+        return len(self.hosts)*self.settings.host_spacing + self.settings.time_margin_left + self.hosts[len(self.hosts)-1].display_options.width
+
+    def page_height(self, last_event):
+        return int(last_event.dt.total_seconds() * self.settings.time_spacing) + 40
+
+    def _render_events(self):
+        if self.cache is not None:
+            self.cache.begin()
+        for e in self.events:
+            yield self.render_event(e)
+        if self.cache is not None:
+            self.cache.end()
+
+    def document(self):
+        """ Position everything, returns the svg.Document.  The events are
+        only rendered as the document is written. """
+
+        self.layout_hosts()
+        svg_hosts = [h.to_element() for h in self.hosts]
+
+        for e in self.events:
+            self.layout_event(e)
+
+        page_height = self.page_height(self.events[len(self.events)-1])
+        page_width = self.page_width()
+        time_top = self.hosts[0].display_options.height + 10
+
+        summary_svg = []
+        if self.summary is not None:
+            table, summary_height = self.summary.to_element(x=self.settings.time_margin_left, y=page_height + time_top)
+            summary_svg.append(table)
+            page_height += summary_height + time_top
+
+        overlay = []
+        if self.annotations is not None:
+            overlay = self.annotations.to_elements(self.events)
+
+        return svg.build_document(
+            page_width=page_width,
+            page_height=page_height,
+            hosts=svg_hosts,
+            events=[svg.Fragments(self._render_events())] + overlay,
+            time_left=0,
+            time_top=time_top,
+            summary=summary_svg,
+        )
+
+    def generate(self):
+        """ Generate the SVG """
+        return self.document().to_svg(self.svg_type)
+
+    def write(self, f):
+        """ Write the SVG to an open (text) file as it is generated, e.g. a
+        compressed one from dsd.compression.open_output """
+        self.document().write(f.write, inkscape=self.svg_type == svg.SvgType.INKSCAPE)
 
 # vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+""" Minimal SVG object model.  Elements are plain trees (tag, attributes,
+style, children) written out by a single serializer, which escapes
+everything it writes and only emits the inkscape/sodipodi attributes for
+SvgType.INKSCAPE documents. """
+
 from __future__ import print_function
 
+import re
 from aenum import Enum
 
 
@@ -21,18 +27,221 @@ class SvgType(Enum):
     PLAIN     = 1
     INKSCAPE  = 2
 
-class Tspan(SvgObject):
+_ATTR_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+_TEXT_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Searching is much faster than translating, and hardly anything needs escaping
+_ATTR_SPECIAL = re.compile('[&<>"]').search
+_TEXT_SPECIAL = re.compile('[&<>]').search
+
+def escape_attr(value):
+    value = str(value)
+    return value.translate(_ATTR_ESCAPES) if _ATTR_SPECIAL(value) else value
+
+def escape_text(value):
+    value = str(value)
+    return value.translate(_TEXT_ESCAPES) if _TEXT_SPECIAL(value) else value
+
+class Element(object):
+    """ An SVG element.
+
+    attrs are written in order, followed by the sodipodi and inkscape ones
+    (for SvgType.INKSCAPE only) and the style, which is either a dict of
+    properties or a ready made string.  Attributes set to None are left out.
+    children are Elements, Raw markup, Fragments, or strings (text nodes),
+    text is written before them. """
+
+    TAG = None
+
+    __slots__ = ('tag', 'attrs', 'style', 'children', 'text', 'inkscape', 'sodipodi')
+
+    def __init__(self, tag=None, attrs=None, style=None, children=None, text=None, inkscape=None, sodipodi=None):
+        self.tag      = tag if tag is not None else self.TAG
+        self.attrs    = attrs if attrs is not None else {}
+        self.style    = style
+        self.children = children if children is not None else []
+        self.text     = text
+        self.inkscape = inkscape if inkscape is not None else {}
+        self.sodipodi = sodipodi if sodipodi is not None else {}
+
+    def append(self, child):
+        self.children.append(child)
+        return child
+
+    def extend(self, children):
+        self.children.extend(children)
+
+    def attributes(self, inkscape):
+        """ (name, value) of the attributes to write """
+        items = list(self.attrs.items())
+        if inkscape:
+            items += [('sodipodi:' + k, v) for k, v in self.sodipodi.items()]
+            items += [('inkscape:' + k, v) for k, v in self.inkscape.items()]
+        style = self.style
+        if style:
+            if style.__class__ is dict:
+                style = ';'.join([k + ':' + str(v) for k, v in style.items()])
+            items.append(('style', style))
+        return items
+
+    def write(self, write, inkscape=False):
+        """ The serializer: write this element and its children through the
+        write callable (e.g. a file's write).  The markup is handed over in
+        one piece, or in chunks as it goes for documents holding Fragments. """
+
+        out = []
+        self._serialize(out, write, inkscape)
+        write(''.join(out))
+
+    def _serialize(self, out, write, inkscape):
+        """ Append the markup to the list out, write is None or where
+        Fragments may flush out to """
+
+        append = out.append
+        tag = self.tag
+        append('<' + tag)
+        for k, v in self.attributes(inkscape):
+            if v is None:
+                continue
+            # Numbers never need escaping
+            if v.__class__ is int or v.__class__ is float:
+                append(' ' + k + '="' + str(v) + '"')
+            else:
+                append(' ' + k + '="' + escape_attr(v) + '"')
+
+        text = self.text
+        children = self.children
+        if text is None and not children:
+            append(' />')
+            return
+
+        append('>')
+        if text is not None:
+            append(escape_text(text))
+        for c in children:
+            if c.__class__ is str:
+                append(escape_text(c))
+            else:
+                c._serialize(out, write, inkscape)
+        append('</' + tag + '>')
+
+    def to_svg(self, svg_type=None):
+        """ Serialize to a string """
+        out = []
+        self._serialize(out, None, svg_type == SvgType.INKSCAPE)
+        return ''.join(out)
+
+class Raw(object):
+    """ Markup written as is, e.g. a fragment serialized earlier (and cached) """
+
+    __slots__ = ('markup',)
+
+    def __init__(self, markup):
+        self.markup = markup
+
+    def write(self, write, inkscape=False):
+        write(self.markup)
+
+    def _serialize(self, out, write, inkscape):
+        out.append(self.markup)
+
+class Fragments(object):
+    """ Markup fragments produced as the document is written, e.g. events
+    rendered one at a time.  When writing to a file, the markup written so
+    far is flushed every FLUSH_EVERY fragments, so the whole document never
+    has to be held in memory. """
+
+    FLUSH_EVERY = 1000
+
+    __slots__ = ('fragments',)
+
+    def __init__(self, fragments):
+        self.fragments = fragments
+
+    def _serialize(self, out, write, inkscape):
+        n = 0
+        for f in self.fragments:
+            out.append(f)
+            n += 1
+            if write is not None and n >= self.FLUSH_EVERY:
+                write(''.join(out))
+                del out[:]
+                n = 0
+
+class G(Element):
+    __slots__ = ()
+    TAG = 'g'
+
+class Rect(Element):
+    __slots__ = ()
+    TAG = 'rect'
+
+class Path(Element):
+    __slots__ = ()
+    TAG = 'path'
+
+class Text(Element):
+    __slots__ = ()
+    TAG = 'text'
+
+class Marker(Element):
+    __slots__ = ()
+    TAG = 'marker'
+
+class Document(Element):
+    """ The <svg> root, sized in mm with a viewBox in display units.
+    write() and to_svg() include the XML declaration. """
+
+    TAG = 'svg'
+
+    NAMESPACES = [
+        ('xmlns:dc',  'http://purl.org/dc/elements/1.1/'),
+        ('xmlns:cc',  'http://creativecommons.org/ns#'),
+        ('xmlns:rdf', 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'),
+        ('xmlns:svg', 'http://www.w3.org/2000/svg'),
+        ('xmlns',     'http://www.w3.org/2000/svg'),
+    ]
+
+    INKSCAPE_NAMESPACES = [
+        ('xmlns:inkscape', 'http://www.inkscape.org/namespaces/inkscape'),
+        ('xmlns:sodipodi', 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'),
+    ]
+
+    def __init__(self, page_width, page_height, children=None):
+        super(Document, self).__init__(attrs={
+            'id':      'svg8',
+            'version': '1.1',
+            'viewBox': '0 0 %s %s'%(page_width, page_height),
+            'width':   '%smm'%page_width,
+            'height':  '%smm'%page_height,
+        }, children=children)
+
+    def attributes(self, inkscape):
+        namespaces = self.NAMESPACES + (self.INKSCAPE_NAMESPACES if inkscape else [])
+        return namespaces + super(Document, self).attributes(inkscape)
+
+    XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+
+    def write(self, write, inkscape=False):
+        write(self.XML_DECLARATION)
+        super(Document, self).write(write, inkscape)
+
+    def to_svg(self, svg_type=None):
+        return self.XML_DECLARATION + super(Document, self).to_svg(svg_type)
+
+class Tspan(Element):
     """ A class that actually maps to a SVG tag - likely should have done this a while ago.  This object builds a <tspan> tag.
 
-    This class might be temporary though, if I can make use of it, I can probably upgrade to an actual SVG library. (just right now all the code is too far away from that.)
+    value is its text.  Nested tspans (e.g. to colour part of a label) and
+    more text can be appended as children.
     """
 
+    TAG = 'tspan'
+
     def __init__(self, value: str='', settings=None):
+        super(Tspan, self).__init__(style={})
         self.id = None
         self._position = None
-        self._sodipodi = {}
-        self._inkscape = {}
-        self._style = {}
         self.value = value
         self.on_click = None
 
@@ -58,7 +267,7 @@ class Tspan(SvgObject):
         if self._position is not None:
             return self._position['y']
         return None
-    @x.setter
+    @y.setter
     def y(self, val):
         if self._position is None:
             self._position={'x': 0, 'y': val}
@@ -75,101 +284,95 @@ class Tspan(SvgObject):
 
     @property
     def role(self):
-        if 'role' in self._sodipodi:
-            return self._sodipodi['role']
+        if 'role' in self.sodipodi:
+            return self.sodipodi['role']
         else:
             return None
     @role.setter
     def role(self, val):
-        self._sodipodi['role'] = val
+        self.sodipodi['role'] = val
 
     @property
     def font_color(self):
-        if 'fill' in self._style:
-            return self._style['fill']
+        if 'fill' in self.style:
+            return self.style['fill']
         else:
             return None
     @font_color.setter
     def font_color(self, val):
-        self._style['fill'] = val
+        self.style['fill'] = val
 
     @property
     def font_size(self):
-        if 'font-size' in self._style:
-            return self._style['font-size']
+        if 'font-size' in self.style:
+            return self.style['font-size']
         else:
             return None
     @font_size.setter
     def font_size(self, val):
-        self._style['font-size'] = val
+        self.style['font-size'] = val
 
     @property
     def text_align(self):
-        if 'text-align' in self._style:
-            return self._style['text-align']
+        if 'text-align' in self.style:
+            return self.style['text-align']
         else:
             return None
     @text_align.setter
     def text_align(self, val):
-        self._style['text-align'] = val
+        self.style['text-align'] = val
 
     @property
     def text_anchor(self):
-        if 'text-anchor' in self._style:
-            return self._style['text-anchor']
+        if 'text-anchor' in self.style:
+            return self.style['text-anchor']
         else:
             return None
     @text_anchor.setter
     def text_anchor(self, val):
-        self._style['text-anchor'] = val
+        self.style['text-anchor'] = val
 
-    def to_svg(self):
-        attrs={}
+    @property
+    def text(self):
+        return self.value
+    @text.setter
+    def text(self, val):
+        self.value = val
+
+    def attributes(self, inkscape):
+        self.attrs = {}
         if self._position:
-            attrs['x'] = self._position['x']
-            attrs['y'] = self._position['y']
-
-        if SvgType.INKSCAPE == self.type:
-            for k,v in self._sodipodi.items():
-                attrs['sodipodi:%s'%k] = v
-            for k,v in self._inkscape.items():
-                attrs['inkscape:%s'%k] = v
-
-        if len(self._style):
-            parts=[]
-            for k,v in self._style.items():
-                parts.append('%s:%s'%(k,v))
-            attrs['style'] = ';'.join(parts)
-
-        if self.on_click: attrs['onclick'] = str(self.on_click)
-        if self.id:       attrs['id']      = str(self.id)
-
-        s = '<tspan'
-        if len(attrs):
-            s += ' %s'%' '.join(['%s="%s"'%(k,v) for k,v in attrs.items()])
-        s += '>%s</tspan>'%self.value
-
-        return s
-
-def get_template():
-    """ Version 0 of this module held the template in a data file, but this
-    required an additional command line argument on each invokation.  The
-    version 1 goal is to have the SVG almost entirely generated without the
-    need for a template like this.  For now however, the template is returned
-    by this function """
-
-    return '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<svg
-   xmlns:dc="http://purl.org/dc/elements/1.1/"
-   xmlns:cc="http://creativecommons.org/ns#"
-   xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
-   xmlns:svg="http://www.w3.org/2000/svg"
-   xmlns="http://www.w3.org/2000/svg"
-   id="svg8"
-   version="1.1"
-   viewBox="0 0 {{page_width}} {{page_height}}"
-   width="{{page_width}}mm"
-   height="{{page_height}}mm">
+            self.attrs['x'] = self._position['x']
+            self.attrs['y'] = self._position['y']
+        self.attrs['onclick'] = self.on_click
+        self.attrs['id'] = self.id
+        return super(Tspan, self).attributes(inkscape)
+
+    def to_svg(self, svg_type=None):
+        return super(Tspan, self).to_svg(svg_type if svg_type is not None else self.type)
+
+def build_document(page_width, page_height, hosts, events, time_left=0, time_top=0, summary=None):
+    """ The diagram document: script, arrow markers, metadata, and the hosts
+    and events layers.  hosts, events and summary are lists of children
+    (Elements, Raw markup or Fragments). """
+
+    def arrow_marker(marker_id, stock_id, path_id, color):
+        return Marker(
+            attrs={'id': marker_id, 'refX': '0.0', 'refY': '0.0', 'orient': 'auto'},
+            style='overflow:visible;',
+            inkscape={'isstock': 'true', 'stockid': stock_id},
+            children=[Path(
+                attrs={
+                    'id': path_id,
+                    'transform': 'scale(0.6) rotate(180) translate(0,0)',
+                    'd': 'M 8.7185878,4.0337352 L -2.2072895,0.016013256 L 8.7185884,-4.0017078 C 6.9730900,-1.6296469 6.9831476,1.6157441 8.7185878,4.0337352 z ',
+                },
+                style='stroke-linejoin:round;stroke-opacity:1;fill-rule:evenodd;fill-opacity:1;stroke:{c};stroke-width:0.625;fill:{c}'.format(c=color),
+            )],
+        )
+
+    doc = Document(page_width, page_height)
+    doc.append(Raw('''
   <script type="text/javascript">
 // <![CDATA[
     function show_capture_info(e)
@@ -183,51 +386,13 @@ def get_template():
     }
 // ]]>
   </script>
-  <defs
-     id="defs2">
-    <marker
-       inkscape:isstock="true"
-       style="overflow:visible;"
-       id="ArrowRightNormal"
-       refX="0.0"
-       refY="0.0"
-       orient="auto"
-       inkscape:stockid="Arrow2MendR">
-      <path
-         transform="scale(0.6) rotate(180) translate(0,0)"
-         d="M 8.7185878,4.0337352 L -2.2072895,0.016013256 L 8.7185884,-4.0017078 C 6.9730900,-1.6296469 6.9831476,1.6157441 8.7185878,4.0337352 z "
-         style="stroke-linejoin:round;stroke-opacity:1;fill-rule:evenodd;fill-opacity:1;stroke:#506b83;stroke-width:0.625;fill:#506b83"
-         id="path6573" />
-    </marker>
-    <marker
-       inkscape:isstock="true"
-       style="overflow:visible;"
-       id="ArrowRightSlow"
-       refX="0.0"
-       refY="0.0"
-       orient="auto"
-       inkscape:stockid="Arrow2MendX">
-      <path
-         transform="scale(0.6) rotate(180) translate(0,0)"
-         d="M 8.7185878,4.0337352 L -2.2072895,0.016013256 L 8.7185884,-4.0017078 C 6.9730900,-1.6296469 6.9831476,1.6157441 8.7185878,4.0337352 z "
-         style="stroke-linejoin:round;stroke-opacity:1;fill-rule:evenodd;fill-opacity:1;stroke:#c87137;stroke-width:0.625;fill:#c87137"
-         id="path8002" />
-    </marker>
-    <marker
-       inkscape:stockid="Arrow2Mend"
-       orient="auto"
-       refY="0.0"
-       refX="0.0"
-       id="ArrowRightVerySlow"
-       style="overflow:visible;"
-       inkscape:isstock="true">
-      <path
-         id="path6326"
-         style="fill-rule:evenodd;stroke-width:0.625;stroke-linejoin:round;stroke:#ff0000;stroke-opacity:1;fill:#ff0000;fill-opacity:1"
-         d="M 8.7185878,4.0337352 L -2.2072895,0.016013256 L 8.7185884,-4.0017078 C 6.9730900,-1.6296469 6.9831476,1.6157441 8.7185878,4.0337352 z "
-         transform="scale(0.6) rotate(180) translate(0,0)" />
-    </marker>
-  </defs>
+  '''))
+    doc.append(Element('defs', attrs={'id': 'defs2'}, children=[
+        arrow_marker('ArrowRightNormal',   'Arrow2MendR', 'path6573', '#506b83'),
+        arrow_marker('ArrowRightSlow',     'Arrow2MendX', 'path8002', '#c87137'),
+        arrow_marker('ArrowRightVerySlow', 'Arrow2Mend',  'path6326', '#ff0000'),
+    ]))
+    doc.append(Raw('''
   <metadata
      id="metadata5">
     <rdf:RDF>
@@ -240,12 +405,17 @@ def get_template():
       </cc:Work>
     </rdf:RDF>
   </metadata>
-  <g inkscape:label="Hosts" inkscape:groupmode="layer" id="layer-hosts">
-     {{hosts}}
-  </g>
-  <g inkscape:label="Events" inkscape:groupmode="layer" id="layer-timeline" transform="translate({{time-left}},{{time-top}})">
-    {{events}}
-  </g>
-</svg>'''
+  '''))
+    doc.append(G(attrs={'id': 'layer-hosts'}, inkscape={'label': 'Hosts', 'groupmode': 'layer'}, children=[Raw('\n')] + list(hosts) + [Raw('\n  ')]))
+    doc.append(Raw('\n  '))
+    doc.append(G(
+        attrs={'id': 'layer-timeline', 'transform': 'translate(%s,%s)'%(time_left, time_top)},
+        inkscape={'label': 'Events', 'groupmode': 'layer'},
+        children=[Raw('\n')] + list(events) + [Raw('\n  ')],
+    ))
+    doc.append(Raw('\n'))
+    doc.extend(summary or [])
+
+    return doc
 
 # vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
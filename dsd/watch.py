@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+""" Re-render a diagram whenever its config or events CSV changes, keeping
+the parsed events and the SVG fragments of the events in memory so a change
+only costs what it affects. """
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+
+class DiagramWatcher(object):
+    """ Holds the parsed inputs of generateSequenceDiag between renders """
+
+    def __init__(self, config_filename, data_filename, output, from_frame=None, to_frame=None, from_time=None, to_time=None, anomalies_only=False, context_events=0, context_time=0, coalesce_bursts=False, burst_window=None, inkscape=False, verbose=False):
+        self.config_filename = config_filename
+        self.data_filename   = data_filename
+        self.output          = output
+        self.from_frame      = from_frame
+        self.to_frame        = to_frame
+        self.from_time       = from_time
+        self.to_time         = to_time
+        self.anomalies_only  = anomalies_only
+        self.context_events  = context_events
+        self.context_time    = context_time
+        self.coalesce_bursts = coalesce_bursts
+        self.burst_window    = burst_window
+        self.inkscape        = inkscape
+        self.verbose         = verbose
+
+        self.hosts       = None
+        self.event_types = None
+        self.settings    = None
+
+        """ Every event read (within the frame and time windows), sorted """
+        self.events = []
+
+        self.cache = so.FragmentCache()
+
+        """ Modification times of the inputs when they were last read """
+        self.mtimes = {}
+
+    def _changed(self, filename):
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            return False
+        if self.mtimes.get(filename) == mtime:
+            return False
+        self.mtimes[filename] = mtime
+        return True
+
+    def load_config(self):
+        self.hosts, self.event_types, self.settings = ld.read_config(self.config_filename)
+
+    def load_events(self):
+        self.events = ld.read_events(
+            self.data_filename,
+            hosts=self.hosts,
+            event_types=self.event_types,
+            settings=self.settings,
+            from_frame=self.from_frame,
+            to_frame=self.to_frame,
+            from_time=self.from_time,
+            to_time=self.to_time,
+        )
+
+    def rebind_events(self):
+        """ Point the events at the hosts, event types and settings of a
+        freshly read config, instead of parsing the CSV again """
+
+        hosts = {h.id: h for h in self.hosts}
+        event_types = {et.name: et for et in self.event_types}
+
+        events = []
+        for e in self.events:
+            src = hosts.get(e.src.id)
+            dst = hosts.get(e.dst.id)
+            et = event_types.get(e.event_type.name)
+            if src is None or dst is None or et is None:
+                print('Dropping event %r, its hosts or event type are no longer configured'%e, file=sys.stderr)
+                continue
+
+            e.src, e.dst, e.event_type, e.settings = src, dst, et, self.settings
+            # Classify the ACK again against the new thresholds
+            e.event_ack_speed = so.EventAckSpeed.NORMAL
+            e.ack_time = e.ack_time
+            events.append(e)
+        self.events = events
+
+    def update(self):
+        """ Re-read whatever changed, returns whether anything did """
+
+        config_changed = self._changed(self.config_filename)
+        data_changed   = self._changed(self.data_filename)
+
+        if config_changed or self.settings is None:
+            self.load_config()
+        if data_changed or self.settings is None:
+            self.load_events()
+        elif config_changed:
+            self.rebind_events()
+
+        return config_changed or data_changed
+
+    def render(self):
+        """ Write the SVG, returns the number of events drawn """
+
+        # Links and dt are recomputed every time, as the max time gap may
+        # have changed and filter_anomalies rewires them
+        events = list(self.events)
+        so.Event.sort_and_process(events=events, settings=self.settings)
+
+        hosts = list(self.hosts)
+        if self.coalesce_bursts:
+            events = ld.coalesce_bursts(events=events, settings=self.settings, window=self.burst_window)
+        if self.anomalies_only:
+            events = ld.filter_anomalies(
+                events=events,
+                settings=self.settings,
+                context_events=self.context_events,
+                context_time=self.context_time,
+            )
+        ld.filter_hosts(hosts=hosts, events=events)
+
+        if not events:
+            print('No events to draw', file=sys.stderr)
+            return 0
+
+        diag = so.Diagram(hosts=hosts, events=events, settings=self.settings, inkscape=self.inkscape, cache=self.cache)
+        ld.write_output(self.output, diag.generate())
+        return len(events)
+
+    def run(self, poll_interval=0.5):
+        """ Render, then render again on every change until interrupted """
+
+        try:
+            while True:
+                try:
+                    changed = self.update()
+                except (ValueError, KeyError, StopIteration) as e:
+                    # Most likely a file caught half written, try again on the next change
+                    print('Could not read the inputs: %s'%e, file=sys.stderr)
+                    changed = False
+
+                if changed:
+                    t0 = time.perf_counter()
+                    n = self.render()
+                    if n:
+                        print('Wrote %s: %d events, %d fragments re-serialized (%0.3f s)'%(
+                            self.output, n, self.cache.misses, time.perf_counter() - t0
+                        ), file=sys.stderr)
+
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
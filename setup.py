@@ -9,14 +9,21 @@ setup(
     author='Matthew Russell',
     author_email='matthew.russell@comtechtel.com',
     license='MIT',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires=['aenum', 'pyshark'],
+    extras_require={
+        # Reading and writing zstd compressed captures, CSVs and SVGs
+        'zstd': ['zstandard'],
+    },
     python_requires='>=3',
     entry_points = {
       'console_scripts': [
+          'dsd = dsd.cli:main',
+          'diffCaptures = dsd.diffCaptures:main',
           'generateSequenceDiag = dsd.generateSequenceDiag:main',
           'generateWireSharkDisplayFilters = dsd.generateWireSharkDisplayFilters:main',
           'queryCaptureLogs = dsd.queryLogs:main',
+          'shardCapture = dsd.shardCapture:main',
       ]
     },
     zip_safe=False
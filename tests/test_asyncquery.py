@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+""" dsd.asyncquery with stub captures in place of tshark """
+
+from __future__ import print_function
+
+import asyncio
+import datetime
+
+import pytest
+
+import dsd.loaddata as ld
+from dsd import asyncquery
+
+CONFIG = 'samples/sample1/config.json'
+
+class Layer(object):
+    ack = None
+
+class Packet(object):
+    """ A packet that isn't an HTTP request or response, which the
+    EventMatcher skips """
+
+    def __init__(self, number):
+        self.number = str(number)
+        self.sniff_time = datetime.datetime(2019, 8, 8, 12) + datetime.timedelta(milliseconds=number)
+
+    def __contains__(self, layer):
+        return layer == 'tcp'
+
+    def __getitem__(self, layer):
+        return Layer()
+
+class StubCapture(object):
+    closed = False
+
+    async def close_async(self):
+        self.closed = True
+
+def test_concurrent_queries_overlap(monkeypatch):
+    running = []
+    peak = []
+
+    async def slow_capture(capture_filename, **kwargs):
+        running.append(capture_filename)
+        peak.append(len(running))
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            running.remove(capture_filename)
+        return
+        yield
+
+    monkeypatch.setattr(asyncquery, 'aiter_capture_events', slow_capture)
+
+    hosts, event_types, settings = ld.read_config(CONFIG)
+    results = asyncquery.query_many(
+        ['a.pcapng', 'b.pcapng', 'c.pcapng', 'd.pcapng', 'e.pcapng'],
+        concurrency=3,
+        hosts=hosts,
+        event_type_names=[],
+        event_types=event_types,
+        settings=settings,
+    )
+
+    assert results == [[]]*5
+    assert max(peak) == 3
+
+def test_failure_cancels_the_other_queries(monkeypatch):
+    started = []
+    cancelled = []
+
+    async def capture(capture_filename, **kwargs):
+        started.append(capture_filename)
+        if capture_filename == 'bad.pcapng':
+            await asyncio.sleep(0.01)
+            raise RuntimeError('tshark crashed')
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(capture_filename)
+            raise
+        return
+        yield
+
+    monkeypatch.setattr(asyncquery, 'aiter_capture_events', capture)
+
+    hosts, event_types, settings = ld.read_config(CONFIG)
+    with pytest.raises(RuntimeError):
+        asyncquery.query_many(
+            ['a.pcapng', 'bad.pcapng', 'c.pcapng', 'd.pcapng'],
+            concurrency=2,
+            hosts=hosts,
+            event_type_names=[],
+            event_types=event_types,
+            settings=settings,
+        )
+
+    # Whatever was still running when bad failed is cancelled (c may have
+    # taken its slot), and d, still waiting for a slot, never starts
+    assert 'a.pcapng' in cancelled
+    assert sorted(cancelled) == sorted(f for f in started if f != 'bad.pcapng')
+    assert 'd.pcapng' not in started
+
+def test_tshark_waits_for_the_consumer(monkeypatch):
+    produced = []
+    cap = StubCapture()
+
+    async def packets(c):
+        for n in range(1, 101):
+            produced.append(n)
+            yield Packet(n)
+
+    monkeypatch.setattr(ld, 'open_capture', lambda *args, **kwargs: cap)
+    monkeypatch.setattr(asyncquery, '_tshark_packets', packets)
+    monkeypatch.setattr(asyncquery, 'QUEUE_SIZE', 10)
+
+    hosts, event_types, settings = ld.read_config(CONFIG)
+
+    # Wrap the EventStreamer to see how far ahead tshark is of each packet
+    # being processed
+    lead = []
+    feed = ld.EventStreamer.feed
+    def counting_feed(self, p):
+        lead.append(len(produced) - int(p.number))
+        return feed(self, p)
+    monkeypatch.setattr(ld.EventStreamer, 'feed', counting_feed)
+
+    events = asyncquery.query_many(['a.pcapng'], hosts=hosts, event_type_names=[], event_types=event_types, settings=settings)
+
+    assert events == [[]]
+    assert len(lead) == 100
+    # The queue, plus the packet being put
+    assert max(lead) <= 11
+    assert cap.closed
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
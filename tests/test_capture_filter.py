@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+""" BPF capture filters of loaddata.generate_capture_filter, compiled with
+tcpdump when it's installed, and otherwise parsed and evaluated by a
+checker for the subset of BPF the filters use """
+
+from __future__ import print_function
+
+import re
+import shutil
+import ipaddress
+import subprocess
+
+import pytest
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+
+def host(id, ip):
+    return so.Host(id=id, name=id, ip=ip, host_type=so.HostType.APP)
+
+def tokenize(expr):
+    return re.findall(r'\(|\)|[^\s()]+', expr)
+
+def compile_bpf(expr):
+    """ Predicate on (src address, dst address, port) of TCP packets for a
+    filter made of tcp, port N, [src|dst] host ADDR, [src|dst] net CIDR,
+    'and', 'or' and parentheses.  Raises SyntaxError for anything else. """
+
+    tokens = tokenize(expr)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        t = peek()
+        if t is None or (expected is not None and t != expected):
+            raise SyntaxError('Expected %s at token %d of %r, got %r'%(expected or 'a token', pos[0], expr, t))
+        pos[0] += 1
+        return t
+
+    def primitive():
+        t = peek()
+        if t == '(':
+            take('(')
+            e = alternatives()
+            take(')')
+            return e
+        if t == 'tcp':
+            take()
+            return lambda src, dst, port: True
+        if t == 'port':
+            take()
+            n = take()
+            if not n.isdigit() or not 0 < int(n) < 65536:
+                raise SyntaxError('Bad port %r in %r'%(n, expr))
+            return lambda src, dst, port: port == int(n)
+
+        direction = take() if t in ('src', 'dst') else None
+        kind = take()
+        if kind not in ('host', 'net'):
+            raise SyntaxError('Unexpected %r in %r'%(kind, expr))
+        try:
+            network = ipaddress.ip_network(take(), strict=True)
+        except ValueError as e:
+            raise SyntaxError(str(e))
+        if kind == 'host' and network.prefixlen != network.max_prefixlen:
+            raise SyntaxError('host takes an address, not %s'%network)
+        if kind == 'net' and network.prefixlen == network.max_prefixlen:
+            raise SyntaxError('net %s is a single address'%network)
+
+        def match(src, dst, port):
+            addresses = {'src': [src], 'dst': [dst], None: [src, dst]}[direction]
+            return any(ipaddress.ip_address(a) in network for a in addresses)
+        return match
+
+    def conjunction():
+        terms = [primitive()]
+        while peek() == 'and':
+            take()
+            terms.append(primitive())
+        return lambda *p: all(t(*p) for t in terms)
+
+    def alternatives():
+        terms = [conjunction()]
+        while peek() == 'or':
+            take()
+            terms.append(conjunction())
+        return lambda *p: any(t(*p) for t in terms)
+
+    e = alternatives()
+    if peek() is not None:
+        raise SyntaxError('Trailing %r in %r'%(peek(), expr))
+    return e
+
+HOSTS = [
+    ('single addresses', [host('A', '10.0.0.1'), host('B', '10.0.0.2')]),
+    ('subnets',          [host('A', '10.12.0.0/16'), host('B', ['10.0.0.2', '192.168.1.0/24'])]),
+    ('IPv6',             [host('A', '2001:db8::1'), host('B', '2001:db8:1::/48')]),
+    ('one host',         [host('A', '10.0.0.1')]),
+    ('no hosts',         []),
+]
+
+PORTS = [[80], [80, 8080, 443], []]
+
+@pytest.mark.parametrize('ports', PORTS)
+@pytest.mark.parametrize('name,hosts', HOSTS)
+def test_filter_parses(name, hosts, ports):
+    compile_bpf(ld.generate_capture_filter(hosts, ports=ports))
+
+@pytest.mark.skipif(shutil.which('tcpdump') is None, reason='tcpdump is not installed')
+@pytest.mark.parametrize('ports', PORTS)
+@pytest.mark.parametrize('name,hosts', HOSTS)
+def test_filter_compiles_with_tcpdump(name, hosts, ports):
+    expr = ld.generate_capture_filter(hosts, ports=ports)
+    r = subprocess.run(['tcpdump', '-d', expr], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert r.returncode == 0, r.stderr
+
+def test_single_addresses():
+    f = compile_bpf(ld.generate_capture_filter(HOSTS[0][1], ports=[80]))
+    assert f('10.0.0.1', '10.0.0.2', 80)
+    assert f('10.0.0.2', '10.0.0.1', 80)
+    assert not f('10.0.0.1', '10.0.0.3', 80)
+    assert not f('10.0.0.1', '10.0.0.1', 80)
+    assert not f('10.0.0.1', '10.0.0.2', 22)
+
+def test_subnets():
+    f = compile_bpf(ld.generate_capture_filter(HOSTS[1][1], ports=[80]))
+    assert f('10.12.3.4', '192.168.1.200', 80)
+    assert f('10.0.0.2', '10.12.255.1', 80)
+    assert not f('10.13.0.1', '10.0.0.2', 80)
+    assert not f('10.12.3.4', '10.12.3.5', 80)
+
+def test_ipv6():
+    f = compile_bpf(ld.generate_capture_filter(HOSTS[2][1], ports=[80]))
+    assert f('2001:db8::1', '2001:db8:1::42', 80)
+    assert not f('2001:db8::2', '2001:db8:1::42', 80)
+
+def test_ports():
+    f = compile_bpf(ld.generate_capture_filter(HOSTS[0][1], ports=[80, 8080, 443]))
+    assert all(f('10.0.0.1', '10.0.0.2', p) for p in (80, 8080, 443))
+    assert not f('10.0.0.1', '10.0.0.2', 8443)
+
+    f = compile_bpf(ld.generate_capture_filter(HOSTS[0][1], ports=[]))
+    assert f('10.0.0.1', '10.0.0.2', 8443)
+
+def test_one_host_either_way():
+    f = compile_bpf(ld.generate_capture_filter(HOSTS[3][1], ports=[80]))
+    assert f('10.0.0.1', '10.9.9.9', 80)
+    assert f('10.9.9.9', '10.0.0.1', 80)
+    assert not f('10.9.9.9', '10.9.9.8', 80)
+
+def test_no_hosts_or_ports():
+    assert ld.generate_capture_filter([], ports=[]) == 'tcp'
+    assert ld.generate_capture_filter([], ports=[80]) == 'tcp and port 80'
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+""" Host ids and event type names with XML special characters end up
+escaped in every SVG the commands write """
+
+from __future__ import print_function
+
+import json
+import datetime
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from dsd import api
+from dsd import diff
+from dsd.minimap import Minimap
+from dsd.ackstats import AckStats
+
+HOST = 'App<2>&A'
+EVENT_TYPE = 'Start"Call"&<Co>'
+
+@pytest.fixture
+def config():
+    with open('samples/sample1/config.json') as f:
+        data = json.load(f)
+    data['hosts'][1]['id'] = HOST
+    data['eventTypes'].append({'eventType': EVENT_TYPE})
+    return api.Config.from_dict(data)
+
+@pytest.fixture
+def events(config):
+    t = datetime.datetime(2019, 8, 8, 12)
+    return api.make_events([
+        (t, HOST, 'Admin2A', EVENT_TYPE, 0.004, 1, 2),
+        (t + datetime.timedelta(seconds=1), 'Admin2A', 'MIS2A', EVENT_TYPE, 0.2, 3, 4),
+    ], config)
+
+def parse(svg):
+    """ The texts of a well formed SVG document """
+    return ''.join(ET.fromstring(svg.encode('utf-8')).itertext())
+
+def test_minimap(config, events):
+    text = parse(Minimap(events, config.settings).generate())
+    assert '%s → Admin2A'%HOST in text
+
+def test_ack_stats_table(config, events):
+    diagram = api.make_diagram(events, config)
+    diagram.summary = AckStats().add_events(events)
+    text = parse(diagram.generate())
+    assert HOST in text
+    assert EVENT_TYPE in text
+
+def test_diff(config, events):
+    rows = diff.diff_events(events, events[:1])
+    text = parse(diff.DiffDiagram(list(config.hosts), rows, config.settings).generate())
+    assert EVENT_TYPE in text
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
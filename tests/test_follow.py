@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+""" queryCaptureLogs --follow, with a stub capture in place of tshark """
+
+from __future__ import print_function
+
+import sys
+import datetime
+
+import pytest
+
+import dsd.loaddata as ld
+from dsd import follow
+from dsd import queryLogs
+from test_matcher import request, response, other
+
+ARGS = ['queryCaptureLogs', '-c', 'samples/sample1/config.json', '-i', 'capture.pcapng', '-o', 'diag.svg', '--follow']
+
+@pytest.mark.parametrize('options', [
+    ['--from-frame', '10'],
+    ['--to-time', '5'],
+    ['--minimap-svg', 'minimap.svg'],
+    ['--anomalies-only'],
+    ['--coalesce-bursts'],
+    ['--ack-stats', 'stats.csv'],
+    ['--propagation-annotations'],
+    ['--no-shards'],
+    ['--progress-json', '-'],
+])
+def test_rejected(monkeypatch, capsys, options):
+    monkeypatch.setattr(sys, 'argv', ARGS + options)
+    with pytest.raises(SystemExit) as e:
+        queryLogs.main()
+    assert e.value.code == 2
+    assert '--follow cannot be combined with %s'%options[0] in capsys.readouterr().err
+
+def test_follow_logs(monkeypatch, tmp_path):
+    monkeypatch.setattr(ld, 'find_event_type', lambda xml: 'StartCall')
+    hosts, event_types, settings = ld.read_config('samples/sample1/config.json')
+    timeout = int(settings.ack_timeout*1000)
+
+    packets = [
+        request(1),
+        request(2),
+        response(3, request_in=2),
+        other(2 + timeout),
+        # Too late for the first request, drawn already
+        response(3 + timeout, request_in=1),
+    ]
+
+    class StubCapture(object):
+        def __init__(self, pipe, **kwargs):
+            self.pipe = pipe
+
+        def __iter__(self):
+            return iter(packets)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(follow, 'PipeCapture', StubCapture)
+
+    capture = tmp_path/'capture.pcapng'
+    capture.write_bytes(b'')
+    svg_filename = str(tmp_path/'diag.svg')
+    events = follow.follow_logs(
+        capture_filename=str(capture),
+        hosts=hosts,
+        event_type_names=['StartCall'],
+        event_types=event_types,
+        svg_filename=svg_filename,
+        settings=settings,
+    )
+
+    # In capture order, the first one timed out
+    assert [(e.frame_id, e.ack_frame_id) for e in events] == [(1, None), (2, 3)]
+    assert events[0].ack_time is None
+    with open(svg_filename) as f:
+        assert f.read().endswith('</svg>')
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+""" Captures read through a pipe (dsd.frameindex), opened and closed
+without running tshark """
+
+from __future__ import print_function
+
+import os
+import gzip
+import shutil
+import asyncio
+
+import pytest
+
+from dsd import frameindex
+from benchmarks import synthetic
+
+@pytest.fixture(scope='module')
+def capture(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('capture')/'capture.pcapng')
+    synthetic.write_pcapng(filename, 100, synthetic.make_config(n_hosts=3))
+    return filename
+
+def assert_closed(fd):
+    with pytest.raises(OSError):
+        os.fstat(fd)
+
+def check_close(cap):
+    pipe = cap._pipe
+    try:
+        cap.close()
+    finally:
+        cap.eventloop.close()
+    assert_closed(pipe)
+    cap.writer.join(1)
+    assert not cap.writer.is_alive()
+
+def check_close_async(open_capture):
+    async def run():
+        cap = open_capture()
+        pipe = cap._pipe
+        await cap.close_async()
+        return pipe
+    assert_closed(asyncio.run(run()))
+
+def window_capture(capture, **kwargs):
+    index = frameindex.load_frame_index(capture)
+    return frameindex.WindowCapture(index, from_frame=25, to_frame=50, **kwargs)
+
+def test_window_capture_close(capture):
+    check_close(window_capture(capture, eventloop=asyncio.new_event_loop()))
+
+def test_window_capture_close_async(capture):
+    check_close_async(lambda: window_capture(capture))
+
+@pytest.fixture(scope='module')
+def compressed(capture):
+    filename = capture + '.gz'
+    with open(capture, 'rb') as f, gzip.open(filename, 'wb') as out:
+        shutil.copyfileobj(f, out)
+    return filename
+
+def test_decompressed_capture_close(compressed):
+    check_close(frameindex.DecompressedCapture(compressed, eventloop=asyncio.new_event_loop()))
+
+def test_decompressed_capture_close_async(compressed):
+    check_close_async(lambda: frameindex.DecompressedCapture(compressed))
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+""" Pairing of requests and ACKs by dsd.loaddata.EventMatcher, on stub
+packets in place of tshark's """
+
+from __future__ import print_function
+
+import datetime
+
+import pytest
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+
+APP   = '10.12.10.75'
+ADMIN = '10.12.10.68'
+
+class Layer(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class Packet(object):
+    def __init__(self, number, layers):
+        self.number = str(number)
+        self.sniff_time = datetime.datetime(2019, 8, 8, 12) + datetime.timedelta(milliseconds=number)
+        self.layers = layers
+
+    def __contains__(self, layer):
+        return layer in self.layers
+
+    def __getitem__(self, layer):
+        return self.layers[layer]
+
+def other(number):
+    """ A packet the matcher skips, e.g. to let time pass """
+    return Packet(number, {'tcp': Layer(ack=None)})
+
+def request(number, port=50000, src=APP, dst=ADMIN, layer='ip'):
+    return Packet(number, {
+        layer:  Layer(src=src, dst=dst),
+        'tcp':  Layer(srcport=str(port), dstport='80', ack='1'),
+        'http': Layer(request_method='POST'),
+        'xml':  Layer(),
+    })
+
+def response(number, request_in=None, port=50000, src=ADMIN, dst=APP, layer='ip'):
+    http = Layer(response_code='200', time='0.005')
+    if request_in is not None:
+        http.request_in = str(request_in)
+    return Packet(number, {
+        layer:  Layer(src=src, dst=dst),
+        'tcp':  Layer(srcport='80', dstport=str(port), ack='1'),
+        'http': http,
+    })
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setattr(ld, 'find_event_type', lambda xml: 'StartCall')
+    return ld.read_config('samples/sample1/config.json')
+
+@pytest.fixture
+def matcher(config):
+    hosts, event_types, settings = config
+    return ld.EventMatcher(hosts=hosts, event_types=event_types, settings=settings)
+
+def streamer(config, **kwargs):
+    hosts, event_types, settings = config
+    return ld.EventStreamer(hosts=hosts, event_types=event_types, settings=settings, **kwargs)
+
+def test_linked(matcher):
+    matcher.process(request(1))
+    matcher.process(request(2))
+    kind, e = matcher.process(response(3, request_in=2))
+    assert kind == ld.EventMatcher.ACK
+    assert (e.frame_id, e.ack_frame_id, e.ack_time) == (2, 3, 0.005)
+
+def test_unlinked_single_pending(matcher):
+    matcher.process(request(1))
+    kind, e = matcher.process(response(5))
+    assert kind == ld.EventMatcher.ACK
+    assert (e.frame_id, e.ack_frame_id) == (1, 5)
+    assert e.ack_time == pytest.approx(0.004)
+
+def test_unlinked_several_pending(matcher):
+    # Could answer either request, or one that wasn't selected
+    matcher.process(request(1))
+    matcher.process(request(2))
+    assert matcher.process(response(3)) == (None, None)
+    assert matcher.n_unmatched_acks == 1
+    assert sorted(matcher.pending) == [1, 2]
+
+    # Still paired once tshark links the responses
+    assert matcher.process(response(4, request_in=1))[1].frame_id == 1
+    assert matcher.process(response(6, request_in=2))[1].frame_id == 2
+
+def test_unlinked_other_connection(matcher):
+    matcher.process(request(1, port=50000))
+    assert matcher.process(response(2, port=50001)) == (None, None)
+
+def host(id, ip):
+    return so.Host(id=id, name=id, ip=ip, host_type=so.HostType.APP)
+
+def test_ipv6(config):
+    hosts = [host('A', '2001:db8::1'), host('B', '2001:db8:1::/48')]
+    m = ld.EventMatcher(hosts=hosts, event_types=config[1], settings=config[2])
+    kind, e = m.process(request(1, src='2001:db8::1', dst='2001:db8:1::7', layer='ipv6'))
+    assert kind == ld.EventMatcher.POST
+    assert (e.src.id, e.dst.id) == ('A', 'B')
+    assert m.process(response(2, src='2001:db8:1::7', dst='2001:db8::1', layer='ipv6'))[1] is e
+
+def test_unselected_host_in_selected_pool(config):
+    pool  = host('Pool', '10.12.0.0/16')
+    admin = host('Admin', ADMIN)
+    app   = host('App', APP)
+    m = ld.EventMatcher(hosts=[pool, admin], all_hosts=[pool, admin, app], event_types=config[1], settings=config[2])
+
+    # App's address is in the pool's subnet, but App wasn't selected
+    assert m.process(request(1)) == (None, None)
+    kind, e = m.process(request(2, src='10.12.3.4'))
+    assert (e.src, e.dst) == (pool, admin)
+
+def test_streamer_holds_only_requests_in_flight(config):
+    s = streamer(config)
+    timeout = int(s.ack_timeout.total_seconds()*1000)
+
+    assert s.feed(request(1)) == []
+    assert [e.frame_id for e in s.feed(response(3, request_in=1))] == [1]
+    assert s.feed(request(4)) == []
+    released = s.feed(other(4 + timeout))
+    assert [(e.frame_id, e.ack_frame_id) for e in released] == [(4, None)]
+
+    assert s.matcher.pending == {}
+    assert (s.matcher.n_events, s.matcher.n_unacked) == (2, 1)
+
+    # Too late, the event was handed over already
+    assert s.feed(response(5 + timeout, request_in=4)) == []
+    assert released[0].ack_time is None
+    assert s.matcher.n_unmatched_acks == 1
+
+def test_streamer_clock_offset(config):
+    s = streamer(config, clock_offset=10)
+    s.feed(request(1))
+    e, = s.feed(response(5))
+    assert e.ack_time == pytest.approx(0.004)
+    assert e.time == request(1).sniff_time + datetime.timedelta(seconds=10)
+
+    s.feed(request(6))
+    e, = s.finish()
+    assert e.time == request(6).sniff_time + datetime.timedelta(seconds=10)
+    assert s.matcher.pending == {}
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+""" Number of time bins of the minimap """
+
+from __future__ import print_function
+
+import argparse
+
+import pytest
+
+import dsd.loaddata as ld
+from dsd.minimap import Minimap
+
+def parser():
+    return ld.add_minimap_args(argparse.ArgumentParser())
+
+@pytest.mark.parametrize('bins', ['0', '-3', 'many'])
+def test_bins_rejected(capsys, bins):
+    with pytest.raises(SystemExit):
+        parser().parse_args(['--minimap-bins', bins])
+    assert 'Expected a positive integer, got %s'%bins in capsys.readouterr().err
+
+def test_bins():
+    assert parser().parse_args(['--minimap-bins', '50']).minimap_bins == 50
+
+def test_bins_setting():
+    hosts, event_types, settings = ld.read_config('samples/sample1/config.json')
+    settings.minimap_bins = 0
+    with pytest.raises(ValueError):
+        Minimap(events=[], settings=settings)
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+""" dsd.progress: stopping on signals, and the figures reported """
+
+from __future__ import print_function
+
+import time
+
+import pytest
+
+from dsd import profiling
+from dsd import frameindex
+from dsd.progress import Progress, _capture_frames
+from benchmarks import synthetic
+
+def test_memory_budget_through_signal_handler(monkeypatch):
+    # The watchdog interrupts the main thread with SIGINT, which must not be
+    # taken for a request to stop
+    monkeypatch.setattr(profiling, '_interrupted_by', None)
+    progress = Progress()
+    with pytest.raises(profiling.MemoryBudgetExceeded):
+        with progress.handle_signals():
+            profiler = profiling.Profiler(memory_budget=1, report=False)
+            with profiler.stage('query_logs'):
+                deadline = time.monotonic() + 5
+                while time.monotonic() < deadline:
+                    time.sleep(0.01)
+    assert not progress.stop_requested
+
+def test_total_frames(tmp_path):
+    capture = str(tmp_path/'capture.pcapng')
+    synthetic.write_pcapng(capture, 100, synthetic.make_config(n_hosts=3))
+
+    # Not indexed, only the frame range tells
+    assert _capture_frames(capture) is None
+    assert _capture_frames(capture, from_frame=11, to_frame=30) == 20
+    assert not (tmp_path/'capture.pcapng.frames.json').exists()
+
+    frames = frameindex.load_frame_index(capture).frames
+    assert _capture_frames(capture) == frames
+    assert _capture_frames(capture, from_frame=11) == frames - 10
+    assert _capture_frames([capture, capture], to_frame=frames + 5) == frames + 5
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
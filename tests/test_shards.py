@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+""" Shards written by dsd.shards and the frame numbers of the events found in them """
+
+from __future__ import print_function
+
+import datetime
+
+import dsd.solaobjs as so
+import dsd.loaddata as ld
+from dsd import pcapio
+from dsd import shards
+from benchmarks import synthetic
+
+def packets(filename):
+    with open(filename, 'rb') as f:
+        return {r.number: r.data for r in pcapio.iter_records(f) if r.is_packet}
+
+def test_frame_maps(tmp_path):
+    capture = str(tmp_path/'capture.pcapng')
+    synthetic.write_pcapng(capture, 200, synthetic.make_config(n_hosts=4))
+
+    manifest = shards.shard_capture(capture, bucket_seconds=0.5)
+    assert shards.find_shard_manifest(capture) is not None
+
+    source = packets(capture)
+    seen = []
+    for s in manifest['shards']:
+        filename = str(tmp_path/'capture.pcapng.shards'/s['file'])
+        frame_map = shards.load_frame_map(filename)
+        shard = packets(filename)
+        assert len(frame_map) == len(shard) == s['packets']
+        for number, data in shard.items():
+            assert source[frame_map[number - 1]] == data
+        seen.extend(frame_map)
+
+    assert sorted(seen) == sorted(source)
+
+def test_query_many_logs_maps_frames(monkeypatch):
+    hosts, event_types, settings = ld.read_config('samples/sample1/config.json')
+    et = event_types[0]
+
+    def shard_events(capture_filename, **kwargs):
+        # Both shards find an event in their frames 1 and 2
+        second = capture_filename == 'b.pcapng'
+        return iter([so.Event(
+            settings=settings,
+            time=datetime.datetime(2019, 8, 8, 12, 0, int(second)),
+            src=hosts[0],
+            dst=hosts[1],
+            event_type=et,
+            ack_time=0.01,
+            frame_id=1,
+            ack_frame_id=None if second else 2,
+        )])
+    monkeypatch.setattr(ld, 'iter_capture_events', shard_events)
+
+    events = ld.query_many_logs(
+        capture_filenames=['a.pcapng', 'b.pcapng'],
+        hosts=hosts,
+        event_type_names=[et.name],
+        event_types=event_types,
+        settings=settings,
+        frame_maps=[[3, 7], [4, 9]],
+    )
+
+    assert [(e.frame_id, e.ack_frame_id) for e in events] == [(3, 7), (4, None)]
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
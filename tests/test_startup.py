@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+""" The commands that don't read captures must not import pyshark (or the
+modules that need it), nor the process pool of parallel CSV parsing unless
+asked for, to start quickly from batch scripts """
+
+from __future__ import print_function
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CAPTURE_MODULES = ['pyshark', 'dsd.frameindex', 'dsd.asyncquery', 'concurrent.futures']
+
+def imported_capture_modules(code):
+    """ Capture modules loaded by running code in a fresh interpreter """
+    check = '\nimport sys\nprint(" ".join(m for m in %r if m in sys.modules))'%CAPTURE_MODULES
+    out = subprocess.check_output([sys.executable, '-c', code + check], cwd=ROOT, universal_newlines=True)
+    return out.split()
+
+@pytest.mark.parametrize('module', ['dsd.generateSequenceDiag', 'dsd.cli', 'dsd.api'])
+def test_import(module):
+    assert imported_capture_modules('import %s'%module) == []
+
+def test_generate(tmp_path):
+    events = tmp_path/'events.csv'
+    events.write_text('\n'.join([
+        'time,src,dst,eventType,ackTime,frameId,ackFrameId',
+        '2019-08-08 12:00:00.063041,App2A,Admin2A,StartCall,0.004,1,2',
+        '2019-08-08 12:00:00.126540,Admin2A,MIS2A,StartCall,0.1,4,5',
+    ]) + '\n')
+
+    code = '\n'.join([
+        'import sys',
+        'from dsd import cli',
+        'sys.argv = ["dsd", "generate", "-c", "samples/sample1/config.json", "-i", %r, "-o", %r]'%(str(events), str(tmp_path/'diag.svg')),
+        'cli.main()',
+    ])
+    assert imported_capture_modules(code) == []
+    assert (tmp_path/'diag.svg').stat().st_size > 0
+
+def test_api(tmp_path):
+    code = '\n'.join([
+        'import datetime',
+        'from dsd import api',
+        'config = api.Config.from_file("samples/sample1/config.json")',
+        'events = [(datetime.datetime(2019, 8, 8, 12), "App2A", "Admin2A", "StartCall", 0.004)]',
+        'api.write_svg(events, config, %r)'%str(tmp_path/'diag.svg'),
+    ])
+    assert imported_capture_modules(code) == []
+    assert (tmp_path/'diag.svg').stat().st_size > 0
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+""" Options generateSequenceDiag --watch doesn't support are rejected
+rather than silently ignored """
+
+from __future__ import print_function
+
+import sys
+
+import pytest
+
+from dsd import generateSequenceDiag
+
+ARGS = ['generateSequenceDiag', '-c', 'samples/sample1/config.json', '-i', 'samples/sample1/events.csv', '-o', 'diag.svg', '--watch']
+
+@pytest.mark.parametrize('options', [
+    ['--minimap-svg', 'minimap.svg'],
+    ['--ack-stats', 'stats.csv'],
+    ['--ack-stats-table'],
+    ['--propagation', 'propagation.csv'],
+    ['--propagation-annotations'],
+    ['--jobs', '4'],
+    ['--profile'],
+    ['--memory-budget', '2G'],
+])
+def test_rejected(monkeypatch, capsys, options):
+    monkeypatch.setattr(sys, 'argv', ARGS + options)
+    with pytest.raises(SystemExit) as e:
+        generateSequenceDiag.main()
+    assert e.value.code == 2
+    assert '--watch cannot be combined with %s'%options[0] in capsys.readouterr().err
+
+# vim: sw=4 ts=4 sts=0 expandtab ft=python ffs=unix :